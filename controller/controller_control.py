@@ -1,4 +1,5 @@
 from PySide2.QtCore import QObject
+import os
 import re
 import logging
 import traceback
@@ -6,7 +7,11 @@ import string
 import random
 import numpy as np
 from collections import OrderedDict, deque
-from shape_core.gcode_manager import GCoder, GCodeParser, GCodeLeveler
+from concurrent.futures import ThreadPoolExecutor
+from shape_core.gcode_manager import GCoder, GCodeParser, GCodeLeveler, GCodeProgram
+from shape_core.gcode_stats import GCodeStats
+from shape_core.gcode_runtime import GCodeRuntime
+from shape_core.probe_grid import ProbeGrid, HeightMap
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +29,8 @@ class ControlController(QObject):
     SPLITPAT = re.compile(r"[:,]")
     VARPAT = re.compile(r"^\$(\d+)=(\d*\.?\d*) *\(?.*")
 
+    PARSE_WORKERS = 4
+
     def __init__(self, settings):
         super(ControlController, self).__init__()
         self.settings = settings
@@ -41,6 +48,14 @@ class ControlController(QObject):
         self.abl_val = []
         self.abl_steps = ()
         self.abl_cmd_ls = []
+        # grid indexes probed by the ABL commands, None for the last one in the center
+        self.abl_idx_ls = []
+        self.abl_num_sent = 0
+        self.abl_grid = None
+        self.abl_probe_cfg = ()
+        self.abl_bbox = ()
+        # height map of the last probing, or loaded, applied to the files
+        self.height_map = None
         self.prb_num_todo = 0
         self.prb_num_done = 0
         self.prb_reps_todo = 1
@@ -48,8 +63,16 @@ class ControlController(QObject):
 
         self.status_report_od = OrderedDict({})
         self.workspace_params_od = OrderedDict({})
+        # GRBL $ settings, cached when reported by the machine
+        self.grbl_settings_od = OrderedDict({})
+        # version and build options, reported by $I
+        self.build_info_od = OrderedDict({})
 
         self.gcodes_od = OrderedDict({})
+        self.programs_od = OrderedDict({})
+        # files parsed in background
+        self.parse_pool = ThreadPoolExecutor(max_workers=min(self.PARSE_WORKERS, os.cpu_count() or 1))
+        self.parsing_od = OrderedDict({})
 
     def get_probe_value(self):
         return self.prb_val[0]
@@ -57,8 +80,33 @@ class ControlController(QObject):
     def get_abl_value(self):
         return self.abl_val
 
-    def get_next_abl_cmd(self):
-        return self.abl_cmd_ls[self.prb_num_done]
+    def get_height_map(self):
+        return self.height_map
+
+    def save_height_map(self, path):
+        if self.height_map is None:
+            return False
+        try:
+            self.height_map.save(path)
+        except OSError as e:
+            logging.error(e, exc_info=True)
+            return False
+        return True
+
+    def load_height_map(self, path):
+        height_map = HeightMap.load(path)
+        if height_map is not None:
+            self.height_map = height_map
+            logger.info("Height map loaded: " + str(height_map.get_info()))
+        return height_map
+
+    def get_pending_abl_lines(self):
+        # the commands not sent yet, streamed together: the reports are matched to the points in order
+        lines = []
+        for cmd in self.abl_cmd_ls[self.abl_num_sent:]:
+            lines += cmd.splitlines(keepends=True)
+        self.abl_num_sent = len(self.abl_cmd_ls)
+        return lines
 
     def process_probe_and_abl(self):
         ack_prb_flag = False
@@ -147,6 +195,16 @@ class ControlController(QObject):
         self.status_report_od["wpos"] = self.wpos_a
         return [self.status, self.mpos_a, self.wpos_a]
 
+    def parse_grbl_setting(self, line):
+        match = self.VARPAT.match(line.strip())
+        if match is None:
+            return False
+        try:
+            self.grbl_settings_od[int(match.group(1))] = float(match.group(2))
+        except ValueError as e:
+            logging.error(e, exc_info=True)
+        return True
+
     def parse_bracket_square(self, line):
         word = self.SPLITPAT.split(line.rstrip()[1:-1])
 
@@ -178,6 +236,16 @@ class ControlController(QObject):
             self.workspace_params_od["G92"] = np.array([float(word[1]), float(word[2]), float(word[3])])
         elif word[0] == "TLO":
             self.workspace_params_od["TLO"] = float(word[1])
+        elif word[0] == "VER":
+            self.build_info_od["version"] = word[1]
+        elif word[0] == "OPT":
+            # [OPT:options,planner blocks,rx buffer bytes]
+            try:
+                self.build_info_od["options"] = word[1]
+                self.build_info_od["planner_size"] = int(word[2])
+                self.build_info_od["rx_buffer_size"] = int(word[3])
+            except (ValueError, IndexError) as e:
+                logging.error(e, exc_info=True)
 
         return self.prb_val[0]
 
@@ -187,14 +255,17 @@ class ControlController(QObject):
         self.prb_num_todo = 1
         self.prb_reps_todo = 1
 
-    def cmd_auto_bed_levelling(self, bbox_t, steps_t, feedrate_probe):
-        xy_coord_list = self.get_grid_coords(bbox_t, steps_t)
+    def cmd_auto_bed_levelling(self, bbox_t, steps_t, feedrate_probe, probe_mode='grid',
+                               probe_tolerance=ProbeGrid.TOLERANCE_DEFAULT):
+        self.abl_grid = ProbeGrid(bbox_t, steps_t, probe_mode, probe_tolerance)
         travel_z = bbox_t[5]
         probe_z_min = bbox_t[2]
-        logger.debug(xy_coord_list)
-
-        [self.abl_cmd_ls, self.prb_num_todo] = self.make_cmd_auto_bed_levelling(xy_coord_list, travel_z,
-                                                                                probe_z_min, feedrate_probe)
+        self.abl_probe_cfg = (travel_z, probe_z_min, feedrate_probe)
+        self.abl_bbox = tuple(bbox_t)
+        self.abl_cmd_ls = []
+        self.abl_idx_ls = []
+        self.abl_num_sent = 0
+        self.add_next_abl_cmds()
         self.abl_val = []
         self.abl_steps = (steps_t[0], steps_t[1])
         self.prb_num_done = 0
@@ -218,11 +289,30 @@ class ControlController(QObject):
         xi, yi = np.meshgrid(xc, yc)
         return list(zip(xi.ravel().tolist(), yi.ravel().tolist()))
 
+    def add_next_abl_cmds(self):
+        # the next points decided by the probe grid, or the last probe in the center when it is complete
+        idx_l = self.abl_grid.next_batch()
+        travel_z, probe_z_min, feedrate_probe = self.abl_probe_cfg
+        if idx_l:
+            xy_coord_list = self.abl_grid.get_coords(idx_l)
+            logger.debug(xy_coord_list)
+            [abl_cmd_ls, prb_num_todo] = self.make_cmd_auto_bed_levelling(xy_coord_list, travel_z, probe_z_min,
+                                                                          feedrate_probe, center=False)
+        else:
+            xy_first = self.abl_grid.get_coords([(0, 0)])[0]
+            abl_cmd_ls = [GCoder.get_probe_center_code(self.abl_grid.get_center(), xy_first, travel_z,
+                                                       probe_z_min, feedrate_probe)]
+            idx_l = [None]
+        self.abl_cmd_ls += abl_cmd_ls
+        self.abl_idx_ls += idx_l
+        self.prb_num_todo = len(self.abl_cmd_ls)
+
     @staticmethod
-    def make_cmd_auto_bed_levelling(xy_c_l, travel_z, probe_z_min, probe_feed_rate):
+    def make_cmd_auto_bed_levelling(xy_c_l, travel_z, probe_z_min, probe_feed_rate, center=True):
 
         gcr = GCoder("dummy", "commander")
-        abl_cmd_ls, prb_num_todo = gcr.get_autobed_leveling_code(xy_c_l, travel_z, probe_z_min, probe_feed_rate)
+        abl_cmd_ls, prb_num_todo = gcr.get_autobed_leveling_code(xy_c_l, travel_z, probe_z_min, probe_feed_rate,
+                                                                 center)
 
         logger.debug("ABL routine: " + str(abl_cmd_ls))
         logger.debug("ABL points to do: " + str(prb_num_todo))
@@ -237,12 +327,22 @@ class ControlController(QObject):
             self.prb_num_done += 1
             self.abl_val.append(self.prb_val[0])
             # self.prb_val = []  # doesn't need anymore
-            if self.prb_num_done == self.prb_num_todo:
+            idx = self.abl_idx_ls[self.prb_num_done - 1]
+            if idx is not None:
+                self.abl_grid.set_value(idx, self.prb_val[0][2])
+            if self.prb_num_done == self.prb_num_todo and idx is not None:
+                # batch done, the grid decides what is next
+                self.add_next_abl_cmds()
+                send_next = True
+            elif self.prb_num_done == self.prb_num_todo:
+                # the whole grid, probed or interpolated, and the last probe in the center
+                self.abl_val = self.abl_grid.get_abl_values(self.wco_a[:2]) + [self.prb_val[0]]
+                self.height_map = HeightMap.from_probes(self.abl_val, self.abl_steps, self.wco_a, self.abl_bbox)
+                logger.info("ABL probes: " + str(self.abl_grid.get_probed_count()) + " / " +
+                            str(self.abl_grid.z.size))
                 ack_flag = True
                 self.abl_activated = False
-            elif self.prb_num_done < self.prb_num_todo:
-                send_next = True
-            else:
+            elif self.prb_num_done > self.prb_num_todo:
                 logging.error("ABL: Number of probe done exceeded the number of probe to do.")
 
         return [ack_flag, send_next]
@@ -259,33 +359,138 @@ class ControlController(QObject):
             new_tag = self.id_generator(4)
         return new_tag
 
-    def load_gcode_file(self, cfg, gcode_path):
+    def add_program(self, gcode_path, program):
+        self.programs_od[gcode_path] = program
+
+    def get_program(self, gcode_path):
+        # generated in this session, or saved next to the file
+        program = self.programs_od.get(gcode_path)
+        if program is not None and not program.is_valid_for(gcode_path):
+            self.programs_od.pop(gcode_path, None)
+            program = None
+        if program is None:
+            program = GCodeProgram.load(gcode_path)
+        return program
+
+    @staticmethod
+    def get_file_stats(gcode_path):
+        st = os.stat(gcode_path)
+        return st.st_size, st.st_mtime
+
+    def parse_gcode_file(self, cfg, gcode_path):
         gcp = GCodeParser(cfg)
-        gcp.load_gcode_file(gcode_path)
-        gcp.interp()
-        gcp.vectorize()
-        # ov = gcp.get_gcode_original_vectors()
-        tag = self.get_new_tag()
-        if gcp is not None:
-            self.gcodes_od[gcode_path] = {"gcode": gcp, "tag": tag}
+        program = self.get_program(gcode_path)
+        if program is not None:
+            logger.debug("GCode program loaded without parsing: " + str(gcode_path))
+            gcp.load_program(program, gcode_path)
+        else:
+            gcp.load_gcode_file(gcode_path)
+            gcp.interp()
+            gcp.vectorize()
+            if gcp.get_gcode() is not None:
+                program = GCodeProgram.from_gcode(gcp.get_gcode())
+                try:
+                    program.save(gcode_path)
+                except OSError as e:
+                    logger.warning("GCode program sidecar not saved: " + str(e))
+        return gcp
+
+    def add_gcode_file(self, gcode_path, gcp, stats):
+        if gcode_path in self.gcodes_od.keys():
+            # parsed again, keep the tag of the visualization and the interpolation chosen for the job
+            tag = self.gcodes_od[gcode_path]["tag"]
+            abl_interp = self.gcodes_od[gcode_path].get("abl_interp")
+        else:
+            tag = self.get_new_tag()
+            abl_interp = None
+        self.gcodes_od[gcode_path] = {"gcode": gcp, "tag": tag, "stats": stats, "abl_interp": abl_interp}
+
+    def is_gcode_file_loaded(self, gcode_path):
+        if gcode_path not in self.gcodes_od.keys():
+            return False
+        try:
+            return self.gcodes_od[gcode_path]["stats"] == self.get_file_stats(gcode_path)
+        except OSError:
+            return False
+
+    def read_gcode_file(self, cfg, gcode_path):
+        # the stats are read next to the parse, the content loaded is the one they describe
+        stats = self.get_file_stats(gcode_path)
+        gcp = self.parse_gcode_file(cfg, gcode_path)
+        return gcp, stats
+
+    def load_gcode_file(self, cfg, gcode_path):
+        gcp, stats = self.read_gcode_file(cfg, gcode_path)
+        self.add_gcode_file(gcode_path, gcp, stats)
+
+    def submit_gcode_file(self, cfg, gcode_path):
+        # parse the file in the pool, returns None if the unchanged file is already loaded
+        if self.is_gcode_file_loaded(gcode_path):
+            return None
+        if gcode_path in self.parsing_od.keys():
+            return self.parsing_od[gcode_path]
+        if gcode_path in self.gcodes_od.keys():
+            self.gcodes_od[gcode_path]["gcode"].release_gcode_file()
+        future = self.parse_pool.submit(self.read_gcode_file, cfg, gcode_path)
+        self.parsing_od[gcode_path] = future
+        return future
+
+    def collect_gcode_file(self, gcode_path):
+        # store the result of a background parsing, returns True if the file is loaded,
+        # False if it has failed and None if it is not being parsed
+        if gcode_path not in self.parsing_od.keys():
+            return None
+        future = self.parsing_od.pop(gcode_path)
+        try:
+            gcp, stats = future.result()
+        except Exception as e:
+            # whatever a bad file or sidecar raises in the pool, the control thread goes on
+            logger.error("GCode file not loaded: " + str(gcode_path) + ": " + str(e), exc_info=True)
+            return False
+        self.add_gcode_file(gcode_path, gcp, stats)
+        return True
 
     def remove_gcode_file(self, gcode_path):
         if self.gcodes_od[gcode_path]:
+            self.gcodes_od[gcode_path]["gcode"].release_gcode_file()
             del self.gcodes_od[gcode_path]
 
+    def release_gcode_files(self, keep=()):
+        # unmap the loaded files so that they can be generated again,
+        # except the ones still in use (the file streaming)
+        for gcode_path in self.gcodes_od.keys():
+            if gcode_path not in keep:
+                self.gcodes_od[gcode_path]["gcode"].release_gcode_file()
+
     def get_gcode_tag_and_v(self, gcode_path):
-        v = self.gcodes_od[gcode_path]["gcode"].get_gcode_vectors()
+        v = self.gcodes_od[gcode_path]["gcode"].get_gcode_runs()
         tag = self.gcodes_od[gcode_path]["tag"]
         return tag, v
 
-    def apply_abl(self, gcode_path):
+    def set_abl_interp(self, gcode_path, kind=None):
+        # interpolation of the height map for the job, None for the one of the machine settings
+        if gcode_path in self.gcodes_od.keys():
+            self.gcodes_od[gcode_path]["abl_interp"] = kind if kind in GCodeLeveler.INTERP_KINDS else None
+
+    def get_abl_interp(self, gcode_path, default='cubic'):
+        kind = self.gcodes_od[gcode_path].get("abl_interp") if gcode_path in self.gcodes_od.keys() else None
+        return default if kind is None else kind
+
+    def apply_abl(self, gcode_path, kind=None, mode='grid', tolerance=GCodeLeveler.TOLERANCE_DEFAULT):
+        # kind overrides the interpolation of the job for this apply only
         print("Apply ABL")
+        if kind is None:
+            kind = self.get_abl_interp(gcode_path)
         gcp = self.get_gcode_gcp(gcode_path)
-        abl = GCodeLeveler(gcp.gc)
-        abl_val = self.abl_val.copy()
-        last_probe = abl_val.pop()
-        abl.get_grid_data(abl_val, self.abl_steps, last_probe, self.wco_a)
-        abl.interp_grid_data()
+        # the leveler of the file keeps the subdivision, new probes only change the heights
+        abl = self.gcodes_od[gcode_path].get("leveler")
+        if abl is None or abl.gc is not gcp.gc:
+            abl = GCodeLeveler(gcp.gc, kind=kind, mode=mode, tolerance=tolerance)
+            self.gcodes_od[gcode_path]["leveler"] = abl
+        abl.set_options(kind, mode, tolerance)
+        # the interpolation is computed once for the height map, whatever the file
+        abl.set_grid_data(self.height_map.grid_data)
+        abl.ig = self.height_map.get_interp(kind)
         abl.apply_abl()
         # print("Leveled")
         # print(gcp.gc.modified_vectors)
@@ -302,7 +507,7 @@ class ControlController(QObject):
         return self.gcodes_od[gcode_path]["gcode"]
 
     def get_gcode_lines(self, gcode_path):
-        return self.gcodes_od[gcode_path]["gcode"].recode_gcode()
+        return self.gcodes_od[gcode_path]["gcode"].get_gcode_stream()
 
     def get_change_tool_lines(self):
         gcp = GCodeParser(None)
@@ -311,3 +516,12 @@ class ControlController(QObject):
     def get_boundary_box(self, gcode_path):
         logger.debug(gcode_path)
         return self.gcodes_od[gcode_path]["gcode"].get_bbox()
+
+    def get_gcode_stats(self, gcode_path):
+        return GCodeStats.from_gcode(self.gcodes_od[gcode_path]["gcode"].get_gcode(),
+                                     GCodeStats.get_rapid_rate(self.grbl_settings_od))
+
+    def get_gcode_runtime(self, gcode_path):
+        runtime = GCodeRuntime(self.grbl_settings_od)
+        runtime.estimate(self.gcodes_od[gcode_path]["gcode"])
+        return runtime
@@ -1,6 +1,7 @@
 from PySide2.QtCore import Slot, QObject, Signal, QTimer
 from PySide2.QtGui import QPixmap
-import re
+import os
+import queue
 from collections import OrderedDict as Od
 from .controller_view import ViewController
 from .controller_control import ControlController
@@ -8,7 +9,8 @@ from .controller_align import AlignController
 import logging
 import traceback
 
-from shape_core.gcode_manager import GCoder, GCodeMacro
+from shape_core.gcode_manager import GCoder
+from shape_core.grbl_sender import GrblSender
 
 logger = logging.getLogger(__name__)
 
@@ -28,8 +30,11 @@ class ControllerWorker(QObject):
     update_bbox_s = Signal(tuple)
     update_gcode_s = Signal(str, list, bool, bool)
     gcode_vectorized_s = Signal(str)
+    gcode_parsed_s = Signal(str)                 # Signal from the parser pool, a file has been parsed
+    gcode_failed_s = Signal(str)                 # Signal to report a file that could not be loaded
 
     update_file_progress_s = Signal(float)
+    update_file_eta_s = Signal(float, float)     # Signal to update the estimated total and remaining time [s]
 
     reset_controller_status_s = Signal()
     stop_send_s = Signal()
@@ -51,6 +56,7 @@ class ControllerWorker(QObject):
         self.align_controller = AlignController(self.settings)
 
         self.send_tool_change_s.connect(self.start_tool_change)
+        self.gcode_parsed_s.connect(self.collect_gcode_file)
 
         self.poll_timer = None
         self.alive_timer = None
@@ -59,9 +65,6 @@ class ControllerWorker(QObject):
         self.align_active = False
 
         self.status_to_ack = 0
-        self.buffered_cmds = []
-        self.cmds_to_ack = 0
-        self.wait_tag_decoding = False
         self.dro_status_updated = False
 
         self.abl_apply_active = True
@@ -77,30 +80,38 @@ class ControllerWorker(QObject):
         self.prb_reps_done = 0
 
         self.sending_file = False
-        self.file_content = []
-        self.content_line = 0
         self.file_progress = 0.0
-        self.sent_lines = 0
-        self.ack_lines = 0
-        self.tot_lines = 0
-        self.buffered_size = 0
         self.max_buffered_lines = 100
         self.min_buffer_threshold = 80
         self.eof_wait_for_idle = False
 
         self.active_gcode_path = ""
+        # file read while it is sent, it must stay mapped
+        self.streaming_gcode_path = ""
 
         self.gcr = GCoder("dummy", "commander")
         self.update_gerber_cfg()
-        self.macro_on = False
-        self.macro_obj = None
+        # streaming core, the macros take the machine data from the controller
+        self.sender = GrblSender(self.REMOTE_RX_BUFFER_MAX_SIZE, self.gcr)
+        self.sender.get_macro_data = lambda: (self.get_workspace_parameters(), self.control_controller.prb_val)
+        self.sender.get_freeze_dro = self.get_freeze_dro
+        self.streamer = self.sender.streamer
 
         self.send_soft_reset = True
 
+        self.rx_handlers_od = Od((("status", self.on_rx_status), ("message", self.on_rx_message),
+                                  ("ok", self.on_rx_ok), ("error", self.on_rx_error)))
+        # UI updates collected while the received lines are processed
+        self.console_text_l = []
+        self.progress_updated = False
+        # echo of the streamed lines and of their acks on the console
+        self.job_echo = True
+
     @Slot(bool)
     def on_controller_connection(self, connected):
         if connected:
-            self.buffered_size = 0
+            self.streamer.reset()
+            self.streamer.reset_status()
             self.poll_timer.start()
         else:
             self.poll_timer.stop()
@@ -128,12 +139,26 @@ class ControllerWorker(QObject):
     @Slot(str, Od, str)
     def generate_new_path(self, tag, cfg, machining_type):
         new_paths = self.view_controller.generate_new_path(tag, cfg, machining_type)
-        self.view_controller.generate_new_gcode_file(tag, cfg, machining_type, new_paths)
+        self.control_controller.release_gcode_files(keep=(self.streaming_gcode_path,))
+        try:
+            gcode_path, program = self.view_controller.generate_new_gcode_file(tag, cfg, machining_type, new_paths)
+            if program is not None:
+                # hand over the program, no need to parse the file when it is opened
+                self.control_controller.add_program(os.path.normpath(gcode_path), program)
+            if self.settings.jobs_settings.jobs_settings_od["common"].get("batch_tools", False):
+                for batch_path, batch_program in self.view_controller.generate_batch_gcode_files():
+                    if batch_program is not None:
+                        self.control_controller.add_program(os.path.normpath(batch_path), batch_program)
+        except OSError as e:
+            # e.g. the file is in use
+            logger.error(e, exc_info=True)
+            self.add_console_text("GCode file not written: " + str(e))
+            self.flush_ui_updates()
         self.update_path_s.emit(tag, new_paths)
 
     # ***************** CONTROL related functions. ***************** #
     def check_eof_and_idle(self):
-        if self.eof_wait_for_idle and self.cmds_to_ack == 0:
+        if self.eof_wait_for_idle and self.streamer.get_pending() == 0:
             sta = self.control_controller.status_report_od["state"].lower()
             if "idle" in sta:
                 self.stop_send_s.emit()
@@ -145,11 +170,15 @@ class ControllerWorker(QObject):
     def send_to_tx_queue(self, data):
         parsed_cmd_str = self.decode_tag(data)
         # logger.info(data)
+        if isinstance(parsed_cmd_str, str):
+            # encoded once here, the serial thread writes the bytes as they are
+            parsed_cmd_str = parsed_cmd_str.encode("utf-8")
         self.serialTxQueue.put(parsed_cmd_str)
         self.serial_tx_available_s.emit()
 
     def on_poll_timeout(self):
         status_poll = b"?"
+        self.streamer.on_poll()
         if not self.dro_status_updated:
             self.serial_send_s.emit(status_poll)
             # self.send_to_tx_queue(status_poll)
@@ -159,143 +188,159 @@ class ControllerWorker(QObject):
 
     @Slot()
     def parse_rx_queue(self):
-        if not self.serialRxQueue.empty():
+        """ Process all the received lines, then update the UI once. """
+        status_element = None
+        while True:
             try:
                 element = self.serialRxQueue.get(block=False)
-                if element:
-                    # logger.debug("Element received: " + str(element))
-                    if re.match("^<.*>\s*$\s", element):
-                        self.update_status_s.emit(self.control_controller.parse_bracket_angle(element))
-                        # This variable should be set to true the first time an ack is received.
-                        if not self.dro_status_updated:
-                            self.dro_status_updated = True
-                        self.check_eof_and_idle()
-                    elif re.match("^\[.*\]\s*$\s", element):
-                        self.control_controller.parse_bracket_square(element)
-                        [ack_prb_flag, ack_abl_flag, send_next, other_cmd_flag] = \
-                            self.control_controller.process_probe_and_abl()
-                        if ack_prb_flag:
-                            self.ack_probe()
-                        if ack_abl_flag:
-                            self.ack_auto_bed_levelling()
-                        if send_next:
-                            self.send_next_abl()
-                        if other_cmd_flag:
-                            if element:
-                                self.update_console_text_s.emit(element)
-                                logger.debug(element)
-                    elif re.match("ok\s*$\s", element):
-                        logger.debug("buffered size: " + str(self.buffered_size))
-                        self.update_console_text_s.emit(element)
-                        if self.sending_file and self.cmds_to_ack > 0:
-                            # Update progress #
-                            self.cmds_to_ack -= 1
-                            self.ack_lines += 1
-                            self.buffered_size -= len(self.buffered_cmds[0])
-                            self.buffered_cmds.pop(0)
-                            self.file_progress = (self.content_line / self.tot_lines) * 100
-                            logger.debug("Acknowledged lines: " + str(self.ack_lines))
-                            self.update_file_progress_s.emit(self.file_progress)
-
-                            # all lines have been sent?
-
-                            # print("End Of File: " + str(end_of_file))
-
-                            if self.macro_on:
-                                probe_data = self.control_controller.prb_val
-                                wsp = self.get_workspace_parameters()
-                                cmd_to_send = self.macro_obj.get_next_line(wsp, probe_data)
-                                # print(cmd_to_send)
-                                if cmd_to_send is None:
-                                    self.macro_on = False
-                                    self.macro_obj = None
-                                    self.wait_tag_decoding = False
-                                    self.tot_lines -= 1
-                                else:
-                                    # self.tot_lines += 1
-                                    buff_available = (self.buffered_size + len(
-                                        cmd_to_send)) < self.REMOTE_RX_BUFFER_MAX_SIZE
-
-                            end_of_file = self.content_line >= self.tot_lines
-
-                            if not end_of_file:
-                                if not self.macro_on:
-                                    cmd_to_send = self.file_content[self.content_line]
-                                    cmd_to_send = self.macro_check(cmd_to_send)
-                                    self.content_line += 1
-
-                                logger.debug(str(self.ack_lines) + " <-> " + str(self.sent_lines))
-                                # does data fit the buffer?
-                                buff_available = (self.buffered_size + len(cmd_to_send)) < self.REMOTE_RX_BUFFER_MAX_SIZE
-                            else:
-                                self.wait_tag_decoding = False
-                                buff_available = False
-
-                            logger.debug("wait: " + str(self.wait_tag_decoding))
-
-                            if not end_of_file and buff_available and not self.wait_tag_decoding:
-                                # cmd_to_send = self.file_content[self.sent_lines]
-                                self.send_to_tx_queue(cmd_to_send)
-                                self.buffered_cmds.append(cmd_to_send)
-                                logger.debug("TX:" + cmd_to_send)
-                                self.update_console_text_s.emit(cmd_to_send)
-                                self.buffered_size += len(cmd_to_send)
-                                self.sent_lines += 1
-                                self.cmds_to_ack += 1
-
-                            # if self.ack_lines == self.tot_lines:
-                            if end_of_file:
-                                self.eof_wait_for_idle = True
-                                self.sending_file = False
-
-                                self.file_progress = (self.content_line / self.tot_lines) * 100
-                                self.update_file_progress_s.emit(self.file_progress)
-
-                                logger.info("End of File sending.")
-
-                    elif "error" in element.lower():
-                        self.update_console_text_s.emit(element)
-                        logger.error(element)
-                        logger.debug(self.buffered_size)
-                        logger.debug(self.sent_lines)
-                        logger.debug(self.ack_lines)
-                    else:
-                        self.update_console_text_s.emit(element)
-                        logger.debug(element)
+            except queue.Empty:
+                break
+            if not element:
+                continue
+            try:
+                kind = self.sender.get_kind(element)
+                if kind == "status":
+                    # only the last status report is relevant
+                    if status_element is not None:
+                        self.streamer.set_status()
+                    status_element = element
+                else:
+                    self.rx_handlers_od.get(kind, self.on_rx_other)(element)
             except BlockingIOError as e:
                 logger.error(e, exc_info=True)
             except Exception:
                 logger.error("Uncaught exception: %s", traceback.format_exc())
-
-    def macro_check(self, cmd_to_send):
-        # probe_data = self.control_controller.prb_val
-        # wsp = self.get_workspace_parameters()
-        ret_cmd_to_send = cmd_to_send
-
-        if self.gcr.is_macro(cmd_to_send):
-            macro_type = cmd_to_send.strip()
-            if self.ack_lines != self.sent_lines:
-                # wait that the machine execute all previous lines
-                # to be able to decode the tag
-                # print("Wait")
-                self.wait_tag_decoding = True
-            else:
-                # machine execution queue is empty, let's go
-                # print("Run")
-
-                # DUMMY ELEMENT FREEZE WPO and MPO
-                freeze_dro = {
-                    "WPO": self.control_controller.wpos_a.copy(),
-                    "MPO": self.control_controller.mpos_a.copy()
-                }
-
-                self.wait_tag_decoding = False
-                self.macro_obj = GCodeMacro(freeze_dro, macro_type, self.gcr)
-                ret_cmd_to_send = "$#\n"
-                # ret_cmd_to_send = self.macro_obj.get_next_line(probe_data, wsp)
-                self.tot_lines += 1
-                self.macro_on = True
-        return ret_cmd_to_send
+        try:
+            if status_element is not None:
+                self.on_rx_status(status_element)
+            self.flush_ui_updates()
+        except Exception:
+            logger.error("Uncaught exception: %s", traceback.format_exc())
+
+    def on_rx_status(self, element):
+        self.update_status_s.emit(self.control_controller.parse_bracket_angle(element))
+        if "Bf:" in element:
+            status_od = self.control_controller.status_report_od
+            self.streamer.set_status(status_od.get("planner"), status_od.get("rxbytes"))
+            if self.sending_file:
+                self.stream_lines()
+        else:
+            self.streamer.set_status()
+        # This variable should be set to true the first time an ack is received.
+        if not self.dro_status_updated:
+            self.dro_status_updated = True
+        self.check_eof_and_idle()
+
+    def on_rx_message(self, element):
+        self.control_controller.parse_bracket_square(element)
+        [ack_prb_flag, ack_abl_flag, send_next, other_cmd_flag] = \
+            self.control_controller.process_probe_and_abl()
+        if ack_prb_flag:
+            self.ack_probe()
+        if ack_abl_flag:
+            self.ack_auto_bed_levelling()
+        if send_next:
+            self.send_next_abl()
+        if other_cmd_flag:
+            self.add_console_text(element)
+            logger.debug(element)
+            if element.startswith("[OPT:"):
+                self.update_stream_buffers()
+
+    def on_rx_ok(self, element):
+        command = self.sender.commands_pending > 0
+        if self.sender.ack():
+            if self.job_echo or command:
+                self.add_console_text(element)
+            self.ack_stream_line()
+        else:
+            self.add_console_text(element)
+
+    def on_rx_error(self, element):
+        self.add_console_text(element)
+        logger.error(element)
+        logger.debug(self.streamer.buffered_size)
+        logger.debug(self.streamer.sent_lines)
+        logger.debug(self.streamer.ack_lines)
+        # the line in error has left the buffer too
+        if self.sender.ack(error=True):
+            self.ack_stream_line()
+
+    def on_rx_other(self, element):
+        self.add_console_text(element)
+        if not self.control_controller.parse_grbl_setting(element):
+            logger.debug(element)
+            if element.startswith("Grbl ") and not self.sending_file:
+                # welcome message after a reset: the requests before it are lost,
+                # ask for the build options to know the buffer sizes
+                self.streamer.reset_status()
+                self.sender.drop()
+                self.send_command_line("$I\n")
+
+    def update_stream_buffers(self):
+        build_info = self.control_controller.build_info_od
+        if "rx_buffer_size" in build_info.keys():
+            self.streamer.set_buffer_sizes(build_info["rx_buffer_size"], build_info.get("planner_size"))
+            logger.info("GRBL buffers: RX " + str(build_info["rx_buffer_size"]) + " bytes, planner " +
+                        str(build_info.get("planner_size")) + " blocks")
+
+    def add_console_text(self, text):
+        self.console_text_l.append(text)
+
+    def flush_ui_updates(self):
+        if self.console_text_l:
+            self.update_console_text_s.emit("".join(t if t.endswith("\n") else t + "\n" for t in self.console_text_l))
+            self.console_text_l = []
+        if self.progress_updated:
+            self.update_file_progress_s.emit(self.file_progress)
+            # 0 when the job has no runtime estimate
+            eta = self.sender.get_eta() or (0.0, 0.0)
+            self.update_file_eta_s.emit(*eta)
+            self.progress_updated = False
+
+    def ack_stream_line(self):
+        logger.debug("Acknowledged lines: " + str(self.streamer.ack_lines))
+        if self.sending_file:
+            self.file_progress = self.get_file_progress()
+            self.progress_updated = True
+            self.stream_lines()
+
+    def stream_lines(self):
+        # all the lines fitting the controller buffer are sent with a single write
+        try:
+            lines = self.sender.fill()
+        except OSError as e:
+            # the file can't be read anymore (changed or removed), the job can't go on
+            logger.error(e, exc_info=True)
+            self.add_console_text("Streaming stopped: " + str(e))
+            self.stop_gcode_file()
+            return
+        if lines:
+            self.send_to_tx_queue("".join(lines))
+            if self.job_echo:
+                self.add_console_text("".join(lines))
+
+        if self.sender.is_end_of_file():
+            self.eof_wait_for_idle = True
+            self.sending_file = False
+            self.streaming_gcode_path = ""
+
+            self.file_progress = self.get_file_progress()
+            self.progress_updated = True
+
+            logger.info("End of File sending.")
+            if self.streamer.starved_reports:
+                logger.info("Planner empty in " + str(self.streamer.starved_reports) + " status reports")
+
+    def get_file_progress(self):
+        return self.sender.get_progress()
+
+    def get_freeze_dro(self):
+        # DUMMY ELEMENT FREEZE WPO and MPO
+        return {
+            "WPO": self.control_controller.wpos_a.copy(),
+            "MPO": self.control_controller.mpos_a.copy()
+        }
 
     def decode_tag(self, gcode_str):
         # status = self.control_controller.status
@@ -321,6 +366,14 @@ class ControllerWorker(QObject):
             self.send_soft_reset = False
             self.send_gcode_lines(str_l)
 
+    def send_command_line(self, line):
+        # sent through the streamer, a job started before its ok does not take it for its own
+        self.sender.send_command(line)
+        lines = self.sender.fill()
+        if lines:
+            logger.info("Sent GCODE: " + "".join(lines).strip())
+            self.send_to_tx_queue("".join(lines))
+
     def execute_gcode_cmd(self, cmd_str):
         """ Send generic G-CODE command coming from elsewhere. """
         logger.debug("Execute Gcode")
@@ -338,39 +391,102 @@ class ControllerWorker(QObject):
         self.update_probe_s.emit(prb_val)
 
     def cmd_auto_bed_levelling(self, bbox_t, steps_t):
-        probe_feed_rate = self.settings.machine_settings.feedrate_probe
-        self.control_controller.cmd_auto_bed_levelling(bbox_t, steps_t, probe_feed_rate)
-        self.send_next_abl()  # Send first probe command.
+        machine_sets = self.settings.machine_settings
+        self.control_controller.cmd_auto_bed_levelling(bbox_t, steps_t, machine_sets.feedrate_probe,
+                                                       machine_sets.abl_probe_mode, machine_sets.abl_probe_tolerance)
+        self.send_next_abl()  # Stream the first probe commands.
 
     def send_next_abl(self):
-        next_abl_cmd = self.control_controller.get_next_abl_cmd()
-        logger.info(next_abl_cmd)
-        self.serial_send_s.emit(next_abl_cmd)  # Execute next Probe of Auto-Bed-Levelling
+        # the probe commands are streamed through the buffer like a file
+        lines = self.control_controller.get_pending_abl_lines()
+        logger.info("ABL lines: " + str(len(lines)))
+        if not lines:
+            return
+        if self.sending_file or self.streamer.get_pending() > 0:
+            # still streaming the previous points, the new ones are queued after them
+            self.sender.extend(lines)
+            self.sending_file = True
+            self.eof_wait_for_idle = False
+            self.stream_lines()
+        else:
+            self.send_soft_reset = False
+            self.send_gcode_lines(lines)
 
     def ack_auto_bed_levelling(self):
         abl_val = self.control_controller.get_abl_value()
         logger.debug("ABL values: " + str(abl_val))
+        # the height map is kept, to be used again on the same fixture
+        height_map = self.control_controller.get_height_map()
+        if height_map is not None:
+            hm_path = os.path.join(self.settings.gcf_settings.gcode_folder,
+                                   height_map.get_file_name(self.active_gcode_path))
+            if self.control_controller.save_height_map(hm_path):
+                logger.info("Height map saved: " + hm_path)
+                self.add_console_text("Height map saved: " + hm_path)
+                self.flush_ui_updates()
         # self.update_abl_s.emit(abl_val)
         self.select_active_gcode(self.active_gcode_path)
 
+    @Slot(str)
+    def load_height_map(self, hm_path):
+        if self.control_controller.load_height_map(hm_path) is None:
+            self.add_console_text("Invalid height map: " + hm_path)
+        elif self.active_gcode_path:
+            self.select_active_gcode(self.active_gcode_path)
+        self.flush_ui_updates()
+
+    @Slot(str, str)
+    def set_abl_interp(self, gcode_path, kind):
+        # an empty kind goes back to the interpolation of the machine settings
+        self.control_controller.set_abl_interp(gcode_path, kind or None)
+        if gcode_path == self.active_gcode_path:
+            self.select_active_gcode(gcode_path)
+
     def set_abl_active(self, abl_active=True):
         self.abl_apply_active = abl_active
         self.select_active_gcode(self.active_gcode_path)
 
     def vectorize_new_gcode_file(self, gcode_path):
-        self.control_controller.load_gcode_file({}, gcode_path)
-        self.gcode_vectorized_s.emit(gcode_path)
+        cfg = {'compact': self.settings.gcf_settings.compact_gcode}
+        future = self.control_controller.submit_gcode_file(cfg, gcode_path)
+        if future is None:
+            # unchanged file already parsed
+            self.gcode_vectorized_s.emit(gcode_path)
+        else:
+            # the files are parsed concurrently, the result is collected in this thread
+            future.add_done_callback(lambda f, p=gcode_path: self.gcode_parsed_s.emit(p))
+
+    @Slot(str)
+    def collect_gcode_file(self, gcode_path):
+        loaded = self.control_controller.collect_gcode_file(gcode_path)
+        if loaded:
+            self.gcode_vectorized_s.emit(gcode_path)
+        elif loaded is not None:
+            self.add_console_text("GCode file not loaded: " + gcode_path)
+            self.flush_ui_updates()
+            self.gcode_failed_s.emit(gcode_path)
 
     def select_active_gcode(self, gcode_path):
         self.active_gcode_path = gcode_path
         redraw = False
         visible = True
-        abl_val = self.control_controller.get_abl_value()
-        logger.debug("ABL_val " + str(abl_val))
+        height_map = self.control_controller.get_height_map()
+        logger.debug("ABL_map " + str(height_map.get_info() if height_map is not None else None))
         logger.debug("ABL_active " + str(self.abl_apply_active))
-        if abl_val != [] and self.abl_apply_active:
+        if height_map is not None and self.abl_apply_active and \
+                not height_map.is_valid_for(self.control_controller.wco_a):
+            # probed with another work origin, it does not fit the stock anymore
+            msg = "Height map not applied: work offset " + str(self.control_controller.wco_a.tolist()) + \
+                  ", probed with " + str(list(height_map.wco))
+            logger.warning(msg)
+            self.add_console_text(msg)
+            self.flush_ui_updates()
+            redraw = self.control_controller.remove_abl(gcode_path)
+        elif height_map is not None and self.abl_apply_active:
             logger.debug("Apply ABL")
-            self.control_controller.apply_abl(gcode_path)
+            machine_sets = self.settings.machine_settings
+            kind = self.control_controller.get_abl_interp(gcode_path, machine_sets.abl_interp)
+            self.control_controller.apply_abl(gcode_path, kind, machine_sets.abl_subdiv, machine_sets.abl_tolerance)
             redraw = True
         else:
             logger.debug("Remove ABL")
@@ -390,59 +506,43 @@ class ControllerWorker(QObject):
     def send_gcode_file(self, gcode_path):
         lines = self.control_controller.get_gcode_lines(gcode_path)
         logger.info("Sending file: " + str(gcode_path))
-        self.send_gcode_lines(lines)
-
-    def send_gcode_lines(self, lines):
-        self.file_content = lines
-        # with open(gcode_path+".abl", "w") as f:
-        #     f.writelines(self.file_content)
-        # with open(gcode_path) as f:            # DEBUG: take directly from file
-        #     self.file_content = f.readlines()
-        logger.debug(self.file_content)
-        if self.file_content:
+        try:
+            runtime = self.control_controller.get_gcode_runtime(gcode_path)
+            logger.info("Estimated time: {:.1f} min".format(runtime.total_time / 60))
+            self.add_console_text("Estimated time: {:.1f} min".format(runtime.total_time / 60))
+        except Exception:
+            logger.error("Uncaught exception: %s", traceback.format_exc())
+            runtime = None
+        self.streaming_gcode_path = gcode_path
+        self.send_gcode_lines(lines, runtime)
+
+    def send_gcode_lines(self, lines, runtime=None):
+        # lines can be a list or a GCodeStream, generating the lines while they are sent
+        if len(lines) > 0:
             self.file_progress = 0.0
-            self.cmds_to_ack = 0
-            self.sent_lines = 0
-            self.content_line = 0
-            self.ack_lines = 0
-            self.tot_lines = len(self.file_content)
-            self.macro_on = False
-            self.macro_obj = None
+            self.sender.start(lines, runtime)
+            self.streamer.set_mode(self.settings.machine_settings.stream_mode)
+            self.job_echo = self.settings.app_settings.console_job_echo
             self.eof_wait_for_idle = False
-            self.wait_tag_decoding = False
-            logger.info("Total lines: " + str(self.tot_lines))
-
-            if self.sent_lines < self.tot_lines and \
-                    (self.buffered_size + len(self.file_content[self.content_line])) < self.REMOTE_RX_BUFFER_MAX_SIZE:
-                cmd_to_send = self.file_content[self.content_line]
-                cmd_to_send = self.macro_check(cmd_to_send)
-                self.send_to_tx_queue(cmd_to_send)
-                self.buffered_cmds.append(cmd_to_send)
-                self.update_console_text_s.emit(cmd_to_send)
-                logger.debug(cmd_to_send)
-                self.buffered_size += len(cmd_to_send)
-                self.sent_lines += 1
-                self.content_line += 1
-                self.cmds_to_ack += 1
-
-            logger.debug("Buffered size: " + str(self.buffered_size))
+            logger.info("Total lines: " + str(self.sender.tot_lines))
+
             self.sending_file = True
+            self.stream_lines()
+            self.flush_ui_updates()
+            logger.debug("Buffered size: " + str(self.streamer.buffered_size))
 
     def stop_gcode_file(self):
         self.sending_file = False
+        self.streaming_gcode_path = ""
         if self.send_soft_reset:
             # send soft reset
             self.execute_gcode_cmd(b"!")
             self.execute_gcode_cmd(b'\030')
         self.send_soft_reset = True
         self.file_progress = 0.0
-        self.cmds_to_ack = 0
-        self.sent_lines = 0
-        self.ack_lines = 0
-        self.tot_lines = 0
-        self.buffered_cmds = []
-        self.buffered_size = 0
-        self.wait_tag_decoding = False
+        self.sender.stop()
+        self.progress_updated = True
+        self.flush_ui_updates()
 
     def pause_resume(self):
         logger.info("Status: " + str(self.control_controller.status))
@@ -496,32 +596,4 @@ class ControllerWorker(QObject):
 
     @Slot()
     def update_gerber_cfg(self):
-        machine_sets = self.settings.machine_settings
-        probe_working = machine_sets.tool_probe_rel_flag
-        if probe_working:
-            probe_pos = (
-                machine_sets.tool_probe_offset_x_wpos,
-                machine_sets.tool_probe_offset_y_wpos,
-                machine_sets.tool_probe_offset_z_wpos,
-            )
-        else:
-            probe_pos = (
-                machine_sets.tool_probe_offset_x_mpos,
-                machine_sets.tool_probe_offset_y_mpos,
-                machine_sets.tool_probe_offset_z_mpos,
-            )
-        change_pos = (
-            machine_sets.tool_change_offset_x_mpos,
-            machine_sets.tool_change_offset_y_mpos,
-            machine_sets.tool_change_offset_z_mpos,
-        )
-        cfg = Od({
-            'tool_probe_pos': probe_pos,
-            'tool_probe_working': probe_working,  # False: machine pos or True: working pos
-            'tool_probe_min': machine_sets.tool_probe_z_limit,
-            'tool_change_pos': change_pos,
-            'tool_probe_feedrate': (machine_sets.feedrate_xy, machine_sets.feedrate_z, machine_sets.feedrate_probe),
-            'tool_probe_hold': machine_sets.hold_on_probe_flag,
-            'tool_probe_zero': machine_sets.zeroing_after_probe_flag,
-        })
-        self.gcr.load_cfg(cfg)
+        self.gcr.load_cfg(self.settings.machine_settings.get_macro_cfg())
@@ -2,6 +2,7 @@ from PySide2.QtCore import QObject
 from shape_core.pcb_manager import PcbObj
 from shape_core.path_manager import MachinePath
 from shape_core.gcode_manager import GCoder
+from shape_core.job_planner import JobPlanner
 import os
 import logging
 import traceback
@@ -14,6 +15,13 @@ class ViewController(QObject):
         super(ViewController, self).__init__()
         self.pcb = PcbObj()
         self.settings = settings
+        self.jobs_od = {}
+        # revision of each job, the batch programs are generated again only when they change
+        self.jobs_rev = 0
+        self.jobs_rev_od = {}
+        self.batch_od = {}
+        # folder of the loaded layers, a layer from another folder is another board
+        self.board_dir = None
 
     def load_new_layer(self, layer, layer_path):
         try:
@@ -22,10 +30,12 @@ class ViewController(QObject):
             if layer in grb_tags:
                 self.pcb.load_gerber(layer_path, layer)
                 loaded_layer = self.pcb.get_gerber_layer(layer)
+                self.update_board(layer, layer_path)
                 return [loaded_layer, False]
             if layer in exc_tags:
                 self.pcb.load_excellon(layer_path, layer)
                 loaded_layer = self.pcb.get_excellon_layer(layer)
+                self.update_board(layer, layer_path)
                 return [loaded_layer, True]
         except (AttributeError, ValueError, ZeroDivisionError, IndexError) as e:
             logging.error(e, exc_info=True)
@@ -33,6 +43,18 @@ class ViewController(QObject):
             logger.error("Uncaught exception: %s", traceback.format_exc())
         return [None, None]
 
+    def update_board(self, layer, layer_path):
+        board_dir = os.path.dirname(os.path.abspath(layer_path))
+        if board_dir != self.board_dir:
+            # new board, the jobs of the previous one are not merged with its ones
+            self.board_dir = board_dir
+            self.jobs_od.clear()
+            self.jobs_rev_od.clear()
+        else:
+            # the job of the replaced layer is no longer valid
+            self.jobs_od.pop(layer, None)
+            self.jobs_rev_od.pop(layer, None)
+
     def generate_new_path(self, tag, cfg, machining_type):
         if machining_type == "gerber" or machining_type == "profile":
             machining_layer = self.pcb.get_gerber_layer(tag)
@@ -48,17 +70,48 @@ class ViewController(QObject):
         return new_paths
 
     def generate_new_gcode_file(self, tag, cfg, machining_type, path):
+        compact = self.settings.gcf_settings.compact_gcode
         if 'mirroring_axis' in self.settings.jobs_settings.jobs_settings_od["common"].keys():
             mt = self.settings.jobs_settings.jobs_settings_od["common"]['mirroring_axis']
             logger.debug("Mirror Axis: " + str(mt))
-            gcoder = GCoder(tag, machining_type, mirror_type=mt)
+            gcoder = GCoder(tag, machining_type, mirror_type=mt, compact=compact)
         else:
-            gcoder = GCoder(tag, machining_type)
+            gcoder = GCoder(tag, machining_type, compact=compact)
         gcoder.load_cfg(cfg)
         gcoder.load_path(path)
         if gcoder.compute():
+            self.jobs_od[tag] = (machining_type, cfg, path)
+            self.jobs_rev += 1
+            self.jobs_rev_od[tag] = self.jobs_rev
             gcode_filename = gcoder.get_file_name()
             gcode_path = os.path.join(self.settings.gcf_settings.gcode_folder, gcode_filename)
-            gcoder.write(gcode_path)
+            program = gcoder.write_program(gcode_path)
+            return gcode_path, program
         else:
             logging.error("Gcode generation failed.")
+        return None, None
+
+    def generate_batch_gcode_files(self):
+        """ Merge all the generated jobs, one program per board setup, grouping the operations per tool. """
+        common_settings = self.settings.jobs_settings.jobs_settings_od["common"]
+        planner = JobPlanner(mirror_type=common_settings.get('mirroring_axis', 'x'),
+                             compact=self.settings.gcf_settings.compact_gcode)
+        for tag in self.jobs_od.keys():
+            planner.add_job(tag, *self.jobs_od[tag])
+        batch_l = []
+        for setup in planner.SETUPS:
+            # the plan changes only when one of its jobs or the output options change
+            key = (planner.mirror_type, planner.compact, self.settings.gcf_settings.gcode_folder) + \
+                tuple((tag, self.jobs_rev_od[tag]) for tag in planner.get_setup_jobs(setup))
+            if setup in self.batch_od.keys():
+                last_key, last_path = self.batch_od[setup]
+                if last_key == key and os.path.isfile(last_path):
+                    continue
+            # the tool in the spindle is unknown: the programs start with a tool change
+            gcoder = planner.compute(setup)
+            if gcoder is not None:
+                gcode_path = os.path.join(self.settings.gcf_settings.gcode_folder, gcoder.get_file_name())
+                program = gcoder.write_program(gcode_path)
+                batch_l.append((gcode_path, program))
+                self.batch_od[setup] = (key, gcode_path)
+        return batch_l
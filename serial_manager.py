@@ -1,5 +1,6 @@
 from PySide2.QtSerialPort import QSerialPort, QSerialPortInfo
 from PySide2.QtCore import QIODevice, Signal, Slot, QObject
+import queue
 import logging
 import traceback
 
@@ -19,11 +20,15 @@ class SerialWorker(QObject):
         self.serial_port = QSerialPort(self)
         self.serial_port.readyRead.connect(self.receive)
         self.serial_port.errorOccurred.connect(self.serial_error_manager)
+        self.serial_port.bytesWritten.connect(self.on_bytes_written)
         self.refresh_port_list_s.connect(self.get_port_list)
 
         self.serialRxQueue = serial_rx_queue  # FIFO RX Queue to pass data to control thread
         self.serialTxQueue = serial_tx_queue  # FIFO TX Queue to get data from control thread
-        self.residual_string = ""
+        # received bytes, the incomplete last line is kept for the next read
+        self.rx_buffer = bytearray()
+        # bytes taken from the TX queue, waiting to be written to the port
+        self.tx_buffer = bytearray()
 
         self.count_queue_sent = 0
         self.count_sent = 0
@@ -63,42 +68,44 @@ class SerialWorker(QObject):
         logger.debug("Closing " + self.serial_port.portName())
         self.update_console_text_s.emit("Closing " + self.serial_port.portName())
         self.serial_port.close()
+        self.rx_buffer.clear()
+        self.tx_buffer.clear()
+
+    @staticmethod
+    def to_bytes(data):
+        if isinstance(data, (bytes, bytearray)):
+            return data
+        elif isinstance(data, int):
+            return b""  # do nothing, this should not happen
+        return data.encode("utf-8")
 
     @Slot()
     def receive(self):
-        if self.serial_port.canReadLine():
-            data_out = self.serial_port.readAll().data().decode()
-            if data_out:
-                # logger.debug("data in: " + data_out)
-                self.residual_string = self.residual_string + data_out
-                # logger.debug("Residual string: " + self.residual_string)
-                res_split = self.residual_string.splitlines(True)
-                self.residual_string = ""
-                while res_split:
-                    element = res_split.pop(0)
-                    if '\n' in element:
-                        self.serialRxQueue.put(element)
-                        # logger.debug("RXelem: " + element)
-                        self.rx_queue_not_empty_s.emit()
-                    else:
-                        self.residual_string = element
-                # logger.debug("Final residual string: " + self.residual_string)
+        self.rx_buffer += self.serial_port.readAll().data()
+        start = 0
+        end = self.rx_buffer.find(b"\n")
+        if end < 0:
+            return
+        with memoryview(self.rx_buffer) as mv:
+            while end >= 0:
+                self.serialRxQueue.put(str(mv[start:end + 1], "utf-8", "replace"))
+                start = end + 1
+                end = self.rx_buffer.find(b"\n", start)
+        del self.rx_buffer[:start]
+        # the control thread takes all the lines in the queue at once
+        self.rx_queue_not_empty_s.emit()
 
     @Slot(bytes)
     def send(self, data):
+        # real time commands, written ahead of the queued lines
         if self.serial_port.isOpen():
             try:
                 # logger.debug("data sent: " + str(data))
                 self.count_sent += 1
                 # logger.debug("Sent count: " + str(self.count_sent))
-                if isinstance(data, bytes):
+                data = self.to_bytes(data)
+                if data:
                     self.serial_port.write(data)
-                    self.serial_port.waitForBytesWritten(msecs=200)
-                elif isinstance(data, int):
-                    pass  # do nothing, this should not happen
-                else:
-                    self.serial_port.write(data.encode())
-                    self.serial_port.waitForBytesWritten(msecs=200)
             except AttributeError as e:
                 logger.error(e, exc_info=True)
             except Exception:
@@ -106,30 +113,35 @@ class SerialWorker(QObject):
 
     @Slot()
     def send_from_queue(self):
+        """ Take all the queued data, the port writes it in the background. """
         if self.serial_port.isOpen():
             try:
-                if not self.serialTxQueue.empty():
-                    data = self.serialTxQueue.get()
-                    # logger.debug("data sent: " + str(data))
+                while True:
+                    try:
+                        data = self.serialTxQueue.get(block=False)
+                    except queue.Empty:
+                        break
                     self.count_queue_sent += 1
-                    logger.debug("Sent count: " + str(self.count_queue_sent))
-                    if isinstance(data, bytes):
-                        self.serial_port.write(data)
-                        self.serial_port.waitForBytesWritten(msecs=1000)
-                    elif isinstance(data, int):
-                        pass  # do nothing, this should not happen
-                        # self.serial_port.write(data)
-                    else:
-                        self.serial_port.write(data.encode("utf-8"))
-                        self.serial_port.waitForBytesWritten(msecs=1000)
-                    # if not self.serial_port.waitForBytesWritten(msecs=10):
-                    #     logger.debug("data not completely sent: " + str(data))
-                    self.serial_port.flush()
+                    self.tx_buffer += self.to_bytes(data)
+                logger.debug("Sent count: " + str(self.count_queue_sent))
+                self.write_tx_buffer()
             except AttributeError as e:
                 logger.error(e, exc_info=True)
             except Exception:
                 logger.error("Uncaught exception: %s", traceback.format_exc())
 
+    def write_tx_buffer(self):
+        if self.tx_buffer:
+            written = self.serial_port.write(bytes(self.tx_buffer))
+            if written > 0:
+                del self.tx_buffer[:written]
+
+    @Slot(int)
+    def on_bytes_written(self, _):
+        # the port is ready for more data
+        if self.tx_buffer and self.serial_port.isOpen():
+            self.write_tx_buffer()
+
     @Slot()
     def serial_error_manager(self):
         error_type = self.serial_port.error()
@@ -19,6 +19,8 @@ class AppSettingsHandler:
     SETTINGS_TAB_INDEX_DEFAULT = 0
     SHOW_SETTINGS_TAB_DEFAULT = False
     SHOW_CONSOLE_DEFAULT = False
+    CONSOLE_MAX_LINES_DEFAULT = 2000
+    CONSOLE_JOB_ECHO_DEFAULT = True
     LAST_SERIAL_PORT_DEFAULT = ""
     LAST_SERIAL_BAUD_DEFAULT = 115200
     LAYER_LAST_DIR_DEFAULT = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
@@ -50,6 +52,8 @@ class AppSettingsHandler:
         self.settings_tab_index = self.SETTINGS_TAB_INDEX_DEFAULT
         self.settings_tab_visibility = self.SHOW_SETTINGS_TAB_DEFAULT
         self.console_visibility = self.SHOW_CONSOLE_DEFAULT
+        self.console_max_lines = self.CONSOLE_MAX_LINES_DEFAULT
+        self.console_job_echo = self.CONSOLE_JOB_ECHO_DEFAULT
         self.last_serial_port = self.LAST_SERIAL_PORT_DEFAULT
         self.last_serial_baud = self.LAST_SERIAL_BAUD_DEFAULT
         self.layer_last_dir = self.LAYER_LAST_DIR_DEFAULT
@@ -84,6 +88,8 @@ class AppSettingsHandler:
             self.settings_tab_visibility = app_general.getboolean("settings_tab_visibility",
                                                                   self.SHOW_SETTINGS_TAB_DEFAULT)
             self.console_visibility = app_general.getboolean("console_visibility", self.SHOW_CONSOLE_DEFAULT)
+            self.console_max_lines = app_general.getint("console_max_lines", self.CONSOLE_MAX_LINES_DEFAULT)
+            self.console_job_echo = app_general.getboolean("console_job_echo", self.CONSOLE_JOB_ECHO_DEFAULT)
             self.logs_file = app_general.get('logs_file', self.LOGS_FILE_DEFAULT)
             self.logs_max_bytes = app_general.getint('logs_max_bytes', self.LOGS_MAX_BYTES)
             self.logs_backup_count = app_general.getint('logs_backup_count', self.LOGS_BACKUP_COUNT)
@@ -121,6 +127,8 @@ class AppSettingsHandler:
                                         "settings_tab_index": self.SETTINGS_TAB_INDEX_DEFAULT,
                                         "settings_tab_visibility": self.SHOW_SETTINGS_TAB_DEFAULT,
                                         "console_visibility": self.console_visibility,
+                                        "console_max_lines": self.CONSOLE_MAX_LINES_DEFAULT,
+                                        "console_job_echo": self.CONSOLE_JOB_ECHO_DEFAULT,
                                         "layer_last_dir": self.LAYER_LAST_DIR_DEFAULT,
                                         "top_layer_color": self.TOP_LAYER_COLOR_DEFAULT,
                                         "bottom_layer_color": self.BOTTOM_LAYER_COLOR_DEFAULT,
@@ -150,6 +158,8 @@ class AppSettingsHandler:
         app_general["settings_tab_index"] = str(self.main_win.ui.settings_sub_tab.currentIndex())
         app_general["settings_tab_visibility"] = str(self.main_win.ui.actionSettings_Preferences.isChecked())
         app_general["console_visibility"] = str(self.main_win.ui.actionHide_Show_Console.isChecked())
+        app_general["console_max_lines"] = str(self.console_max_lines)
+        app_general["console_job_echo"] = str(self.console_job_echo)
         app_general["logs_file"] = str(self.LOGS_FILE_DEFAULT)
         app_general["logs_max_bytes"] = str(self.LOGS_MAX_BYTES)
         app_general["logs_backup_count"] = str(self.LOGS_BACKUP_COUNT)
@@ -188,6 +198,8 @@ class AppSettingsHandler:
                                         "settings_tab_index": self.SETTINGS_TAB_INDEX_DEFAULT,
                                         "settings_tab_visibility": self.SHOW_SETTINGS_TAB_DEFAULT,
                                         "console_visibility": self.console_visibility,
+                                        "console_max_lines": self.CONSOLE_MAX_LINES_DEFAULT,
+                                        "console_job_echo": self.CONSOLE_JOB_ECHO_DEFAULT,
                                         "layer_last_dir": self.LAYER_LAST_DIR_DEFAULT,
                                         "top_layer_color": self.TOP_LAYER_COLOR_DEFAULT,
                                         "bottom_layer_color": self.BOTTOM_LAYER_COLOR_DEFAULT,
@@ -215,6 +227,8 @@ class AppSettingsHandler:
         app_general["settings_tab_index"] = str(self.SETTINGS_TAB_INDEX_DEFAULT)
         app_general["settings_tab_visibility"] = str(self.main_win.ui.actionSettings_Preferences.isChecked())
         app_general["console_visibility"] = str(self.SHOW_CONSOLE_DEFAULT)
+        app_general["console_max_lines"] = str(self.CONSOLE_MAX_LINES_DEFAULT)
+        app_general["console_job_echo"] = str(self.CONSOLE_JOB_ECHO_DEFAULT)
         app_general["logs_file"] = str(self.LOGS_FILE_DEFAULT)
         app_general["logs_max_bytes"] = str(self.LOGS_MAX_BYTES)
         app_general["logs_backup_count"] = str(self.LOGS_BACKUP_COUNT)
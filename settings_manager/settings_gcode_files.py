@@ -5,12 +5,14 @@ import os
 class GCodeFilesSettingsHandler:
     # G-Code Files CONFIGURATION DEFAULT VALUES
     GCODE_FOLDER_DEFAULT = os.path.normpath(os.path.join(os.path.dirname(__file__), '../gcode_temp_dir'))
+    COMPACT_GCODE_DEFAULT = False
 
     def __init__(self, config_folder):
         if not os.path.isdir(self.GCODE_FOLDER_DEFAULT):
             os.makedirs(self.GCODE_FOLDER_DEFAULT)
         self.gcf_config_path = os.path.normpath(os.path.join(config_folder, 'gcode_files_config.ini'))
         self.gcode_folder = self.GCODE_FOLDER_DEFAULT
+        self.compact_gcode = self.COMPACT_GCODE_DEFAULT
         self.gcf_settings = configparser.ConfigParser()
 
     def read_all_gcf_settings(self):
@@ -24,14 +26,17 @@ class GCodeFilesSettingsHandler:
 
         if "FILES" in self.gcf_settings:
             self.gcode_folder = self.gcf_settings["FILES"]["gcode_folder"]
+            self.compact_gcode = self.gcf_settings["FILES"].getboolean("compact_gcode", self.COMPACT_GCODE_DEFAULT)
 
     def write_all_gcf_settings(self):
         """ Write all g-code files' settings to ini files """
-        self.gcf_settings["DEFAULT"] = {"gcode_folder": self.GCODE_FOLDER_DEFAULT}
+        self.gcf_settings["DEFAULT"] = {"gcode_folder": self.GCODE_FOLDER_DEFAULT,
+                                        "compact_gcode": self.COMPACT_GCODE_DEFAULT}
 
         self.gcf_settings["FILES"] = {}
         files_settings = self.gcf_settings["FILES"]
         files_settings["gcode_folder"] = self.gcode_folder
+        files_settings["compact_gcode"] = str(self.compact_gcode)
 
         # Write application ini file #
         with open(self.gcf_config_path, 'w') as configfile:
@@ -39,11 +44,13 @@ class GCodeFilesSettingsHandler:
 
     def restore_all_gcf_settings(self):
         """ Restore all g-code files' settings to ini files """
-        self.gcf_settings["DEFAULT"] = {"gcode_folder": self.GCODE_FOLDER_DEFAULT}
+        self.gcf_settings["DEFAULT"] = {"gcode_folder": self.GCODE_FOLDER_DEFAULT,
+                                        "compact_gcode": self.COMPACT_GCODE_DEFAULT}
 
         self.gcf_settings["FILES"] = {}
         files_settings = self.gcf_settings["FILES"]
         files_settings["gcode_folder"] = self.GCODE_FOLDER_DEFAULT
+        files_settings["compact_gcode"] = str(self.COMPACT_GCODE_DEFAULT)
 
         # Write application ini file #
         with open(self.gcf_config_path, 'w') as configfile:
@@ -22,6 +22,7 @@ class JobSettingsHandler:
     MIRROR_ALL_DEFAULT = False
     MIRROR_BOTTOM_DEFAULT = True
     MIRROR_AXIS_DEFAULT = "x"
+    BATCH_TOOLS_DEFAULT = False
 
     def __init__(self, config_folder):
         self.jobs_config_path = os.path.normpath(os.path.join(config_folder, 'jobs_sets_config.ini'))
@@ -42,11 +43,13 @@ class JobSettingsHandler:
             common_settings = self.jobs_settings["COMMON"]
             common_set_od = ({})
             common_set_od["mirroring_axis"] = common_settings.get("mirroring_axis", self.MIRROR_AXIS_DEFAULT)
+            common_set_od["batch_tools"] = common_settings.getboolean("batch_tools", self.BATCH_TOOLS_DEFAULT)
             self.jobs_settings_od["common"] = common_set_od
         else:
             self.jobs_settings["COMMON"] = {}
             common_set_od = ({})
             common_set_od["mirroring_axis"] = self.MIRROR_AXIS_DEFAULT
+            common_set_od["batch_tools"] = self.BATCH_TOOLS_DEFAULT
             self.jobs_settings_od["common"] = common_set_od
 
         # Top job related settings #
@@ -165,13 +168,15 @@ class JobSettingsHandler:
                                          "taps_type": self.TAPS_TYPE_INDEX_DEFAULT,
                                          "taps_length": self.TAPS_LENGTH_DEFAULT,
                                          "mirror": self.MIRROR_ALL_DEFAULT,
-                                         "mirroring_axis": self.MIRROR_AXIS_DEFAULT}
+                                         "mirroring_axis": self.MIRROR_AXIS_DEFAULT,
+                                         "batch_tools": self.BATCH_TOOLS_DEFAULT}
 
         # Common jobs' settings.
         self.jobs_settings["COMMON"] = {}
         common_settings = self.jobs_settings["COMMON"]
         common_set_od = job_settings_od["common"]
         common_settings["mirroring_axis"] = str(common_set_od["mirroring_axis"])
+        common_settings["batch_tools"] = str(common_set_od.get("batch_tools", self.BATCH_TOOLS_DEFAULT))
 
         # Top job related settings #
         self.jobs_settings["TOP"] = {}
@@ -284,12 +289,14 @@ class JobSettingsHandler:
                                          "taps_type": self.TAPS_TYPE_INDEX_DEFAULT,
                                          "taps_length": self.TAPS_LENGTH_DEFAULT,
                                          "mirror": self.MIRROR_ALL_DEFAULT,
-                                         "mirroring_axis": self.MIRROR_AXIS_DEFAULT}
+                                         "mirroring_axis": self.MIRROR_AXIS_DEFAULT,
+                                         "batch_tools": self.BATCH_TOOLS_DEFAULT}
 
         # Common jobs' settings.
         self.jobs_settings["COMMON"] = {}
         common_settings = self.jobs_settings["COMMON"]
         common_settings["mirroring_axis"] = str(self.MIRROR_AXIS_DEFAULT)
+        common_settings["batch_tools"] = str(self.BATCH_TOOLS_DEFAULT)
 
         # Top job related settings #
         self.jobs_settings["TOP"] = {}
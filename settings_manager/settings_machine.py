@@ -1,5 +1,6 @@
 import configparser
 import os
+from collections import OrderedDict
 
 
 class MachineSettingsHandler:
@@ -15,6 +16,12 @@ class MachineSettingsHandler:
     FEEDRATE_XY_DEFAULT = 300.0
     FEEDRATE_Z_DEFAULT = 40.0
     FEEDRATE_PROBE_DEFAULT = 40.0
+    ABL_INTERP_DEFAULT = "cubic"
+    ABL_SUBDIV_DEFAULT = "grid"
+    ABL_TOLERANCE_DEFAULT = 0.005
+    ABL_PROBE_MODE_DEFAULT = "grid"
+    ABL_PROBE_TOLERANCE_DEFAULT = 0.02
+    STREAM_MODE_DEFAULT = "counting"
 
     TOOL_PROBE_OFFSET_MPOS_X_DEFAULT = 0.0
     TOOL_PROBE_OFFSET_MPOS_Y_DEFAULT = 0.0
@@ -48,6 +55,12 @@ class MachineSettingsHandler:
         self.feedrate_xy = self.FEEDRATE_XY_DEFAULT
         self.feedrate_z = self.FEEDRATE_Z_DEFAULT
         self.feedrate_probe = self.FEEDRATE_PROBE_DEFAULT
+        self.abl_interp = self.ABL_INTERP_DEFAULT
+        self.abl_subdiv = self.ABL_SUBDIV_DEFAULT
+        self.abl_tolerance = self.ABL_TOLERANCE_DEFAULT
+        self.abl_probe_mode = self.ABL_PROBE_MODE_DEFAULT
+        self.abl_probe_tolerance = self.ABL_PROBE_TOLERANCE_DEFAULT
+        self.stream_mode = self.STREAM_MODE_DEFAULT
 
         self.tool_probe_offset_x_mpos = self.TOOL_PROBE_OFFSET_MPOS_X_DEFAULT
         self.tool_probe_offset_y_mpos = self.TOOL_PROBE_OFFSET_MPOS_Y_DEFAULT
@@ -88,6 +101,13 @@ class MachineSettingsHandler:
             self.feedrate_xy = machine_general.getfloat("feedrate_xy", self.FEEDRATE_XY_DEFAULT)
             self.feedrate_z = machine_general.getfloat("feedrate_z", self.FEEDRATE_Z_DEFAULT)
             self.feedrate_probe = machine_general.getfloat("feedrate_probe", self.FEEDRATE_PROBE_DEFAULT)
+            self.abl_interp = machine_general.get("abl_interp", self.ABL_INTERP_DEFAULT)
+            self.abl_subdiv = machine_general.get("abl_subdiv", self.ABL_SUBDIV_DEFAULT)
+            self.abl_tolerance = machine_general.getfloat("abl_tolerance", self.ABL_TOLERANCE_DEFAULT)
+            self.abl_probe_mode = machine_general.get("abl_probe_mode", self.ABL_PROBE_MODE_DEFAULT)
+            self.abl_probe_tolerance = machine_general.getfloat("abl_probe_tolerance",
+                                                                self.ABL_PROBE_TOLERANCE_DEFAULT)
+            self.stream_mode = machine_general.get("stream_mode", self.STREAM_MODE_DEFAULT)
 
             self.tool_probe_rel_flag = machine_general.getboolean("tool_probe_relative_flag",
                                                                   self.TOOL_PROBE_REL_FLAG_DEFAULT)
@@ -117,6 +137,36 @@ class MachineSettingsHandler:
             self.zeroing_after_probe_flag = machine_general.getboolean("zeroing_after_probe_flag",
                                                                        self.ZEROING_AFTER_PROBE_FLAG_DEFAULT)
 
+    def get_macro_cfg(self):
+        """ Configuration of the tool change macro """
+        probe_working = self.tool_probe_rel_flag
+        if probe_working:
+            probe_pos = (
+                self.tool_probe_offset_x_wpos,
+                self.tool_probe_offset_y_wpos,
+                self.tool_probe_offset_z_wpos,
+            )
+        else:
+            probe_pos = (
+                self.tool_probe_offset_x_mpos,
+                self.tool_probe_offset_y_mpos,
+                self.tool_probe_offset_z_mpos,
+            )
+        change_pos = (
+            self.tool_change_offset_x_mpos,
+            self.tool_change_offset_y_mpos,
+            self.tool_change_offset_z_mpos,
+        )
+        return OrderedDict({
+            'tool_probe_pos': probe_pos,
+            'tool_probe_working': probe_working,  # False: machine pos or True: working pos
+            'tool_probe_min': self.tool_probe_z_limit,
+            'tool_change_pos': change_pos,
+            'tool_probe_feedrate': (self.feedrate_xy, self.feedrate_z, self.feedrate_probe),
+            'tool_probe_hold': self.hold_on_probe_flag,
+            'tool_probe_zero': self.zeroing_after_probe_flag,
+        })
+
     def write_all_machine_settings(self):
         """ Write all machine settings to ini files """
         self.machine_settings["DEFAULT"] = {"probe_z_min": self.PROBE_Z_MIN_DEFAULT,
@@ -130,6 +180,12 @@ class MachineSettingsHandler:
                                             "feedrate_xy": self.FEEDRATE_XY_DEFAULT,
                                             "feedrate_z": self.FEEDRATE_Z_DEFAULT,
                                             "feedrate_probe": self.FEEDRATE_PROBE_DEFAULT,
+                                            "abl_interp": self.ABL_INTERP_DEFAULT,
+                                            "abl_subdiv": self.ABL_SUBDIV_DEFAULT,
+                                            "abl_tolerance": self.ABL_TOLERANCE_DEFAULT,
+                                            "abl_probe_mode": self.ABL_PROBE_MODE_DEFAULT,
+                                            "abl_probe_tolerance": self.ABL_PROBE_TOLERANCE_DEFAULT,
+                                            "stream_mode": self.STREAM_MODE_DEFAULT,
                                             "tool_probe_relative_flag": self.TOOL_PROBE_REL_FLAG_DEFAULT,
                                             "hold_on_probe_flag": self.HOLD_ON_PROBE_FLAG_DEFAULT,
                                             "zeroing_after_probe_flag": self.ZEROING_AFTER_PROBE_FLAG_DEFAULT,
@@ -159,6 +215,12 @@ class MachineSettingsHandler:
         machine_general["feedrate_xy"] = str(self.feedrate_xy)
         machine_general["feedrate_z"] = str(self.feedrate_z)
         machine_general["feedrate_probe"] = str(self.feedrate_probe)
+        machine_general["abl_interp"] = str(self.abl_interp)
+        machine_general["abl_subdiv"] = str(self.abl_subdiv)
+        machine_general["abl_tolerance"] = str(self.abl_tolerance)
+        machine_general["abl_probe_mode"] = str(self.abl_probe_mode)
+        machine_general["abl_probe_tolerance"] = str(self.abl_probe_tolerance)
+        machine_general["stream_mode"] = str(self.stream_mode)
         machine_general["tool_probe_relative_flag"] = str(self.tool_probe_rel_flag)
         machine_general["hold_on_probe_flag"] = str(self.hold_on_probe_flag)
         machine_general["zeroing_after_probe_flag"] = str(self.zeroing_after_probe_flag)
@@ -190,6 +252,12 @@ class MachineSettingsHandler:
                                             "feedrate_xy": self.FEEDRATE_XY_DEFAULT,
                                             "feedrate_z": self.FEEDRATE_Z_DEFAULT,
                                             "feedrate_probe": self.FEEDRATE_PROBE_DEFAULT,
+                                            "abl_interp": self.ABL_INTERP_DEFAULT,
+                                            "abl_subdiv": self.ABL_SUBDIV_DEFAULT,
+                                            "abl_tolerance": self.ABL_TOLERANCE_DEFAULT,
+                                            "abl_probe_mode": self.ABL_PROBE_MODE_DEFAULT,
+                                            "abl_probe_tolerance": self.ABL_PROBE_TOLERANCE_DEFAULT,
+                                            "stream_mode": self.STREAM_MODE_DEFAULT,
                                             "tool_probe_relative_flag": self.TOOL_PROBE_REL_FLAG_DEFAULT,
                                             "hold_on_probe_flag": self.HOLD_ON_PROBE_FLAG_DEFAULT,
                                             "zeroing_after_probe_flag": self.ZEROING_AFTER_PROBE_FLAG_DEFAULT,
@@ -218,6 +286,12 @@ class MachineSettingsHandler:
         machine_general["feedrate_xy"] = str(self.FEEDRATE_XY_DEFAULT)
         machine_general["feedrate_z"] = str(self.FEEDRATE_Z_DEFAULT)
         machine_general["feedrate_probe"] = str(self.FEEDRATE_PROBE_DEFAULT)
+        machine_general["abl_interp"] = str(self.ABL_INTERP_DEFAULT)
+        machine_general["abl_subdiv"] = str(self.ABL_SUBDIV_DEFAULT)
+        machine_general["abl_tolerance"] = str(self.ABL_TOLERANCE_DEFAULT)
+        machine_general["abl_probe_mode"] = str(self.ABL_PROBE_MODE_DEFAULT)
+        machine_general["abl_probe_tolerance"] = str(self.ABL_PROBE_TOLERANCE_DEFAULT)
+        machine_general["stream_mode"] = str(self.STREAM_MODE_DEFAULT)
         machine_general["tool_probe_relative_flag"] = str(self.TOOL_PROBE_REL_FLAG_DEFAULT)
         machine_general["hold_on_probe_flag"] = str(self.HOLD_ON_PROBE_FLAG_DEFAULT)
         machine_general["zeroing_after_probe_flag"] = str(self.ZEROING_AFTER_PROBE_FLAG_DEFAULT)
@@ -1,12 +1,13 @@
 
 import os
 import re
+import mmap
+from types import MappingProxyType
 import time
 import numpy as np
 from collections import OrderedDict as od
 from datetime import datetime
 import scipy.interpolate as spi
-from shapely.geometry import LineString
 from .macros_manager import Macros
 from .commands_manager import CommandManager
 
@@ -23,13 +24,23 @@ class GCoder:
     STEPS = 3
     CHANGE_TOOL_COMMAND = "M6"
 
-    def __init__(self, tag, machining_type='gerber', parent=None, units='ms', mirror_type='x'):
+    def __init__(self, tag, machining_type='gerber', parent=None, units='ms', mirror_type='x', compact=False):
 
         self.parent = parent
         self.tag = tag
 
         self.mill = True
 
+        # compact output:
+        # track the modal state of the machine and
+        # skip repeated G words, unchanged axes, redundant
+        # feed rates and trailing zeros, so that each line
+        # takes less room in the controller serial buffer
+        self.compact = compact
+        self.modal = {}
+        self.pending_feed = None
+        self.reset_modal()
+
         # units:
         # ms -> metric system
         # is -> imperial system
@@ -110,8 +121,49 @@ class GCoder:
         ff = round(f, self.DIGITS)
         fs = "{:." + str(self.DIGITS) + "f}"
         f_str = fs.format(ff)
+        if self.compact:
+            f_str = f_str.rstrip("0").rstrip(".")
+            if f_str == "-0":
+                f_str = "0"
         return f_str
 
+    def reset_modal(self, keep_feed=False):
+        # the modal state is unknown, e.g. at the beginning
+        # of the file or after a macro that moved the machine.
+        # After a macro the requested feed rate is kept, to be
+        # sent again with the next working move
+        self.modal = {'G': None, 'X': None, 'Y': None, 'Z': None, 'F': None}
+        if not keep_feed:
+            self.pending_feed = None
+
+    def set_feed(self, f):
+        f_str = self.format_float(f)
+        if self.compact:
+            # the feed rate is attached to the next working move,
+            # and again whenever the machine may have a different one
+            self.pending_feed = f_str
+            return ""
+        return "G01 F" + f_str + "\n"
+
+    def compact_move(self, g, x=None, y=None, z=None):
+        words = []
+        for k, v in (('X', x), ('Y', y), ('Z', z)):
+            if v is not None:
+                v_str = self.format_float(v)
+                if v_str != self.modal[k]:
+                    words.append(k + v_str)
+                    self.modal[k] = v_str
+        if not words:
+            # the machine is already there
+            return ""
+        if g != self.modal['G']:
+            words.insert(0, "G" + str(g))
+            self.modal['G'] = g
+        if g == 1 and self.pending_feed is not None and self.pending_feed != self.modal['F']:
+            words.append("F" + self.pending_feed)
+            self.modal['F'] = self.pending_feed
+        return " ".join(words) + "\n"
+
     def load_path(self, path):
         self.path = path
 
@@ -139,6 +191,7 @@ class GCoder:
         # compute GCode from a drill path
 
         self.gcode = []
+        self.reset_modal()
         self.create_header()
         self.add_job_info()
         self.add_init()
@@ -149,25 +202,7 @@ class GCoder:
         print("Compute Drill:")
         tool_change = -1
         for d in self.path:
-            data = d[0]
-            path = d[1]
-            if data[1] == 'pocketing':
-                print(" - Pocketing, bit diameter " + str(data[0]))
-                self.insert_comment("Pocketing Section in Drill Procedure")
-                self.insert_comment("Tool Diameter: " + str(data[0]))
-                cut = self.cfg['cut']
-                sign = cut / abs(cut)
-                dpp = data[0]
-                n = int(abs(cut) // dpp) + 1
-                dpp = abs(cut)/n
-                pass_list = [sign * dpp * x for x in range(1, n)] + [cut]
-                pass_list.sort(reverse=True)
-                self.compute_pocketing_paths(path, pass_list, mirror=mirror)
-            else:
-                print(" - Drilling, bit diameter " + str(data[0]))
-                self.insert_comment("Drill Section in Drill Procedure")
-                self.insert_comment("Tool Diameter: " + str(data[0]))
-                self.compute_drill_paths(path, tool_change=tool_change, mirror=mirror)
+            self.compute_operation(d, mirror=mirror, tool_change=tool_change)
             tool_change += 1
 
         self.spindle_on(False)
@@ -180,6 +215,7 @@ class GCoder:
         # can be chosen in the settings
 
         self.gcode = []
+        self.reset_modal()
         self.create_header()
         self.add_job_info()
         self.add_init()
@@ -196,8 +232,7 @@ class GCoder:
         # return in travel mode
 
         for d in self.path:
-            paths = d[1]
-            self.compute_gerber_paths(paths, mirror=mirror)
+            self.compute_operation(d, mirror=mirror)
 
         self.spindle_on(False)
         self.go_to((0.0, 0.0))
@@ -210,6 +245,7 @@ class GCoder:
         # can be chosen in the settings
 
         self.gcode = []
+        self.reset_modal()
         self.create_header()
         self.add_job_info()
         self.add_init()
@@ -225,12 +261,40 @@ class GCoder:
         # follow the path and finally
         # return in travel mode
 
-        multi_pass = False
-        if self.cfg['multi_depth']:
-            multi_pass = self.cfg['depth_per_pass'] > 0.0
-
         for d in self.path:
-            paths = d[1]
+            self.compute_operation(d, mirror=mirror)
+
+        self.spindle_on(False)
+        self.go_to((0.0, 0.0))
+
+    def compute_operation(self, d, machining_type=None, mirror=False, tool_change=-1):
+        # compute the GCode of a single ((tool diameter, kind), paths) element of a path
+        if machining_type is None:
+            machining_type = self.type
+        data = d[0]
+        paths = d[1]
+        if machining_type == 'drill':
+            if data[1] == 'pocketing':
+                print(" - Pocketing, bit diameter " + str(data[0]))
+                self.insert_comment("Pocketing Section in Drill Procedure")
+                self.insert_comment("Tool Diameter: " + str(data[0]))
+                cut = self.cfg['cut']
+                sign = cut / abs(cut)
+                dpp = data[0]
+                n = int(abs(cut) // dpp) + 1
+                dpp = abs(cut)/n
+                pass_list = [sign * dpp * x for x in range(1, n)] + [cut]
+                pass_list.sort(reverse=True)
+                self.compute_pocketing_paths(paths, pass_list, mirror=mirror)
+            else:
+                print(" - Drilling, bit diameter " + str(data[0]))
+                self.insert_comment("Drill Section in Drill Procedure")
+                self.insert_comment("Tool Diameter: " + str(data[0]))
+                self.compute_drill_paths(paths, tool_change=tool_change, mirror=mirror)
+        elif machining_type in ('profile', 'pocketing'):
+            multi_pass = False
+            if self.cfg['multi_depth']:
+                multi_pass = self.cfg['depth_per_pass'] > 0.0
             if multi_pass:
                 cut = self.cfg['cut']
                 sign = cut/abs(cut)
@@ -241,9 +305,8 @@ class GCoder:
                 self.compute_pocketing_paths(paths, pass_list, mirror=mirror)
             else:
                 self.compute_gerber_paths(paths, mirror=mirror)
-
-        self.spindle_on(False)
-        self.go_to((0.0, 0.0))
+        else:
+            self.compute_gerber_paths(paths, mirror=mirror)
 
     def mirror_coords(self, cs):
         csa = np.array(cs)
@@ -257,15 +320,15 @@ class GCoder:
 
     def compute_drill_paths(self, paths, tool_change=-1, mirror=False):
 
+        # insert tool change command if needed,
+        # before the feed rate: the macro sets its own ones
+        if tool_change >= 0:
+            self.go_tool_change(tool_id=tool_change)
+
         # set the working feed rate
         # of the Z axis
         zf = self.cfg['z_feedrate']
-        zf_str = self.format_float(zf)
-        self.gcode.append("G01 F" + zf_str + "\n")
-
-        # insert tool change command if needed
-        if tool_change >= 0:
-            self.go_tool_change(tool_id=tool_change)
+        self.gcode.append(self.set_feed(zf))
 
         for p in paths:
             cs = list(p.coords)
@@ -310,6 +373,9 @@ class GCoder:
     def go_to(self, p):
         gc = ""
         x, y = p
+        if self.compact:
+            self.gcode.append(self.compact_move(1 if self.mill else 0, x=x, y=y))
+            return
         x_str = self.format_float(x)
         y_str = self.format_float(y)
         if self.mill:
@@ -328,6 +394,8 @@ class GCoder:
         gc = "T" + str(int(tool_id)) + "\n"
         gc += self.CHANGE_TOOL_COMMAND + "\n"
         self.gcode.append(gc)
+        # the tool change macro moves the machine around and sets its own feed rates
+        self.reset_modal(keep_feed=True)
 
     def make_drill(self):
         steps = self.STEPS
@@ -344,6 +412,10 @@ class GCoder:
 
         for i in range(steps):
             z += delta_z
+            if self.compact:
+                gc += self.compact_move(1, z=z)
+                gc += self.compact_move(0, z=0.0)
+                continue
             zt_str = self.format_float(z)
             gc += "G01 Z" + zt_str + "\n"
             gc += "G00 Z" + z_zero_str + "\n"
@@ -351,8 +423,11 @@ class GCoder:
 
     def go_travel(self):
         zt = self.cfg['travel']
-        zt_str = self.format_float(zt)
-        self.gcode.append("G00 Z" + zt_str + "\n")
+        if self.compact:
+            self.gcode.append(self.compact_move(0, z=zt))
+        else:
+            zt_str = self.format_float(zt)
+            self.gcode.append("G00 Z" + zt_str + "\n")
         self.mill = False
 
     def go_mill(self, z=None):
@@ -362,13 +437,14 @@ class GCoder:
             zt = self.cfg['cut']
         else:
             zt = z
-        zf_str = self.format_float(zf)
-        gc += "G01 F" + zf_str + "\n"
-        zt_str = self.format_float(zt)
-        gc += "G01 Z" + zt_str + "\n"
+        gc += self.set_feed(zf)
+        if self.compact:
+            gc += self.compact_move(1, z=zt)
+        else:
+            zt_str = self.format_float(zt)
+            gc += "G01 Z" + zt_str + "\n"
         xyf = self.cfg['xy_feedrate']
-        xyf_str = self.format_float(xyf)
-        gc += "G01 F" + xyf_str + "\n"
+        gc += self.set_feed(xyf)
         self.gcode.append(gc)
         self.mill = True
 
@@ -452,34 +528,43 @@ class GCoder:
     def insert_comment(self, txt):
         self.gcode.append(self.gcode_comment(txt))
 
-    def get_autobed_leveling_code(self, xy_c_l, travel_z, probe_z_min, probe_feed_rate):
+    def get_autobed_leveling_code(self, xy_c_l, travel_z, probe_z_min, probe_feed_rate, center=True):
         # todo: change this part using methods to create the GCode
         abl_cmd_ls = []
-        abl_cmd_s = ""
-        abl_cmd_s += "G01 F" + str(probe_feed_rate) + "\n"  # set probe feed rate
-
         prb_num_todo = 0
         for coord in xy_c_l:
             prb_num_todo += 1
-            abl_cmd_s += "G00 Z" + str(travel_z) + "\n"  # get to safety Z Travel
-            abl_cmd_s += "G00 X" + str(coord[0]) + "Y" + str(coord[1]) + "\n"  # go to XY coordinate
-            abl_cmd_s += "G38.2 Z" + str(probe_z_min) + "F" + str(probe_feed_rate) + "\n"  # set probe command
-            abl_cmd_s += "G00 Z" + str(travel_z) + "\n"  # get to safety Z Travel
-            abl_cmd_ls.append(abl_cmd_s)
-            abl_cmd_s = ""
+            abl_cmd_ls.append(self.get_probe_point_code(coord, travel_z, probe_z_min, probe_feed_rate))
+        if abl_cmd_ls:
+            abl_cmd_ls[0] = "G01 F" + str(probe_feed_rate) + "\n" + abl_cmd_ls[0]  # set probe feed rate
+
+        if center:
+            xy_center = ((xy_c_l[0][0] + xy_c_l[-1][0]) / 2.0, (xy_c_l[0][1] + xy_c_l[-1][1]) / 2.0)
+            abl_cmd_ls.append(self.get_probe_center_code(xy_center, xy_c_l[0], travel_z, probe_z_min,
+                                                         probe_feed_rate))
+            prb_num_todo += 1
 
+        return abl_cmd_ls, prb_num_todo
+
+    @staticmethod
+    def get_probe_point_code(coord, travel_z, probe_z_min, probe_feed_rate):
         abl_cmd_s = ""
         abl_cmd_s += "G00 Z" + str(travel_z) + "\n"  # get to safety Z Travel
-        abl_cmd_s += "G00 X" + str((xy_c_l[0][0] + xy_c_l[-1][0]) / 2.0) + "Y" + \
-                          str((xy_c_l[0][1] + xy_c_l[-1][1]) / 2.0) + "\n"
+        abl_cmd_s += "G00 X" + str(coord[0]) + "Y" + str(coord[1]) + "\n"  # go to XY coordinate
         abl_cmd_s += "G38.2 Z" + str(probe_z_min) + "F" + str(probe_feed_rate) + "\n"  # set probe command
-        prb_num_todo += 1
-        abl_cmd_s += "G10 P1 L20 Z0\n"  # set Z zero
         abl_cmd_s += "G00 Z" + str(travel_z) + "\n"  # get to safety Z Travel
-        abl_cmd_s += "G00 X" + str(xy_c_l[0][0]) + "Y" + str(xy_c_l[0][1]) + "\n"  # go 1st XY coordinate
-        abl_cmd_ls.append(abl_cmd_s)
+        return abl_cmd_s
 
-        return abl_cmd_ls, prb_num_todo
+    @staticmethod
+    def get_probe_center_code(xy_center, xy_first, travel_z, probe_z_min, probe_feed_rate):
+        abl_cmd_s = ""
+        abl_cmd_s += "G00 Z" + str(travel_z) + "\n"  # get to safety Z Travel
+        abl_cmd_s += "G00 X" + str(xy_center[0]) + "Y" + str(xy_center[1]) + "\n"
+        abl_cmd_s += "G38.2 Z" + str(probe_z_min) + "F" + str(probe_feed_rate) + "\n"  # set probe command
+        abl_cmd_s += "G10 P1 L20 Z0\n"  # set Z zero
+        abl_cmd_s += "G00 Z" + str(travel_z) + "\n"  # get to safety Z Travel
+        abl_cmd_s += "G00 X" + str(xy_first[0]) + "Y" + str(xy_first[1]) + "\n"  # go 1st XY coordinate
+        return abl_cmd_s
 
     def get_macro_code(self, macro_type="M6", to_comment=""):
         print("Get Macro Code")
@@ -497,15 +582,38 @@ class GCoder:
     def write(self, file_path):
         print("Writing gcode file:")
         print("\t " + str(os.path.abspath(file_path)))
-        with open(file_path, 'w') as f:
+        # the file is replaced, not rewritten in place: a previous version
+        # mapped by the controller (e.g. while streaming) stays valid
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'w') as f:
             f.write("".join(self.gcode))
+        os.replace(tmp_path, file_path)
         print("Done")
 
+    def get_program(self):
+        # the generated code is interpreted once, in memory
+        gcp = GCodeParser({'compact': self.compact})
+        gcp.load_gcode_lines("".join(self.gcode).splitlines(True))
+        gcp.interp()
+        gcp.vectorize()
+        if gcp.get_gcode() is None:
+            return None
+        return GCodeProgram.from_gcode(gcp.get_gcode())
+
+    def write_program(self, file_path):
+        # write the gcode file together with its program sidecar
+        self.write(file_path)
+        program = self.get_program()
+        if program is not None:
+            try:
+                program.save(file_path)
+            except OSError as e:
+                print("Program sidecar not saved: " + str(e))
+        return program
+
     # macro section
 
     def is_macro(self, cmd):
-        print("Is Macro")
-        print(cmd)
         if self.macro is not None:
             return self.macro.is_macro(cmd)
         else:
@@ -534,6 +642,9 @@ class GCodeMacro:
 
 
 class GcodeLine:
+
+    __slots__ = ('command', 'params', 'comment', 'tag')
+
     def __init__(self):
         self.command = []
         self.params = od({})
@@ -578,13 +689,18 @@ class GcodePoint:
     WORKING_POS = "wp"
     MACHINE_POS = "mp"
 
+    # points are created by the million (ABL): no instance dict, and the params
+    # are shared between points, so they are replaced and never changed in place
+    __slots__ = ('coords', 'line', 'sub_line', 'type', 'pos', 'params')
+    NO_PARAMS = MappingProxyType(od({}))
+
     def __init__(self):
         self.coords = np.zeros((3,))
         self.line = -1
         self.sub_line = 0
         self.type = self.WORKING  # w working t travel
         self.pos = self.WORKING_POS  # wp working mp machine
-        self.params = od({})
+        self.params = self.NO_PARAMS
 
     def __repr__(self):
         s = "GcodeVector (\n"
@@ -609,25 +725,30 @@ class GcodePoint:
         cnp.sub_line = self.sub_line
         cnp.type = self.type
         cnp.pos = self.pos
-        cnp.params = self.params.copy()
+        cnp.params = self.params
         return cnp
 
-    def get_string(self):
-        s = ""
+    def get_string(self, prev=None):
+        # prev is the point sent just before this one:
+        # when given, the words already in the modal state are skipped
+        if prev is not None and (prev.pos == self.MACHINE_POS or self.pos == self.MACHINE_POS):
+            prev = None
+        wl = []
         if self.pos == self.MACHINE_POS:
-            s += "G53 "
+            wl.append("G53")
 
-        if self.type == self.TRAVEL:
-            s += "G0"
-        else:
-            s += "G1"
-        s += " X" + "{:.3f}".format(self.coords[0])
-        s += " Y" + "{:.3f}".format(self.coords[1])
-        if len(self.coords) > 2:
-            s += " Z" + "{:.3f}".format(self.coords[2])
+        if prev is None or prev.type != self.type:
+            if self.type == self.TRAVEL:
+                wl.append("G0")
+            else:
+                wl.append("G1")
+        for i, k in enumerate(("X", "Y", "Z")[:len(self.coords)]):
+            c_str = "{:.3f}".format(self.coords[i])
+            if prev is None or c_str != "{:.3f}".format(prev.coords[i]):
+                wl.append(k + c_str)
         for k in self.params.keys():
-            s += " " + str(k).upper() + str(self.params[k])
-        s += "\n"
+            wl.append(str(k).upper() + str(self.params[k]))
+        s = " ".join(wl) + "\n"
         return s
 
 
@@ -640,18 +761,356 @@ class GCode:
         self.original_vectors = []
         self.modified_vectors = []
         self.bb = None
+        # columnar table of the interpreted lines
+        self.records = GCodeRecords()
+        # columnar table of the original vectors
+        self.vectors = GCodeVectors()
+
+
+class GCodeFileLines:
+    """ Lines of a G-code file read from a memory map of the file
+        through the index of the line offsets, the lines are decoded
+        only when they are accessed. """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.mm = None
+        self.src_size = -1
+        self.src_mtime = -1.0
+        self.open()
+        buf = np.frombuffer(self.mm, dtype=np.uint8)
+        ends = np.flatnonzero(buf == ord("\n")) + 1
+        del buf
+        if not len(ends) or ends[-1] != self.src_size:
+            ends = np.append(ends, self.src_size)
+        self.offsets = np.concatenate(([0], ends)).astype(np.int64)
+
+    def open(self):
+        if self.mm is None:
+            st = os.stat(self.file_path)
+            if self.src_size >= 0 and (st.st_size != self.src_size or st.st_mtime != self.src_mtime):
+                raise OSError("GCode file changed since it was loaded: " + str(self.file_path))
+            with open(self.file_path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.src_size = st.st_size
+            self.src_mtime = st.st_mtime
+
+    def close(self):
+        # release the file (it can't be overwritten while mapped on Windows),
+        # it is mapped again on the next access
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+    def get_bytes(self, start, stop):
+        self.open()
+        return self.mm[self.offsets[start]:self.offsets[stop]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        line = self.get_bytes(i, i + 1).decode("utf-8", "replace")
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
+        return line
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class GCodeRecords:
+    """ Columnar table of the records (non empty lines) of a G-code file.
+        The first and the second command of each record (a G, or an M after
+        a word that is not a G: T1 M6) are stored as letter code
+        (0: no command) and number * 10 (e.g. G38.2 -> 382, M6 -> 60),
+        the second is the first again when there is none. """
+
+    PARAM_TAG = ['x', 'y', 'z', 'f', 'p']
+    FIELDS = ('src', 'cmd_letter', 'cmd_code', 'motion', 'machine', 'complex', 'params')
+
+    def __init__(self, n=0):
+        # source line
+        self.src = np.zeros((n,), dtype=np.int32)
+        # first and second command
+        self.cmd_letter = np.zeros((n, 2), dtype=np.uint8)
+        self.cmd_code = np.full((n, 2), -1, dtype=np.int32)
+        # active motion mode (G0, G1, G2, G3) of the motion records, -1 otherwise
+        self.motion = np.full((n,), -1, dtype=np.int8)
+        # position in machine coordinates (G53)
+        self.machine = np.zeros((n,), dtype=bool)
+        # tags or words understood only by the full line interpreter
+        self.complex = np.zeros((n,), dtype=bool)
+        # X, Y, Z, F, P values, nan when missing
+        self.params = np.full((n, len(self.PARAM_TAG)), np.nan)
+
+    def __len__(self):
+        return len(self.src)
+
+
+class GcodeLines:
+    """ Sequence of the GcodeLine of a file, each line
+        is interpreted only when it is accessed. """
+
+    def __init__(self, lines, records):
+        self.lines = lines
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        motion = self.records.motion[i]
+        motion_cmd = ('g', (int(motion),)) if motion >= 0 else None
+        gcl = GCodeParser.interp_line(self.lines[self.records.src[i]], motion_cmd)
+        if gcl is None:
+            gcl = GcodeLine()
+        return gcl
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class GCodeVectors:
+    """ Columnar table of the vectors of a G-code file: the positions
+        reached by the motion commands in working coordinates,
+        starting from the origin. """
+
+    TYPE_CODES = (GcodePoint.TRAVEL, GcodePoint.WORKING)
+    POS_CODES = (GcodePoint.WORKING_POS, GcodePoint.MACHINE_POS)
+    PARAM_TAG = ['f', 'p']
+    FIELDS = ('points', 'types', 'pos', 'lines', 'sub_lines', 'params')
+
+    def __init__(self, n=0):
+        self.points = np.zeros((n, 3))
+        # indexes of TYPE_CODES and POS_CODES
+        self.types = np.ones((n,), dtype=np.int8)
+        self.pos = np.zeros((n,), dtype=np.int8)
+        # record of each vector, and index inside the subdivided segments
+        self.lines = np.full((n,), -1, dtype=np.int32)
+        self.sub_lines = np.zeros((n,), dtype=np.int32)
+        # F, P values, nan when missing
+        self.params = np.full((n, len(self.PARAM_TAG)), np.nan)
+        # params of the points, shared by the points with the same values
+        self.params_table = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    @staticmethod
+    def forward_fill(a):
+        # nan values take the last valid value along the first axis
+        idx = np.arange(len(a)).reshape((-1,) + (1,) * (a.ndim - 1))
+        idx = np.where(np.isnan(a), 0, idx)
+        np.maximum.accumulate(idx, axis=0, out=idx)
+        return np.take_along_axis(a, idx, axis=0)
+
+    @classmethod
+    def from_points(cls, vl):
+        n = len(vl)
+        vec = cls(n)
+        for i, p in enumerate(vl):
+            vec.points[i] = p.coords
+            vec.types[i] = cls.TYPE_CODES.index(p.type)
+            vec.pos[i] = cls.POS_CODES.index(p.pos)
+            vec.lines[i] = p.line
+            vec.sub_lines[i] = p.sub_line
+            for j, k in enumerate(cls.PARAM_TAG):
+                if k in p.params:
+                    vec.params[i, j] = p.params[k]
+        return vec
+
+    def get_params(self, i):
+        key = self.params[i].tobytes()
+        params = self.params_table.get(key)
+        if params is None:
+            params = od({})
+            for j, k in enumerate(self.PARAM_TAG):
+                if not np.isnan(self.params[i, j]):
+                    params[k] = float(self.params[i, j])
+            params = MappingProxyType(params) if params else GcodePoint.NO_PARAMS
+            self.params_table[key] = params
+        return params
+
+    def get_point(self, i):
+        px = GcodePoint()
+        px.coords = self.points[i].copy()
+        px.type = self.TYPE_CODES[self.types[i]]
+        px.pos = self.POS_CODES[self.pos[i]]
+        px.line = int(self.lines[i])
+        px.sub_line = int(self.sub_lines[i])
+        px.params = self.get_params(i)
+        return px
+
+    def get_runs(self):
+        # consecutive vectors of the same type as (travel, points),
+        # each run starts from the last point of the previous one
+        runs = []
+        n = len(self)
+        if n > 1:
+            t = self.types[1:]
+            bounds = [0] + (np.flatnonzero(t[1:] != t[:-1]) + 1).tolist() + [n - 1]
+            for a, b in zip(bounds[:-1], bounds[1:]):
+                runs.append((self.TYPE_CODES[t[a]] == GcodePoint.TRAVEL, self.points[a:b + 1]))
+        return runs
+
+
+class GcodePoints:
+    """ Sequence of the GcodePoint of a vectors table,
+        each point is created only when it is accessed. """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def __getitem__(self, i):
+        return self.vectors.get_point(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class GCodeProgram:
+    """ Structured representation of a vectorized G-code program.
+        It is handed over from the generator to the controller in memory
+        and it is saved next to the gcode file, so that the file can be
+        loaded again without parsing it. """
+
+    VERSION = 6
+    SIDECAR_EXT = ".npz"
+
+    def __init__(self):
+        self.lines = []
+        self.records = GCodeRecords()
+        self.vectors = GCodeVectors()
+        # modal feed rate active on each vector
+        self.feeds = np.zeros((0,))
+        self.bb = None
+        # source file stats
+        self.src_size = -1
+        self.src_mtime = -1.0
+
+    @classmethod
+    def from_gcode(cls, gc):
+        prg = cls()
+        prg.lines = gc.original_lines
+        prg.records = gc.records
+        prg.vectors = gc.vectors
+        prg.feeds = prg.get_modal_values(prg.records.params[:, 3], prg.vectors.lines)
+        prg.bb = gc.bb
+        return prg
+
+    @staticmethod
+    def get_modal_values(rec_values, v_lines):
+        # value of a modal word active on each vector
+        values = np.full((len(v_lines),), np.nan)
+        if len(rec_values):
+            ff = GCodeVectors.forward_fill(rec_values)
+            valid = v_lines >= 0
+            values[valid] = ff[v_lines[valid]]
+        return values
+
+    def to_gcode(self):
+        gc = GCode(self.lines)
+        gc.records = self.records
+        gc.vectors = self.vectors
+        gc.original_vectors = GcodePoints(self.vectors)
+        gc.gcll = GcodeLines(self.lines, self.records)
+        gc.bb = self.bb
+        return gc
+
+    @classmethod
+    def get_sidecar_path(cls, gcode_path):
+        return gcode_path + cls.SIDECAR_EXT
+
+    def set_source(self, gcode_path):
+        st = os.stat(gcode_path)
+        self.src_size = st.st_size
+        self.src_mtime = st.st_mtime
+
+    def is_valid_for(self, gcode_path):
+        if not os.path.isfile(gcode_path):
+            return False
+        st = os.stat(gcode_path)
+        return st.st_size == self.src_size and st.st_mtime == self.src_mtime
+
+    def save(self, gcode_path):
+        self.set_source(gcode_path)
+        bb = np.array(self.bb if self.bb is not None else [], dtype=float)
+        tables = {"rec_" + k: getattr(self.records, k) for k in GCodeRecords.FIELDS}
+        tables.update({"vec_" + k: getattr(self.vectors, k) for k in GCodeVectors.FIELDS})
+        with open(self.get_sidecar_path(gcode_path), 'wb') as f:
+            np.savez(f, version=self.VERSION, src=np.array([self.src_size, self.src_mtime]),
+                     feeds=self.feeds, bb=bb, **tables)
+
+    @classmethod
+    def load(cls, gcode_path):
+        sc_path = cls.get_sidecar_path(gcode_path)
+        if not os.path.isfile(sc_path):
+            return None
+        prg = cls()
+        try:
+            with np.load(sc_path) as d:
+                if int(d['version']) != cls.VERSION:
+                    return None
+                prg.src_size = int(d['src'][0])
+                prg.src_mtime = float(d['src'][1])
+                if not prg.is_valid_for(gcode_path):
+                    return None
+                for k in GCodeRecords.FIELDS:
+                    setattr(prg.records, k, d["rec_" + k])
+                for k in GCodeVectors.FIELDS:
+                    setattr(prg.vectors, k, d["vec_" + k])
+                prg.feeds = d['feeds']
+                prg.bb = tuple(d['bb'].tolist()) if d['bb'].size else None
+        except (OSError, KeyError, ValueError) as e:
+            print("Invalid GCode sidecar file: " + str(e))
+            return None
+        prg.lines = GCodeFileLines(gcode_path)
+        return prg
+
+
+class GCodeStream:
+    """ Lines of a recoded program, generated while they are sent. """
+
+    def __init__(self, lines_it, length):
+        self.lines_it = lines_it
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.lines_it
 
 
 class GCodeParser:
 
+    # tokenizer: words, line ends and characters (or adjacent letters) of tags and special commands
+    WORD_PAT = re.compile(rb"[A-Za-z]-?(?:\d+\.?\d*|\.\d+)|\n|[^A-Za-z0-9.+\-\s]|[A-Za-z](?=[A-Za-z_])")
+    COMMENT_PAT = re.compile(rb"\([^)\n]*\)?|;[^\n]*")
+    # first non blank char of each line, empty for blank lines
+    NONBLANK_PAT = re.compile(rb"^[ \t\r\x0b\x0c]*(\S?)", re.M)
+    # lines tokenized at once
+    CHUNK_LINES = 65536
+
     COORD_TAG = ['x', 'y', 'z']
     PARAM_TAG = ['f', 'p']
+    MODAL_TAG = ['x', 'y', 'z', 'f']
+    MOTION_CODES = (0, 1, 2, 3)
     CHANGE_TOOL_COMMAND = ('m', 6)
     MACHINE_POS_COMMAND = ('g', 53)
 
     def __init__(self, cfg):
         self.gcode_path = ""
         self.cfg = cfg
+        # compact recoding: skip the words already in the machine modal state
+        self.compact = bool(cfg) and cfg.get('compact', False)
         self.gc = None
 
     def load_gcode_file(self, gcode_path):
@@ -659,75 +1118,227 @@ class GCodeParser:
         print(gcode_path)
         if os.path.isfile(gcode_path):
             self.gcode_path = gcode_path
-            with open(self.gcode_path) as f:
-                lines = f.readlines()
-                if lines:
-                    # GCode file loaded
-                    self.gc = GCode(lines)
+            if os.path.getsize(gcode_path) > 0:
+                # GCode file mapped
+                self.gc = GCode(GCodeFileLines(gcode_path))
         else:
             print("Invalid GCode File Path")
 
+    def release_gcode_file(self):
+        if self.gc is not None and isinstance(self.gc.original_lines, GCodeFileLines):
+            self.gc.original_lines.close()
+
+    def load_gcode_lines(self, lines):
+        if lines:
+            self.gc = GCode(lines)
+
+    def load_program(self, program, gcode_path=""):
+        self.gcode_path = gcode_path
+        self.gc = program.to_gcode()
+
     def interp(self, single_line=None):
+        if single_line is not None:
+            gcl = self.interp_line(single_line)
+            return [gcl] if gcl is not None else []
         gcll = []
-        if self.gc is not None or single_line is not None:
-            if single_line is not None:
-                ls = [single_line]
+        if self.gc is not None:
+            if self.gc.modified_lines:
+                ls = self.gc.modified_lines
             else:
-                if self.gc.modified_lines:
-                    ls = self.gc.modified_lines
+                ls = self.gc.original_lines
+            self.gc.records = self.tokenize(ls)
+            self.check_complex(ls, self.gc.records)
+            gcll = GcodeLines(ls, self.gc.records)
+            self.gc.gcll = gcll
+        return gcll
+
+    @classmethod
+    def check_complex(cls, lines, records):
+        # the lines with tags or special commands are interpreted at load,
+        # an invalid line must stop the load and not the streaming
+        for i in np.flatnonzero(records.complex):
+            src = records.src[i]
+            try:
+                gcl = cls.interp_line(lines[src])
+            except (ValueError, IndexError) as e:
+                raise ValueError("Invalid GCode line " + str(src + 1) + ": " + str(lines[src]).strip()) from e
+            if gcl is None or not gcl.command:
+                # nothing to send
+                records.complex[i] = False
+
+    @classmethod
+    def interp_line(cls, l, motion_cmd=None):
+        # full interpretation of a single line,
+        # motion_cmd is the motion mode active on the line
+        d = l.strip()
+        d = d.replace("(", ";")
+        d = d.replace(")", "")
+        d += ";"
+        tmp = d.split(";")
+        data, comment = tmp[0:2]
+        if data or comment:
+            gcl = GcodeLine()
+            # store the comment if needed
+            gcl.comment = comment.strip()
+            # decode the commands
+            if data:
+                data = data.lower()
+                if "$#" in data:
+                    gcl.command = [("$#", tuple())]
+                elif data.startswith("$"):
+                    # system command ($H, $X, $J=...), sent as it is
+                    gcl.command = [(data.strip(), tuple())]
+                elif data.strip() == "%":
+                    # program delimiter
+                    pass
                 else:
-                    ls = self.gc.original_lines
-            for l in ls:
-                d = l.strip()
-                d = d.replace("(", ";")
-                d = d.replace(")", "")
-                d += ";"
-                tmp = d.split(";")
-                data, comment = tmp[0:2]
-                if data or comment:
-                    gcl = GcodeLine()
-                    # store the comment if needed
-                    gcl.comment = comment.strip()
-                    # decode the commands
-                    if data:
-                        data = data.lower()
-                        if "$#" in data:
-                            gcl.command = [("$#", tuple())]
-                        else:
-                            splitted = re.findall(r'[a-z][-]*[\d.]+', data)
-
-                            # detect tags (remember, tags cannot be used in motion commands)
-                            tags = re.findall(r'[a-z][@]*[a-z_]+[@]*', data)
+                    splitted = re.findall(r'[a-z][-]*[\d.]+', data)
+
+                    # detect tags (remember, tags cannot be used in motion commands)
+                    tags = re.findall(r'[a-z][@]*[a-z_]+[@]*', data)
 
+                    if splitted and splitted[0][0] in cls.MODAL_TAG and motion_cmd is not None:
+                        # no command word, the active motion mode is used
+                        gcl.command = [motion_cmd]
+                    else:
+                        cmd = splitted.pop(0)
+                        ct = cmd[0]
+                        cd = [int(x) for x in cmd[1::].split(".")]
+                        gcl.command = [(ct, tuple(cd))]
+
+                    if splitted:
+                        if splitted[0][0] == "g" or (splitted[0][0] == "m" and gcl.command[0][0] != "g"):
+                            # second command
                             cmd = splitted.pop(0)
                             ct = cmd[0]
                             cd = [int(x) for x in cmd[1::].split(".")]
-                            gcl.command = [(ct, tuple(cd))]
-
-                            if splitted:
-                                if splitted[0].upper().startswith("G"):
-                                    # second command
-                                    cmd = splitted.pop(0)
-                                    ct = cmd[0]
-                                    cd = [int(x) for x in cmd[1::].split(".")]
-                                    gcl.command += [(ct, tuple(cd))]
-
-                            par = splitted
-                            params = od({})
-                            for p in par:
-                                params[p[0]] = float(p[1::])
-                            for t in tags:
-                                params[t[0]] = t[1::]
-                                gcl.tag = True
-                            gcl.params = params
-                    gcll.append(gcl)
-            if single_line is None:
-                self.gc.gcll = gcll
-        return gcll
+                            gcl.command += [(ct, tuple(cd))]
+
+                    par = splitted
+                    params = od({})
+                    for p in par:
+                        params[p[0]] = float(p[1::])
+                    for t in tags:
+                        params[t[0]] = t[1::]
+                        gcl.tag = True
+                    gcl.params = params
+            return gcl
+        return None
+
+    @classmethod
+    def iter_chunks(cls, lines):
+        # blocks of consecutive lines as bytes, the file is never joined in a single string
+        n = len(lines)
+        for a in range(0, n, cls.CHUNK_LINES):
+            b = min(a + cls.CHUNK_LINES, n)
+            if isinstance(lines, GCodeFileLines):
+                yield b - a, lines.get_bytes(a, b)
+            else:
+                yield b - a, "".join(lines[a:b]).encode("utf-8", "replace")
+
+    @classmethod
+    def scan_lines(cls, text, n):
+        # columns of a block of n lines: first word, second command, X Y Z F P values after them
+        nonblank = np.array(cls.NONBLANK_PAT.findall(text)[:n], dtype='S1') != b""
+        # tokens are fixed width byte strings: words are the only tokens longer than one char
+        toks = np.array(cls.WORD_PAT.findall(cls.COMMENT_PAT.sub(b"", text)), dtype='S')
+        width = toks.dtype.itemsize
+        tb = toks.view(np.uint8).reshape(-1, width)
+        if width > 1:
+            is_word = tb[:, 1] != 0
+        else:
+            is_word = np.zeros((len(toks),), dtype=bool)
+        nl = ~is_word & (tb[:, 0] == ord("\n"))
+        cx = ~is_word & ~nl
+        t_line = np.cumsum(nl)
+        w_line = t_line[is_word]
+        w_letter = tb[is_word, 0] | 0x20
+        w_num = np.ascontiguousarray(tb[is_word, 1:]).view('S' + str(max(width - 1, 1))).ravel().astype(float)
+
+        nw = len(w_line)
+        first = np.ones((nw,), dtype=bool)
+        first[1:] = w_line[1:] != w_line[:-1]
+        second = np.zeros((nw,), dtype=bool)
+        second[1:] = first[:-1] & ~first[1:]
+        # a second G (G53 G0) or, after a word that is not a G, M command (T1 M6, M5 M6)
+        second_m = second & (w_letter == ord('m'))
+        second_m[1:] &= w_letter[:-1] != ord('g')
+        second &= (w_letter == ord('g'))
+        second |= second_m
+
+        c_letter = np.zeros((n, 2), dtype=np.uint8)
+        c_num = np.full((n, 2), np.nan)
+        c_letter[w_line[first], 0] = w_letter[first]
+        c_num[w_line[first], 0] = w_num[first]
+        c_letter[:, 1] = c_letter[:, 0]
+        c_num[:, 1] = c_num[:, 0]
+        c_letter[w_line[second], 1] = w_letter[second]
+        c_num[w_line[second], 1] = w_num[second]
+        has_second = np.zeros((n,), dtype=bool)
+        has_second[w_line[second & (w_letter == ord('g'))]] = True
+
+        is_param = ~(first | second)
+        params = np.full((n, len(GCodeRecords.PARAM_TAG)), np.nan)
+        for j, k in enumerate(GCodeRecords.PARAM_TAG):
+            m = is_param & (w_letter == ord(k))
+            params[w_line[m], j] = w_num[m]
+
+        complex_l = np.zeros((n,), dtype=bool)
+        complex_l[t_line[cx]] = True
+        return nonblank, c_letter, c_num, has_second, params, complex_l
+
+    @classmethod
+    def tokenize(cls, lines):
+        # interpret all the lines block by block filling the columns of the records table
+        n = len(lines)
+        cols = [cls.scan_lines(text, bn) for bn, text in cls.iter_chunks(lines)]
+        if cols:
+            nonblank, c_letter, c_num, has_second, params, complex_l = [np.concatenate(c) for c in zip(*cols)]
+        else:
+            nonblank, c_letter, c_num, has_second, params, complex_l = cls.scan_lines(b"", 0)
+        del cols
+
+        # lines starting with a coordinate after the first motion command use the active motion mode
+        g = ord('g')
+        with np.errstate(invalid='ignore'):
+            major = np.floor(c_num)
+        explicit = (c_letter[:, 1] == g) & (major[:, 1] >= 0) & (major[:, 1] <= max(cls.MOTION_CODES))
+        exp_lines = np.flatnonzero(explicit)
+        fm = exp_lines[0] if len(exp_lines) else n
+        modal_letters = np.frombuffer("".join(cls.MODAL_TAG).encode("ascii"), dtype=np.uint8)
+        modal = np.isin(c_letter[:, 0], modal_letters) & (np.arange(n) > fm)
+        explicit &= ~modal
+        motion = np.where(explicit, major[:, 1], -1)
+        idx = np.where(explicit, np.arange(n), 0)
+        np.maximum.accumulate(idx, out=idx)
+        motion = np.where(modal, motion[idx], motion)
+
+        # the first word of the modal lines is a parameter too (the last occurrence wins)
+        for j, k in enumerate(GCodeRecords.PARAM_TAG):
+            m = modal & (c_letter[:, 0] == ord(k)) & np.isnan(params[:, j])
+            params[m, j] = c_num[m, 0]
+        c_letter[modal] = g
+        c_num[modal] = motion[modal, None]
+
+        machine = (c_letter[:, 0] == g) & (major[:, 0] == cls.MACHINE_POS_COMMAND[1]) & has_second & ~modal
+
+        rec = np.flatnonzero(nonblank)
+        records = GCodeRecords(len(rec))
+        records.src = rec.astype(np.int32)
+        records.cmd_letter = c_letter[rec]
+        records.cmd_code = np.where(np.isnan(c_num[rec]), -1, np.round(c_num[rec] * 10)).astype(np.int32)
+        records.motion = motion[rec].astype(np.int8)
+        records.machine = machine[rec]
+        records.complex = complex_l[rec]
+        records.params = params[rec]
+        return records
 
     def recode_gcode(self):
         # Recode Gcode
-        gcls = []
+        return list(self.iter_recode_gcode())
+
+    def iter_recode_gcode(self):
+        # Recode Gcode, the lines are generated one at a time
         if self.gc.modified_vectors:
             # - Modified Loaded
             gcv = self.gc.modified_vectors
@@ -735,28 +1346,36 @@ class GCodeParser:
             # - Original Loaded
             gcv = self.gc.original_vectors
         gcl = self.gc.gcll
-        if gcv or gcl:
-            gcv_len = len(gcv)
-            # start from one because the first initial point
-            # is always in origin of the working coords system
-            vi = 1
-            for l in range(len(gcl)):
-                if vi < len(gcv):
-                    nl = gcv[vi].line
-                else:
-                    nl = -1
-                if nl == l:
-                    cl_flag = True
-                    gcls.append(gcv[vi].get_string())
-                    while cl_flag and vi < gcv_len - 1:
-                        vi += 1
-                        cl_flag = gcv[vi].line == l
-                        if cl_flag:
-                            gcls.append(gcv[vi].get_string())
-                else:
-                    if gcl[l].command:
-                        gcls.append(gcl[l].get_string())
-        return gcls
+        gcv_it = iter(gcv)
+        # skip the first initial point,
+        # it is always in origin of the working coords system
+        next(gcv_it, None)
+        v = next(gcv_it, None)
+        prev = None
+        for l in range(len(gcl)):
+            if v is not None and v.line == l:
+                while v is not None and v.line == l:
+                    yield v.get_string(prev)
+                    prev = v if self.compact else None
+                    v = next(gcv_it, None)
+            else:
+                cl = gcl[l]
+                if cl.command:
+                    yield cl.get_string()
+                    # any other command could change the modal state
+                    prev = None
+
+    def get_recode_length(self):
+        # number of lines generated by the recode, without generating them:
+        # one per vector and one per record with commands and no vectors
+        rec = self.gc.records
+        v_lines = self.get_gcode_vectors_table().lines[1:]
+        has_cmd = (rec.cmd_letter[:, 0] != 0) | rec.complex
+        has_cmd[v_lines] = False
+        return len(v_lines) + int(np.count_nonzero(has_cmd))
+
+    def get_gcode_stream(self):
+        return GCodeStream(self.iter_recode_gcode(), self.get_recode_length())
 
     def get_change_tool_gcode(self):
         ctc = self.CHANGE_TOOL_COMMAND
@@ -764,55 +1383,29 @@ class GCodeParser:
         return ["T0\n", ctc_str]
 
     def vectorize(self):
-        if self.gc.gcll:
-            p0 = GcodePoint()
-            last_coord = p0.coords.copy()
-            vl = [p0]
-            bb_max = [-1e6, -1e6, -1e6]
-            bb_min = [1e6, 1e6, 1e6]
-            for i, gcl in enumerate(self.gc.gcll):
-                if gcl.command:
-                    first_cmd = gcl.command[0]
-                    last_cmd = gcl.command[-1]
-
-                    # check for position command
-                    machine_pos = False
-                    if first_cmd != last_cmd:
-                        if first_cmd[0] == self.MACHINE_POS_COMMAND[0] and self.MACHINE_POS_COMMAND[1] in first_cmd[1]:
-                            machine_pos = True
-
-                    cn = last_cmd[0]
-                    if len(last_cmd[1]) > 0:
-                        ci = last_cmd[1][0]
-                    else:
-                        ci = -1
-                    if cn == 'g' and ci < 2 and not machine_pos and not gcl.tag:
-                        # it is a valid position command in working position system
-                        # let's vectorize it
-                        a = set(gcl.params.keys())
-                        b = set(self.COORD_TAG)
-                        c = b.intersection(a)
-                        d = set(self.PARAM_TAG)
-                        f = a.intersection(d)
-                        if c:
-                            for e in c:
-                                last_coord[self.COORD_TAG.index(e)] = gcl.params[e]
-                                bb_max[self.COORD_TAG.index(e)] = max(bb_max[self.COORD_TAG.index(e)], gcl.params[e])
-                                bb_min[self.COORD_TAG.index(e)] = min(bb_min[self.COORD_TAG.index(e)], gcl.params[e])
-                            p = last_coord.copy()
-                            px = GcodePoint()
-                            px.coords = p
-                            px.type = px.TRAVEL if ci == 0 else px.WORKING
-                            px.pos = px.MACHINE_POS if machine_pos else px.WORKING_POS
-                            px.line = i
-                            if f:
-                                for g in f:
-                                    px.params[g] = gcl.params[g]
-                            vl.append(px)
-
-            if len(vl) > 1:
-                self.gc.original_vectors = vl
-                self.gc.bb = tuple(bb_min + bb_max)
+        rec = self.gc.records
+        nc = len(self.COORD_TAG)
+        coords = rec.params[:, :nc]
+        # valid position commands in working position system (G0, G1)
+        valid = (rec.motion >= 0) & (rec.motion < 2) & ~rec.machine & ~rec.complex
+        valid &= ~np.isnan(coords).all(axis=1)
+        idx = np.flatnonzero(valid)
+        if len(idx):
+            c = coords[idx]
+            # the first vector is always in the origin of the working coords system,
+            # the missing coordinates keep the last value
+            vec = GCodeVectors(len(idx) + 1)
+            vec.points[1:] = c
+            vec.points = GCodeVectors.forward_fill(vec.points)
+            vec.types[1:] = np.where(rec.motion[idx] == 0, 0, 1)
+            vec.lines[1:] = idx
+            vec.params[1:] = rec.params[idx, nc:]
+
+            bb_min = np.where(np.isnan(c), 1e6, c).min(axis=0)
+            bb_max = np.where(np.isnan(c), -1e6, c).max(axis=0)
+            self.gc.vectors = vec
+            self.gc.original_vectors = GcodePoints(vec)
+            self.gc.bb = tuple(bb_min.tolist() + bb_max.tolist())
 
     def get_gcode(self):
         return self.gc
@@ -826,38 +1419,68 @@ class GCodeParser:
         else:
             return self.gc.original_vectors
 
+    def get_gcode_vectors_table(self):
+        gcv = self.get_gcode_vectors()
+        if isinstance(gcv, GcodePoints):
+            return gcv.vectors
+        return GCodeVectors.from_points(gcv)
+
+    def get_gcode_runs(self):
+        return self.get_gcode_vectors_table().get_runs()
+
     def get_bbox(self):
         return self.gc.bb
 
 
 class GCodeLeveler:
 
-    def __init__(self, gc, grid_data=None):
+    # interpolation of the height map: bilinear or bicubic spline
+    INTERP_KINDS = ('linear', 'cubic')
+    INTERP_ORDERS = (1, 3)
+    # subdivision of the segments: at the grid lines or where the height map
+    # deviates from the linear interpolation along the segment more than the tolerance
+    SUBDIV_MODES = ('grid', 'adaptive')
+    TOLERANCE_DEFAULT = 0.005
+    MIN_SUB_LEN = 0.1
+    MAX_SUB_DEPTH = 12
+
+    def __init__(self, gc, grid_data=None, kind='cubic', mode='grid', tolerance=TOLERANCE_DEFAULT):
         self.gc = gc
+        self.set_options(kind, mode, tolerance)
         if grid_data is not None:
             self.grid_data = grid_data
         else:
             self.grid_data = self.get_dummy_grid_data()
         self.grid_lines, self.grid_step = self.get_grid_lines()
         self.ig = None
+        # subdivided vectors without the heights, kept while the vectors
+        # and the grid geometry do not change
+        self.sub_vectors = None
+        self.sub_key = None
+
+    def set_options(self, kind='cubic', mode='grid', tolerance=TOLERANCE_DEFAULT):
+        self.kind = kind if kind in self.INTERP_KINDS else self.INTERP_KINDS[-1]
+        self.mode = mode if mode in self.SUBDIV_MODES else self.SUBDIV_MODES[0]
+        self.tolerance = tolerance
+
+    def set_grid_data(self, grid_data):
+        self.grid_data = grid_data
+        self.grid_lines, self.grid_step = self.get_grid_lines()
+        self.ig = None
+
+    def get_sub_key(self):
+        # the adaptive subdivision depends on the heights too
+        key = (self.gc.vectors, self.mode, self.grid_lines[0].tobytes(), self.grid_lines[1].tobytes())
+        if self.mode == 'adaptive':
+            key += (self.kind, self.tolerance, np.asarray(self.grid_data[2]).tobytes())
+        return key
 
     def get_grid_lines(self):
-        x = list(set(self.grid_data[0].ravel().tolist()))
-        x.sort()
-        y = list(set(self.grid_data[1].ravel().tolist()))
-        y.sort()
+        # coordinates of the x and y lines of the probe grid
+        x, y, zg = self.get_grid_axes()
         x_step = abs(x[1] - x[0])
         y_step = abs(y[1] - y[0])
-        x_min = min(x)
-        x_max = max(x)
-        y_min = min(y)
-        y_max = max(y)
-        vectors = []
-        for yc in y:
-            vectors.append(LineString(((x_min, yc), (x_max, yc))))
-        for xc in x:
-            vectors.append(LineString(((xc, y_min), (xc, y_max))))
-        return vectors, (x_step, y_step)
+        return (x, y), (x_step, y_step)
 
     def get_dummy_grid_data(self):
         grid_steps = 10
@@ -879,27 +1502,55 @@ class GCodeLeveler:
                 Y += y_min
                 return X, Y, Z
 
-    def get_grid_data(self, probe_results, steps, last_probe, wco_offset=(0, 0, 0)):
+    @staticmethod
+    def get_grid_data(probe_results, steps, last_probe, wco_offset=(0, 0, 0)):
         x, y, z = zip(*probe_results)
         X = np.array(x).reshape(steps[0], steps[1]) - wco_offset[0]
         Y = np.array(y).reshape(steps[0], steps[1]) - wco_offset[1]
         Z = np.array(z).reshape(steps[0], steps[1]) - last_probe[2]
         return X, Y, Z
 
+    def get_grid_axes(self):
+        # probe grid as x, y axes and the Z matrix indexed [x, y]
+        X, Y, Z = (np.asarray(a, dtype=float).ravel() for a in self.grid_data)
+        # the probed coordinates are grouped by lines, rounded as the G-code
+        x, jx, ix = np.unique(np.round(X, GCoder.DIGITS), return_index=True, return_inverse=True)
+        y, jy, iy = np.unique(np.round(Y, GCoder.DIGITS), return_index=True, return_inverse=True)
+        x = X[jx]
+        y = Y[jy]
+        zg = np.full((len(x), len(y)), np.nan)
+        zg[ix, iy] = Z
+        return x, y, zg
+
     def interp_grid_data(self):
         if self.grid_data is not None:
-            X, Y, Z = self.grid_data
-            self.ig = spi.interp2d(X, Y, Z, kind='cubic')
+            x, y, zg = self.get_grid_axes()
+            if len(x) < 2 or len(y) < 2 or np.isnan(zg).any():
+                print("ABL grid is not complete")
+                return
+            # bicubic needs at least 4 probes per axis, otherwise bilinear
+            order = self.INTERP_ORDERS[self.INTERP_KINDS.index(self.kind)]
+            kx = min(order, len(x) - 1)
+            ky = min(order, len(y) - 1)
+            spline = spi.RectBivariateSpline(x, y, zg, kx=kx, ky=ky, s=0)
+            x_lim = (x[0], x[-1])
+            y_lim = (y[0], y[-1])
+
+            def ig(xp, yp):
+                # outside the probed area the value at the border is kept
+                return spline.ev(np.clip(xp, *x_lim), np.clip(yp, *y_lim))
+
+            self.ig = ig
 
     def apply(self):
         print("Auto Bed Leveler Start")
         if self.gc is not None and self.ig is not None:
-            mvl = []
-            for p in self.gc.original_vectors:
-                cnp = p.copy()
-                delta = self.ig(cnp.coords[0], cnp.coords[1])
-                cnp.coords[2] += delta
-                mvl.append(cnp)
+            vec = self.gc.vectors
+            mvec = GCodeVectors(len(vec))
+            for k in GCodeVectors.FIELDS:
+                setattr(mvec, k, getattr(vec, k).copy())
+            mvec.points[:, 2] += self.ig(vec.points[:, 0], vec.points[:, 1])
+            self.gc.modified_vectors = GcodePoints(mvec)
         print("Auto Bed Leveler Stop")
 
     def apply_abl(self):
@@ -913,42 +1564,21 @@ class GCodeLeveler:
         if self.gc is not None and self.ig is not None:
             ta = time.time()
             print("Advanced Auto Bed Leveler Start")
-            mvl = []
-            pre_pc = None
-            min_step = min(self.grid_step)
-            print("Min Step ", min_step)
-            for p in self.gc.original_vectors:
-                np_l = []
-                nwp = p.copy()
-                delta = self.ig(nwp.coords[0], nwp.coords[1])
-                nwp.coords[2] += delta
-                if pre_pc is not None:
-                    pc = np.array(nwp.coords[:2])
-                    seg_len = np.linalg.norm(pc - pre_pc)
-                    sub_line = 0
-                    if seg_len <= min_step and seg_len > 0.1:
-                        i_l = self.get_grid_intersection(pc, pre_pc)
-                        if i_l:
-                            for i in i_l:
-                                x = i.xy[0][0]
-                                y = i.xy[1][0]
-                                # if intersection differ from segment vertex
-                                if (x != pc[0] and y != pc[1]) or (x != pre_pc[0] and y != pre_pc[1]):
-                                    nip = nwp.copy()
-                                    nip.coords[0] = x
-                                    nip.coords[1] = y
-                                    delta = self.ig(nip.coords[0], nip.coords[1])
-                                    nip.coords[2] += delta
-                                    nip.sub_line = sub_line
-                                    np_l.append(nip)
-                                    sub_line += 1
-                    nwp.sub_line = sub_line
-                    np_l.append(nwp)
-                else:
-                    np_l = [nwp]
-                mvl += np_l
-                pre_pc = np.array(p.coords[:2])
-            self.gc.modified_vectors = mvl
+            sub_key = self.get_sub_key()
+            if self.sub_vectors is None or sub_key != self.sub_key:
+                self.sub_vectors = self.get_sub_vectors()
+                self.sub_key = sub_key
+            else:
+                print("Subdivision unchanged")
+            sub = self.sub_vectors
+            mvec = GCodeVectors(len(sub))
+            for k in GCodeVectors.FIELDS:
+                setattr(mvec, k, getattr(sub, k))
+            mvec.params_table = sub.params_table
+            # only the heights change, evaluated once for all the points
+            mvec.points = sub.points.copy()
+            mvec.points[:, 2] += self.ig(sub.points[:, 0], sub.points[:, 1])
+            self.gc.modified_vectors = GcodePoints(mvec)
             print("Advanced Auto Bed Leveler Stop")
             tb = time.time()
             print("Done in " + "{:.3f}".format(tb-ta) + " sec")
@@ -956,15 +1586,111 @@ class GCodeLeveler:
         else:
             return False
 
-    def get_grid_intersection(self, a1, a2):
-        i_l = []
-        line1 = LineString([a1, a2])
-        for s in self.grid_lines:
-            line2 = s
-            i = line1.intersection(line2)
-            if i:
-                i_l.append(i)
-        return i_l
+    def get_sub_vectors(self):
+        vec = self.gc.vectors
+        seg_len = np.zeros((len(vec),))
+        seg_len[1:] = np.linalg.norm(np.diff(vec.points[:, :2], axis=0), axis=1)
+        if self.mode == 'adaptive':
+            print("Tolerance ", self.tolerance)
+            to_split = np.flatnonzero(seg_len >= 2 * self.MIN_SUB_LEN)
+            seg, t = self.get_adaptive_splits(vec.points, seg_len, to_split)
+        else:
+            min_step = min(self.grid_step)
+            print("Min Step ", min_step)
+            to_split = np.flatnonzero((seg_len <= min_step) & (seg_len > self.MIN_SUB_LEN))
+            seg, t = self.get_grid_crossings(vec.points, to_split)
+        print("Inserted points ", len(seg))
+        return self.subdivide(vec, seg, t)
+
+    def get_grid_crossings(self, points, segs):
+        # crossings of the segments ending in the points segs with the grid lines:
+        # segment index and parameter along the segment, sorted along each segment
+        seg_l = []
+        t_l = []
+        for axis in range(2):
+            lines = self.grid_lines[axis]
+            other = self.grid_lines[1 - axis]
+            a = points[segs - 1, axis]
+            b = points[segs, axis]
+            # grid lines strictly between the segment ends
+            lo = np.searchsorted(lines, np.minimum(a, b), side='right')
+            hi = np.searchsorted(lines, np.maximum(a, b), side='left')
+            count = np.maximum(hi - lo, 0)
+            seg = np.repeat(segs, count)
+            first = np.repeat(lo - np.cumsum(count) + count, count)
+            li = first + np.arange(len(seg))
+            a = np.repeat(a, count)
+            t = (lines[li] - a) / (np.repeat(b, count) - a)
+            # the grid lines end at the border of the probed area
+            c = points[seg - 1, 1 - axis] + t * (points[seg, 1 - axis] - points[seg - 1, 1 - axis])
+            inside = (c >= other[0]) & (c <= other[-1])
+            seg_l.append(seg[inside])
+            t_l.append(t[inside])
+        seg = np.concatenate(seg_l)
+        t = np.concatenate(t_l)
+        order = np.lexsort((t, seg))
+        seg = seg[order]
+        t = t[order]
+        # a grid node is crossed by both lines
+        keep = np.ones((len(seg),), dtype=bool)
+        keep[1:] = (seg[1:] != seg[:-1]) | (t[1:] - t[:-1] > 1e-9)
+        return seg[keep], t[keep]
+
+    def get_adaptive_splits(self, points, seg_len, segs):
+        # the pieces of the segments are halved while the height map at a quarter,
+        # the middle or three quarters of the piece is farther than the tolerance
+        # from the line joining the heights at its ends
+        seg_l = []
+        t_l = []
+        seg = segs
+        t0 = np.zeros((len(seg),))
+        t1 = np.ones((len(seg),))
+        for depth in range(self.MAX_SUB_DEPTH):
+            if not len(seg):
+                break
+            p0 = points[seg - 1, :2]
+            d = points[seg, :2] - p0
+            z0 = self.ig(*(p0 + t0[:, None] * d).T)
+            z1 = self.ig(*(p0 + t1[:, None] * d).T)
+            err = np.zeros((len(seg),))
+            for f in (0.25, 0.5, 0.75):
+                tf = t0 + f * (t1 - t0)
+                zf = self.ig(*(p0 + tf[:, None] * d).T)
+                err = np.maximum(err, np.abs(zf - (z0 + f * (z1 - z0))))
+            split = (err > self.tolerance) & (seg_len[seg] * (t1 - t0) >= 2 * self.MIN_SUB_LEN)
+            tm = 0.5 * (t0[split] + t1[split])
+            seg = seg[split]
+            seg_l.append(seg)
+            t_l.append(tm)
+            seg = np.concatenate((seg, seg))
+            t0, t1 = np.concatenate((t0[split], tm)), np.concatenate((tm, t1[split]))
+        seg = np.concatenate(seg_l) if seg_l else np.zeros((0,), dtype=int)
+        t = np.concatenate(t_l) if t_l else np.zeros((0,))
+        order = np.lexsort((t, seg))
+        return seg[order], t[order]
+
+    @staticmethod
+    def subdivide(vec, seg, t):
+        # vectors table with the points at parameters t inserted before the vectors seg,
+        # they take everything from the vector they precede
+        n = len(vec)
+        count = np.bincount(seg, minlength=n)
+        # position of each vector in the new table
+        v_idx = np.arange(n) + np.cumsum(count)
+        mvec = GCodeVectors(n + len(seg))
+        for k in GCodeVectors.FIELDS:
+            getattr(mvec, k)[v_idx] = getattr(vec, k)
+        mvec.params_table = vec.params_table
+        mvec.sub_lines[v_idx] = count
+        if len(seg):
+            s_idx = np.setdiff1d(np.arange(len(mvec)), v_idx, assume_unique=True)
+            for k in GCodeVectors.FIELDS:
+                getattr(mvec, k)[s_idx] = getattr(vec, k)[seg]
+            # seg is sorted, the points are numbered inside each segment
+            mvec.sub_lines[s_idx] = np.arange(len(seg)) - np.searchsorted(seg, seg)
+            p0 = vec.points[seg - 1]
+            mvec.points[s_idx] = p0 + t[:, None] * (vec.points[seg] - p0)
+        return mvec
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+
+import numpy as np
+from collections import OrderedDict as od
+from .gcode_manager import GcodePoint, GCodeProgram, GCodeRecords, GCodeVectors
+
+
+class GCodeRuntime:
+    """ Runtime estimation of a G-code program simulating the GRBL planner:
+        max rates and accelerations of each axis, junction deviation at the
+        corners and trapezoidal speed profiles over the vectorized program.
+        The machine settings are the GRBL $ settings read from the controller.
+        The timestamps are given for the lines generated by the recode,
+        so they can be used for the progress while the file is sent. """
+
+    # GRBL settings: $11 junction deviation [mm], $110-$112 max rates [mm/min],
+    # $120-$122 accelerations [mm/s^2]
+    JUNCTION_DEVIATION = 11
+    MAX_RATES = (110, 111, 112)
+    ACCELERATIONS = (120, 121, 122)
+    SETTINGS_DEFAULT = od({11: 0.010, 110: 500.0, 111: 500.0, 112: 500.0, 120: 10.0, 121: 10.0, 122: 10.0})
+
+    # dwell command (G4 P seconds)
+    DWELL_CODE = ('g', 4)
+    # commands executed with the planner empty: the motion stops before them
+    # (dwell, pauses, program end, spindle and tool changes)
+    STOP_CODES = (('g', 4), ('m', 0), ('m', 1), ('m', 2), ('m', 3), ('m', 4), ('m', 5), ('m', 6), ('m', 30))
+    # minimum speed at the junctions [mm/s]
+    MIN_JUNCTION_SPEED = 0.0
+
+    def __init__(self, grbl_settings=None):
+        self.settings_od = od(self.SETTINGS_DEFAULT)
+        if grbl_settings:
+            for k in self.settings_od.keys():
+                if k in grbl_settings.keys():
+                    self.settings_od[k] = float(grbl_settings[k])
+        # end time of each recoded line [s]
+        self.line_times = np.zeros((0,))
+        self.total_time = 0.0
+
+    def get_axes_limits(self):
+        max_rates = np.array([self.settings_od[k] for k in self.MAX_RATES]) / 60.0
+        accels = np.array([self.settings_od[k] for k in self.ACCELERATIONS])
+        return max_rates, accels
+
+    @staticmethod
+    def limit_by_axes(unit, limits):
+        # the largest value along the unit vectors not exceeding the limit of any axis
+        with np.errstate(divide='ignore'):
+            ratio = np.where(np.abs(unit) > 0, limits / np.abs(unit), np.inf)
+        return ratio.min(axis=1)
+
+    def get_junction_speeds(self, unit, accel, speed, stops=None):
+        # GRBL junction deviation: the speed that keeps the centripetal
+        # acceleration within the limit on a circle tangent to both segments
+        n = len(unit)
+        vj = np.zeros((n + 1,))
+        if n > 1:
+            cos_theta = -np.einsum('ij,ij->i', unit[:-1], unit[1:])
+            cos_theta = np.clip(cos_theta, -1.0, 1.0)
+            sin_half = np.sqrt(0.5 * (1.0 - cos_theta))
+            a = np.minimum(accel[:-1], accel[1:])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vj2 = a * self.settings_od[self.JUNCTION_DEVIATION] * sin_half / (1.0 - sin_half)
+            # straight junctions are not limited, reversals stop the motion
+            vj2 = np.where(cos_theta < -0.999999, np.inf, vj2)
+            vj2 = np.where(cos_theta > 0.999999, self.MIN_JUNCTION_SPEED ** 2, vj2)
+            vj[1:-1] = np.minimum(np.sqrt(vj2), np.minimum(speed[:-1], speed[1:]))
+            if stops is not None:
+                vj[1:-1][stops] = 0.0
+        return vj
+
+    @staticmethod
+    def plan_speeds(length, accel, vj):
+        # entry speeds of the segments (and exit of the last one) with full look ahead
+        v = vj.copy()
+        n = len(length)
+        for i in range(n - 1, -1, -1):
+            v[i] = min(v[i], np.sqrt(v[i + 1] * v[i + 1] + 2.0 * accel[i] * length[i]))
+        for i in range(n):
+            v[i + 1] = min(v[i + 1], np.sqrt(v[i] * v[i] + 2.0 * accel[i] * length[i]))
+        return v
+
+    @staticmethod
+    def get_segment_times(length, accel, speed, v0, v1):
+        # trapezoidal (or triangular) speed profiles
+        d_acc = (speed * speed - v0 * v0) / (2.0 * accel)
+        d_dec = (speed * speed - v1 * v1) / (2.0 * accel)
+        cruise = d_acc + d_dec <= length
+        vp = np.sqrt(np.maximum((2.0 * accel * length + v0 * v0 + v1 * v1) / 2.0, 0.0))
+        vp = np.where(cruise, speed, np.minimum(vp, speed))
+        t = (vp - v0) / accel + (vp - v1) / accel
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_cruise = np.where(cruise, (length - d_acc - d_dec) / speed, 0.0)
+        return t + t_cruise
+
+    def get_move_times(self, vec, feeds, stop_after=None):
+        # time of the move reaching each vector, the first vector is the origin,
+        # stop_after marks the vectors followed by a command stopping the motion
+        times = np.zeros((len(vec),))
+        if len(vec) < 2:
+            return times
+        d = np.diff(vec.points, axis=0)
+        length = np.linalg.norm(d, axis=1)
+        moving = np.flatnonzero(length > 0)
+        if not len(moving):
+            return times
+        length = length[moving]
+        unit = d[moving] / length[:, None]
+        max_rates, accels = self.get_axes_limits()
+        rate_limit = self.limit_by_axes(unit, max_rates)
+        accel = self.limit_by_axes(unit, accels)
+        travel = vec.types[1:][moving] == GCodeVectors.TYPE_CODES.index(GcodePoint.TRAVEL)
+        feed = feeds[1:][moving] / 60.0
+        feed = np.where(np.isnan(feed) | (feed <= 0), rate_limit, feed)
+        speed = np.where(travel, rate_limit, np.minimum(feed, rate_limit))
+
+        stops = None
+        if stop_after is not None and len(moving) > 1:
+            # a stop between the end of a move and the start of the next one
+            stop_cum = np.cumsum(stop_after)
+            stops = stop_cum[moving[1:]] > stop_cum[moving[:-1]]
+        vj = self.get_junction_speeds(unit, accel, speed, stops)
+        v = self.plan_speeds(length, accel, vj)
+        times[1:][moving] = self.get_segment_times(length, accel, speed, v[:-1], v[1:])
+        return times
+
+    def estimate(self, gcp):
+        """ Timestamps of the lines generated by the parser recode. """
+        rec = gcp.get_gcode().records
+        vec = gcp.get_gcode_vectors_table()
+        f_col = GCodeRecords.PARAM_TAG.index('f')
+        p_col = GCodeRecords.PARAM_TAG.index('p')
+        feeds = GCodeProgram.get_modal_values(rec.params[:, f_col], vec.lines)
+        # in any command of the line (T1 M6)
+        stop_rec = np.zeros((len(rec),), dtype=bool)
+        for sc in self.STOP_CODES:
+            stop_rec |= np.any((rec.cmd_letter == ord(sc[0])) & (rec.cmd_code == sc[1] * 10), axis=1)
+        stop_after = np.zeros((len(vec),), dtype=bool)
+        stop_after[np.searchsorted(vec.lines, np.flatnonzero(stop_rec), side='right') - 1] = True
+        move_t = self.get_move_times(vec, feeds, stop_after)
+
+        dc = self.DWELL_CODE
+        dwell = (rec.cmd_letter[:, 0] == ord(dc[0])) & (rec.cmd_code[:, 0] == dc[1] * 10)
+        dwell_t = np.where(dwell, np.nan_to_num(rec.params[:, p_col]), 0.0)
+        dwell_cum = np.cumsum(dwell_t)
+
+        v_lines = vec.lines[1:]
+        cum_move = np.cumsum(move_t[1:])
+        # end time of the vectors, and of the records generating a single line
+        v_end = cum_move + dwell_cum[v_lines]
+        has_cmd = (rec.cmd_letter[:, 0] != 0) | rec.complex
+        has_cmd[v_lines] = False
+        cmd_recs = np.flatnonzero(has_cmd)
+        # a record without vectors ends with the last vector before it
+        last_v = np.searchsorted(v_lines, cmd_recs, side='right')
+        r_end = np.concatenate(([0.0], cum_move))[last_v] + dwell_cum[cmd_recs]
+
+        # same order of the recode: by record, the vectors of a record in sequence
+        o_rec = np.concatenate((v_lines, cmd_recs))
+        o_time = np.concatenate((v_end, r_end))
+        self.line_times = o_time[np.argsort(o_rec, kind='stable')]
+        self.total_time = float(self.line_times[-1]) if len(self.line_times) else 0.0
+        return self.line_times
+
+    def get_time_at(self, line):
+        # elapsed time when the first line lines have been executed
+        if line <= 0 or not len(self.line_times):
+            return 0.0
+        return float(self.line_times[min(line, len(self.line_times)) - 1])
+
+    def get_progress(self, line):
+        if self.total_time <= 0:
+            return 0.0
+        return self.get_time_at(line) / self.total_time * 100
+
+    def get_eta(self, line):
+        return self.total_time - self.get_time_at(line)
@@ -0,0 +1,138 @@
+
+import sys
+import numpy as np
+from collections import OrderedDict as od
+from .gcode_manager import GcodePoint, GCodeParser, GCodeProgram, GCodeRecords, GCodeVectors
+from .gcode_runtime import GCodeRuntime
+
+
+class GCodeStats:
+    """ Statistics of a G-code program: bounding box, cut and rapid
+        lengths, time spent at each feed rate, tool changes and lines.
+        Everything is computed with numpy over the records and vectors
+        tables, no line or point objects are created, so it can be used
+        to plan a queue of jobs without the user interface. """
+
+    # rapid rate used for the travel moves [mm/min], the GRBL default max rate
+    RAPID_RATE_DEFAULT = GCodeRuntime.SETTINGS_DEFAULT[GCodeRuntime.MAX_RATES[0]]
+    TOOL_CHANGE_CODE = ('m', 6)
+
+    def __init__(self, rapid_rate=RAPID_RATE_DEFAULT):
+        self.rapid_rate = rapid_rate
+        self.line_count = 0
+        self.record_count = 0
+        self.vector_count = 0
+        self.bb = None
+        self.cut_length = 0.0
+        self.rapid_length = 0.0
+        # feed rate: (length, minutes) of the working moves
+        self.feeds_od = od({})
+        # working moves before any feed rate
+        self.no_feed_length = 0.0
+        self.tool_changes = 0
+
+    @classmethod
+    def get_rapid_rate(cls, grbl_settings=None):
+        # the slowest of the X and Y max rates ($110, $111) read from the controller,
+        # as the runtime estimate does for the travel moves
+        rates = [float(grbl_settings[k]) for k in GCodeRuntime.MAX_RATES[:2]
+                 if grbl_settings and grbl_settings.get(k, 0) > 0]
+        return min(rates) if rates else cls.RAPID_RATE_DEFAULT
+
+    @classmethod
+    def from_gcode(cls, gc, rapid_rate=RAPID_RATE_DEFAULT):
+        st = cls(rapid_rate)
+        rec = gc.records
+        vec = gc.vectors
+        st.line_count = len(gc.original_lines)
+        st.record_count = len(rec)
+        st.vector_count = max(len(vec) - 1, 0)
+        st.bb = gc.bb
+
+        # M6 in any command of the line (T1 M6, M5 M6)
+        ct = cls.TOOL_CHANGE_CODE
+        st.tool_changes = int(np.count_nonzero(np.any((rec.cmd_letter == ord(ct[0])) & (rec.cmd_code == ct[1] * 10),
+                                                      axis=1)))
+
+        if len(vec) > 1:
+            # each segment takes the type and the feed rate of the vector it reaches
+            seg_len = np.linalg.norm(np.diff(vec.points, axis=0), axis=1)
+            travel = vec.types[1:] == GCodeVectors.TYPE_CODES.index(GcodePoint.TRAVEL)
+            feeds = GCodeProgram.get_modal_values(rec.params[:, GCodeRecords.PARAM_TAG.index('f')], vec.lines)[1:]
+            st.rapid_length = float(seg_len[travel].sum())
+            st.cut_length = float(seg_len[~travel].sum())
+
+            cut_feeds = feeds[~travel]
+            cut_len = seg_len[~travel]
+            known = ~np.isnan(cut_feeds) & (cut_feeds > 0)
+            st.no_feed_length = float(cut_len[~known].sum())
+            if np.any(known):
+                f_values, f_idx = np.unique(cut_feeds[known], return_inverse=True)
+                f_len = np.bincount(f_idx, weights=cut_len[known], minlength=len(f_values))
+                for f, l in zip(f_values.tolist(), f_len.tolist()):
+                    st.feeds_od[f] = (l, l / f)
+        return st
+
+    @classmethod
+    def from_file(cls, gcode_path, rapid_rate=RAPID_RATE_DEFAULT):
+        gcp = GCodeParser(None)
+        gcp.load_gcode_file(gcode_path)
+        if gcp.get_gcode() is None:
+            return None
+        gcp.interp()
+        gcp.vectorize()
+        st = cls.from_gcode(gcp.get_gcode(), rapid_rate)
+        gcp.release_gcode_file()
+        return st
+
+    def get_rapid_time(self):
+        return self.rapid_length / self.rapid_rate
+
+    def get_cut_time(self):
+        return sum(t for l, t in self.feeds_od.values())
+
+    def get_time(self):
+        # minutes, without accelerations
+        return self.get_cut_time() + self.get_rapid_time()
+
+    def get_report(self):
+        r = od({})
+        r["lines"] = self.line_count
+        r["records"] = self.record_count
+        r["vectors"] = self.vector_count
+        r["bbox"] = self.bb
+        r["z_range"] = (self.bb[2], self.bb[5]) if self.bb is not None else None
+        r["cut_length"] = self.cut_length
+        r["rapid_length"] = self.rapid_length
+        r["feeds"] = od((f, od((("length", l), ("time", t)))) for f, (l, t) in self.feeds_od.items())
+        r["no_feed_length"] = self.no_feed_length
+        r["tool_changes"] = self.tool_changes
+        r["cut_time"] = self.get_cut_time()
+        r["rapid_time"] = self.get_rapid_time()
+        r["time"] = self.get_time()
+        return r
+
+    def __repr__(self):
+        s = "GCodeStats (\n"
+        s += " lines = " + str(self.line_count) + "\n"
+        if self.bb is not None:
+            s += " bbox = " + ", ".join("{:.3f}".format(b) for b in self.bb) + "\n"
+        s += " cut = {:.1f} mm, rapid = {:.1f} mm\n".format(self.cut_length, self.rapid_length)
+        for f, (l, t) in self.feeds_od.items():
+            s += "  F{:g}: {:.1f} mm, {:.2f} min\n".format(f, l, t)
+        s += " tool changes = " + str(self.tool_changes) + "\n"
+        s += " time = {:.2f} min\n".format(self.get_time())
+        s += ")\n"
+        return s
+
+
+if __name__ == "__main__":
+    # python -m shape_core.gcode_stats file.gcode [file.gcode ...]
+    tot = 0.0
+    for path in sys.argv[1:]:
+        stats = GCodeStats.from_file(path)
+        if stats is not None:
+            print(path)
+            print(stats)
+            tot += stats.get_time()
+    print("Total time: {:.2f} min".format(tot))
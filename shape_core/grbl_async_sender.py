@@ -0,0 +1,260 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import numpy as np
+from collections import OrderedDict as od
+from .gcode_manager import GCoder
+from .grbl_sender import GrblSender
+
+# configuration folder of the application
+SETTINGS_FOLDER = os.path.normpath(os.path.join(os.path.dirname(__file__), "../configurations"))
+
+
+def open_serial(path, baud_rate=115200):
+    """ Raw non blocking file descriptor of a serial device or pty (POSIX). """
+    import termios
+    import tty
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    tty.setraw(fd)
+    attrs = termios.tcgetattr(fd)
+    speed = getattr(termios, "B" + str(baud_rate), None)
+    if speed is not None:
+        attrs[4] = attrs[5] = speed
+    attrs[2] |= termios.CLOCAL | termios.CREAD
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    termios.tcflush(fd, termios.TCIOFLUSH)
+    return fd
+
+
+class AsyncGrblSender:
+    """ Asyncio runner of a GrblSender on a file descriptor: it writes the
+        lines, reads the responses, polls the status and keeps what the
+        macros need. Used by the command line to run the jobs headless.
+        An alarm or a controller that stops answering aborts the job, a
+        program pause (M0) is resumed when wait_resume returns and aborts
+        the job when there is no wait_resume. """
+
+    POLL_INTERVAL = 0.12
+    WELCOME_TIMEOUT = 3.0
+    RESPONSE_TIMEOUT = 10.0
+    SPLITPAT = re.compile(r"[:,|]")
+
+    def __init__(self, fd, sender=None, verbose=False, wait_resume=None):
+        self.fd = fd
+        self.sender = sender if sender is not None else GrblSender()
+        self.sender.get_macro_data = lambda: (self.workspace_params_od, self.prb_val)
+        self.sender.get_freeze_dro = lambda: {"WPO": self.mpos_a - self.wco_a, "MPO": self.mpos_a.copy()}
+        self.verbose = verbose
+        # coroutine function returning when a paused program can go on
+        self.wait_resume = wait_resume
+        self.hold = False
+        self.resume_task = None
+        self.rx_buffer = bytearray()
+        self.tx_buffer = bytearray()
+        self.loop = None
+        self.sending = False
+        self.welcome = None
+        self.acked = None
+        self.done = None
+        self.rx_time = None
+        # machine data, from the responses
+        self.mpos_a = np.zeros(3)
+        self.wco_a = np.zeros(3)
+        self.prb_val = [[-1.0, -1.0, -1.0], [-1.0, -1.0, -1.0]]
+        self.workspace_params_od = od({})
+
+    def write(self, data):
+        self.tx_buffer += data
+        self.flush()
+
+    def flush(self):
+        try:
+            written = os.write(self.fd, self.tx_buffer) if self.tx_buffer else 0
+        except BlockingIOError:
+            written = 0
+        del self.tx_buffer[:written]
+        if self.tx_buffer:
+            self.loop.add_writer(self.fd, self.on_writable)
+
+    def on_writable(self):
+        self.loop.remove_writer(self.fd)
+        self.flush()
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.rx_time = time.perf_counter()
+        self.rx_buffer += data
+        start = 0
+        end = self.rx_buffer.find(b"\n")
+        with memoryview(self.rx_buffer) as mv:
+            while end >= 0:
+                self.on_line(str(mv[start:end + 1], "utf-8", "replace"))
+                start = end + 1
+                end = self.rx_buffer.find(b"\n", start)
+        del self.rx_buffer[:start]
+        if self.sending:
+            self.send_lines()
+
+    def abort(self, reason):
+        self.sender.abort(reason)
+        if self.done is not None:
+            self.done.set()
+
+    def on_line(self, element):
+        kind = self.sender.get_kind(element)
+        if self.verbose and kind != "status":
+            print(element.rstrip())
+        if kind in ("ok", "error"):
+            self.sender.ack(kind == "error")
+            if self.acked is not None and not self.sender.commands_pending:
+                self.acked.set()
+            if kind == "error" and not self.verbose:
+                print(element.rstrip())
+        elif kind == "status":
+            self.parse_status(element)
+        elif kind == "message":
+            self.parse_message(element)
+        elif element.startswith("ALARM"):
+            # the controller has stopped and dropped its buffer
+            if self.sending:
+                self.abort(element.strip())
+        elif element.startswith("Grbl ") and self.welcome is not None:
+            self.welcome.set()
+
+    def parse_status(self, element):
+        planner_free = rx_free = None
+        fields = element.strip()[1:-1].split("|")
+        self.on_state(fields[0])
+        for field in fields[1:]:
+            word = self.SPLITPAT.split(field)
+            try:
+                if word[0] == "MPos":
+                    self.mpos_a = np.array([float(w) for w in word[1:4]])
+                elif word[0] == "WCO":
+                    self.wco_a = np.array([float(w) for w in word[1:4]])
+                elif word[0] == "Bf":
+                    planner_free, rx_free = int(word[1]), int(word[2])
+            except (ValueError, IndexError):
+                pass
+        self.sender.streamer.set_status(planner_free, rx_free)
+
+    def parse_message(self, element):
+        word = self.SPLITPAT.split(element.strip()[1:-1])
+        try:
+            if word[0] == "PRB":
+                self.prb_val = [[float(w) for w in word[1:4]], self.prb_val[0]]
+            elif word[0] in ("G54", "G55", "G56", "G57", "G58", "G59", "G28", "G30", "G92"):
+                self.workspace_params_od[word[0]] = np.array([float(w) for w in word[1:4]])
+            elif word[0] == "TLO":
+                self.workspace_params_od["TLO"] = float(word[1])
+            elif word[0] == "OPT":
+                self.sender.streamer.set_buffer_sizes(int(word[3]), int(word[2]))
+        except (ValueError, IndexError):
+            pass
+
+    def on_state(self, state):
+        if not state.startswith("Hold"):
+            self.hold = False
+            return
+        if self.hold or not self.sending:
+            return
+        self.hold = True
+        if self.wait_resume is None:
+            self.abort("program paused (" + state + "), nobody to resume it")
+        elif self.resume_task is None:
+            self.resume_task = asyncio.ensure_future(self.resume())
+
+    async def resume(self):
+        try:
+            await self.wait_resume()
+            # cycle start, realtime command
+            self.write(b"~")
+        finally:
+            self.resume_task = None
+
+    def send_lines(self):
+        lines = self.sender.fill()
+        if lines:
+            self.write("".join(lines).encode("utf-8"))
+        if self.sender.is_done():
+            self.done.set()
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            if time.perf_counter() - self.rx_time > self.RESPONSE_TIMEOUT:
+                self.abort("no response from the controller in " + str(self.RESPONSE_TIMEOUT) + " s")
+            self.sender.streamer.on_poll()
+            self.write(b"?")
+
+    async def run(self, lines, mode="counting", timeout=None):
+        """ Send the lines, returns the throughput statistics.
+            The job is aborted when it takes more than timeout seconds. """
+        self.loop = asyncio.get_running_loop()
+        self.welcome = asyncio.Event()
+        self.acked = asyncio.Event()
+        self.done = asyncio.Event()
+        self.loop.add_reader(self.fd, self.on_readable)
+        poll_task = None
+        try:
+            # opening the port resets most boards, wait for the welcome message
+            try:
+                await asyncio.wait_for(self.welcome.wait(), self.WELCOME_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            # the build options give the buffer sizes, a late reply is not taken for a job ack
+            self.sender.send_command("$I\n")
+            self.write("".join(self.sender.fill()).encode("utf-8"))
+            try:
+                await asyncio.wait_for(self.acked.wait(), self.WELCOME_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self.acked = None
+            self.sender.streamer.set_mode(mode)
+            self.sender.streamer.reset_status()
+            poll_task = asyncio.ensure_future(self.poll())
+            self.sender.start(lines)
+            self.sending = True
+            self.rx_time = time.perf_counter()
+            self.send_lines()
+            try:
+                await asyncio.wait_for(self.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.abort("timeout, the job has not ended in " + str(timeout) + " s")
+        finally:
+            self.sending = False
+            if poll_task is not None:
+                poll_task.cancel()
+            if self.resume_task is not None:
+                self.resume_task.cancel()
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+        return self.sender.get_stats()
+
+
+def read_gcode_lines(path):
+    with open(path) as f:
+        return [line.strip() + "\n" for line in f if line.strip()]
+
+
+def load_commander(config_folder):
+    """ Commander with the machine configuration of the application,
+        None when the configuration has never been saved. """
+    from settings_manager.settings_machine import MachineSettingsHandler
+    machine_sets = MachineSettingsHandler(config_folder, None)
+    if not os.path.isfile(machine_sets.machine_config_path):
+        return None
+    machine_sets.read_all_machine_settings()
+    gcr = GCoder("dummy", "commander")
+    gcr.load_cfg(machine_sets.get_macro_cfg())
+    return gcr
+
+
+async def wait_enter():
+    print("Program paused: press Enter to resume")
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
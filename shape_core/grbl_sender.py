@@ -0,0 +1,228 @@
+import re
+import time
+import itertools
+from collections import OrderedDict as od, deque
+from .gcode_manager import GCodeMacro, GCoder
+from .grbl_streamer import GrblStreamer
+
+
+class GrblSender:
+    """ Streaming of a G-code job to GRBL, without any user interface:
+        the buffer accounting, the lines of the file and of the macros they
+        start, the progress and the end of the file. The owner writes the
+        lines returned by fill and calls ack for each ok or error, the
+        machine data needed by the macros is taken with get_macro_data
+        (workspace parameters, probe data) and get_freeze_dro.
+        The macros are expanded with gcr, the commander loaded with the
+        machine configuration: without it a job calling a macro is aborted. """
+
+    # kind of the received lines, the name of the matching group selects the handler
+    RX_PAT = re.compile(r"^(?:(?P<status><.*>)|(?P<message>\[.*\])|(?P<ok>ok)|(?P<error>.*(?i:error).*))\s*$")
+
+    def __init__(self, rx_buffer_size=GrblStreamer.RX_BUFFER_SIZE, gcr=None):
+        self.streamer = GrblStreamer(rx_buffer_size)
+        self.gcr = gcr
+        self.get_macro_data = lambda: (od({}), None)
+        self.get_freeze_dro = lambda: None
+
+        self.file_content = iter([])
+        self.content_line = 0
+        self.tot_lines = 0
+        # all the lines have been taken from the file content
+        self.end_of_content = True
+        # line of the file waiting for the previous ones to be executed (macro)
+        self.wait_line = None
+        self.wait_tag_decoding = False
+        self.macro_on = False
+        self.macro_obj = None
+        # estimated runtime of the file, the progress is based on the time when available
+        self.runtime = None
+        self.errors = 0
+        self.start_time = None
+        self.end_time = None
+        # bytes sent before the job, the count goes on for the status reports
+        self.start_bytes = 0
+        # why the job has been stopped before its end
+        self.abort_reason = None
+        # commands sent outside the jobs, counted in the buffer like the lines of a job
+        self.commands = deque()
+        # commands sent and still waiting for their ok
+        self.commands_pending = 0
+
+    @classmethod
+    def get_kind(cls, element):
+        m = cls.RX_PAT.match(element)
+        return m.lastgroup if m is not None else None
+
+    def start(self, lines, runtime=None):
+        # lines can be a list or a GCodeStream, generating the lines while they are sent
+        self.file_content = iter(lines)
+        self.runtime = runtime if runtime is not None and len(runtime.line_times) == len(lines) else None
+        if self.commands_pending:
+            # the ok of a command is still to come, its room in the buffer is kept
+            self.streamer.reset_counters()
+        else:
+            self.streamer.reset()
+        self.content_line = 0
+        self.tot_lines = len(lines)
+        self.end_of_content = False
+        self.wait_line = None
+        self.wait_tag_decoding = False
+        self.macro_on = False
+        self.macro_obj = None
+        self.errors = 0
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.start_bytes = self.streamer.bytes_sent
+        self.abort_reason = None
+
+    def extend(self, lines):
+        # more lines queued after the ones of the job
+        self.file_content = itertools.chain(self.file_content, lines)
+        self.tot_lines += len(lines)
+        self.end_of_content = False
+        self.end_time = None
+
+    def send_command(self, cmd):
+        # a command that is not part of a job (e.g. $I): its ok is not taken for the one of a job line,
+        # it is written by the next fill
+        self.commands.append(cmd)
+
+    def drop(self):
+        self.file_content = iter([])
+        self.streamer.flush()
+        self.commands.clear()
+        self.commands_pending = 0
+        self.end_of_content = True
+        self.wait_line = None
+        self.wait_tag_decoding = False
+        self.macro_on = False
+        self.macro_obj = None
+
+    def stop(self):
+        self.drop()
+        self.streamer.reset()
+        self.tot_lines = 0
+        self.runtime = None
+
+    def abort(self, reason):
+        # nothing more is sent, the lines in the controller buffer are lost or left to run,
+        # the counters are kept for the statistics
+        self.drop()
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+        if self.abort_reason is None:
+            self.abort_reason = reason
+
+    def fill(self):
+        """ Lines to write now, all the ones fitting the controller buffer. """
+        return self.streamer.fill(self.get_next_line)
+
+    def ack(self, error=False):
+        """ An ok or an error: the oldest line has left the buffer. """
+        if not self.streamer.ack():
+            return False
+        if self.commands_pending:
+            # the commands sent before the job are the oldest lines
+            self.commands_pending -= 1
+            return True
+        if error:
+            self.errors += 1
+        if self.is_done() and self.end_time is None:
+            self.end_time = time.perf_counter()
+        return True
+
+    def is_end_of_file(self):
+        # all the lines have been sent
+        return self.end_of_content and not self.macro_on and self.wait_line is None and \
+            self.streamer.next_line is None and not self.commands
+
+    def is_done(self):
+        # and acknowledged
+        return self.is_end_of_file() and self.streamer.get_pending() == 0
+
+    def get_next_line(self):
+        # next line to send, None to wait for the acks
+        if self.commands:
+            self.commands_pending += 1
+            return self.commands.popleft()
+        if self.macro_on:
+            if self.streamer.get_pending():
+                # each macro line is computed on the result of the previous one
+                return None
+            wsp, probe_data = self.get_macro_data()
+            cmd_to_send = self.macro_obj.get_next_line(wsp, probe_data)
+            if cmd_to_send is not None:
+                return cmd_to_send
+            self.macro_on = False
+            self.macro_obj = None
+            self.tot_lines -= 1
+
+        if self.wait_line is None:
+            self.wait_line = next(self.file_content, None)
+            if self.wait_line is None:
+                self.end_of_content = True
+                return None
+            self.content_line += 1
+
+        cmd_to_send = self.macro_check(self.wait_line)
+        if self.wait_tag_decoding:
+            return None
+        self.wait_line = None
+        return cmd_to_send
+
+    @staticmethod
+    def is_macro(cmd):
+        return cmd.strip().upper() == GCoder.CHANGE_TOOL_COMMAND
+
+    def find_macro(self, lines):
+        # first line calling a macro that cannot be expanded, None if the lines can be sent
+        if self.gcr is not None:
+            return None
+        return next((i for i, line in enumerate(lines) if self.is_macro(line)), None)
+
+    def macro_check(self, cmd_to_send):
+        ret_cmd_to_send = cmd_to_send
+
+        if self.gcr is None:
+            if self.is_macro(cmd_to_send):
+                self.abort("macro " + cmd_to_send.strip() + " without the machine configuration")
+                return None
+        elif self.gcr.is_macro(cmd_to_send):
+            macro_type = cmd_to_send.strip()
+            if self.streamer.get_pending():
+                # wait that the machine execute all previous lines
+                # to be able to decode the tag
+                self.wait_tag_decoding = True
+            else:
+                # machine execution queue is empty, let's go
+                self.wait_tag_decoding = False
+                self.macro_obj = GCodeMacro(self.get_freeze_dro(), macro_type, self.gcr)
+                ret_cmd_to_send = "$#\n"
+                self.tot_lines += 1
+                self.macro_on = True
+        return ret_cmd_to_send
+
+    def get_progress(self):
+        if self.runtime is not None and self.runtime.total_time > 0:
+            return self.runtime.get_progress(self.content_line)
+        return (self.content_line / self.tot_lines) * 100 if self.tot_lines else 100.0
+
+    def get_eta(self):
+        # (total, remaining) estimated seconds of the job, None without the runtime estimate
+        if self.runtime is None or self.runtime.total_time <= 0:
+            return None
+        return self.runtime.total_time, self.runtime.get_eta(self.content_line)
+
+    def get_stats(self):
+        st = od({})
+        st["lines"] = self.streamer.sent_lines
+        st["bytes"] = self.streamer.bytes_sent - self.start_bytes
+        st["errors"] = self.errors
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        st["time"] = end_time - self.start_time if self.start_time is not None else 0.0
+        st["lines_s"] = st["lines"] / st["time"] if st["time"] > 0 else 0.0
+        st["bytes_s"] = st["bytes"] / st["time"] if st["time"] > 0 else 0.0
+        st["planner_empty_reports"] = self.streamer.starved_reports
+        st["aborted"] = self.abort_reason
+        return st
@@ -0,0 +1,127 @@
+
+from collections import deque
+
+
+class GrblStreamer:
+    """ Character counting streaming of the G-code lines to GRBL: the lines
+        are sent as long as they fit the RX buffer of the controller and
+        every ok (or error) frees the room of the oldest line in it.
+        Only the lengths of the lines in the buffer are kept, so each ack
+        costs the same whatever the size of the file, and every fill
+        returns all the lines that fit, to be written at once.
+        In the status mode the room reported by the status reports (Bf) is
+        used too: GRBL takes a line out of the buffer before acknowledging
+        it, when the planner is full, so the buffer can be kept fuller. """
+
+    RX_BUFFER_SIZE = 128
+    MODES = ('counting', 'status')
+
+    def __init__(self, rx_buffer_size=RX_BUFFER_SIZE, mode='counting'):
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = None
+        self.mode = mode if mode in self.MODES else self.MODES[0]
+        # lengths of the lines sent and not acknowledged yet, oldest first
+        self.line_lens = deque()
+        self.buffered_size = 0
+        # line taken from the source that did not fit the buffer yet
+        self.next_line = None
+        self.sent_lines = 0
+        self.ack_lines = 0
+        self.bytes_sent = 0
+        # bytes sent when the status requests still waiting for their report were written
+        self.poll_sent = deque()
+        # room in the buffer and free planner blocks of the last report, bytes sent before its request
+        self.status_free = None
+        self.status_sent = 0
+        self.planner_free = None
+        # reports with the planner empty while lines are waiting to be acknowledged
+        self.starved_reports = 0
+
+    def flush(self):
+        # the lines in the buffer are not going to be acknowledged
+        self.line_lens.clear()
+        self.buffered_size = 0
+        self.next_line = None
+
+    def reset(self):
+        self.flush()
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.sent_lines = 0
+        self.ack_lines = 0
+        self.starved_reports = 0
+
+    def reset_status(self):
+        # new connection, no report pending
+        self.poll_sent.clear()
+        self.status_free = None
+        self.planner_free = None
+
+    def set_mode(self, mode):
+        self.mode = mode if mode in self.MODES else self.MODES[0]
+
+    def set_buffer_sizes(self, rx_buffer_size, planner_size=None):
+        # sizes of the build, from the $I options
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+
+    def on_poll(self):
+        """ A status request has been written after the lines sent so far. """
+        self.poll_sent.append(self.bytes_sent)
+
+    def set_status(self, planner_free=None, rx_free=None):
+        """ Buffer data of a status report, None when it is not reported. """
+        if not self.poll_sent:
+            # not requested, there is no way to know which lines it includes
+            return
+        self.status_sent = self.poll_sent.popleft()
+        self.status_free = rx_free
+        self.planner_free = planner_free
+        if planner_free is not None and self.planner_size is not None:
+            if planner_free >= self.planner_size and self.line_lens:
+                self.starved_reports += 1
+
+    def get_free(self):
+        # the room sure to be free: the buffer size less the lines not acknowledged,
+        # or the room reported less all the bytes sent after its request
+        free = self.rx_buffer_size - 1 - self.buffered_size
+        if self.mode == 'status' and self.status_free is not None:
+            free = max(free, self.status_free - (self.bytes_sent - self.status_sent))
+        return free
+
+    def get_pending(self):
+        # lines in the controller buffer
+        return len(self.line_lens)
+
+    def fits(self, line):
+        # a line longer than the buffer is sent alone, when the buffer is empty
+        return not self.line_lens or len(line) <= self.get_free()
+
+    def fill(self, get_line):
+        """ Lines to send now. get_line gives the next line to send,
+            or None when there is nothing to send at the moment. """
+        lines = []
+        while True:
+            if self.next_line is None:
+                self.next_line = get_line()
+                if self.next_line is None:
+                    break
+            if not self.fits(self.next_line):
+                break
+            line = self.next_line
+            self.next_line = None
+            self.line_lens.append(len(line))
+            self.buffered_size += len(line)
+            self.bytes_sent += len(line)
+            self.sent_lines += 1
+            lines.append(line)
+        return lines
+
+    def ack(self):
+        """ The oldest line in the buffer has been processed. """
+        if not self.line_lens:
+            return False
+        self.buffered_size -= self.line_lens.popleft()
+        self.ack_lines += 1
+        return True
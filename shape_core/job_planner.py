@@ -0,0 +1,137 @@
+
+from collections import OrderedDict
+from .gcode_manager import GCoder
+
+
+class JobOperation:
+
+    MILL = "mill"
+    BIT = "bit"
+
+    def __init__(self, tag, machining_type, cfg, data, paths):
+        self.tag = tag
+        self.type = machining_type
+        self.cfg = cfg
+        self.data = data
+        self.paths = paths
+        self.kind = data[1]
+        self.diameter = data[0]
+        self.mirror = cfg.get('mirror', False)
+
+    def get_tool(self):
+        # a drill bit and a milling tool with the same diameter are not the same tool
+        tool_class = self.BIT if self.kind == 'drill' else self.MILL
+        return round(self.diameter, GCoder.DIGITS), tool_class
+
+    def __repr__(self):
+        return "JobOperation (" + self.tag + ", " + self.kind + ", " + str(self.get_tool()) + ")"
+
+
+class JobPlanner:
+    """ This class merges the generated jobs (top, bottom, drill, profile)
+        in one program per board setup. The operations sharing the same tool
+        are grouped in a single segment and the segments are ordered
+        so that the number of tool changes, and of the probing
+        executed by the tool change macro, is the minimum. """
+
+    # setups, the mirrored jobs are executed after flipping the board
+    SETUPS = ('top', 'bottom')
+
+    # operations order inside a segment,
+    # the profile releases the board so it is always the last one
+    KIND_ORDER = ('gerber', 'pocketing', 'drill', 'profile')
+
+    def __init__(self, parent=None, units='ms', mirror_type='x', compact=False):
+        self.parent = parent
+        self.units = units
+        self.mirror_type = mirror_type
+        self.compact = compact
+        self.jobs = OrderedDict()
+        self.last_tool = None
+
+    def add_job(self, tag, machining_type, cfg, path):
+        self.jobs[tag] = (machining_type, cfg, path)
+
+    def get_setup(self, cfg):
+        return self.SETUPS[int(bool(cfg.get('mirror', False)))]
+
+    def get_setup_jobs(self, setup):
+        return [tag for tag in self.jobs.keys() if self.get_setup(self.jobs[tag][1]) == setup]
+
+    def get_operations(self, setup):
+        ops = []
+        for tag in self.get_setup_jobs(setup):
+            machining_type, cfg, path = self.jobs[tag]
+            for d in path:
+                ops.append(JobOperation(tag, machining_type, cfg, d[0], d[1]))
+        return ops
+
+    def plan(self, setup, start_tool=None):
+        segments = OrderedDict()
+        for op in self.get_operations(setup):
+            tool = op.get_tool()
+            if tool not in segments.keys():
+                segments[tool] = []
+            segments[tool].append(op)
+        for tool in segments.keys():
+            segments[tool].sort(key=lambda o: self.KIND_ORDER.index(o.kind) if o.kind in self.KIND_ORDER else 0)
+
+        # thinner tools first, the segment containing the profile at the end
+        # and, if possible, start with the tool already in the spindle
+        tools = sorted(segments.keys())
+        last = [t for t in tools if any(op.kind == 'profile' for op in segments[t])]
+        first = [start_tool] if start_tool in tools and start_tool not in last else []
+        order = first + [t for t in tools if t not in first and t not in last] + last
+        return [(t, segments[t]) for t in order]
+
+    def get_separate_tool_changes(self, setup):
+        # tool changes needed executing the jobs one by one
+        n = 0
+        for tag in self.get_setup_jobs(setup):
+            machining_type, cfg, path = self.jobs[tag]
+            n += len(set(JobOperation(tag, machining_type, cfg, d[0], d[1]).get_tool() for d in path))
+        return n
+
+    def compute(self, setup, start_tool=None):
+        # start_tool is the tool known to be in the spindle when the program starts,
+        # otherwise the program starts with a tool change too
+        segments = self.plan(setup, start_tool)
+        if not segments:
+            return None
+
+        gcoder = GCoder(setup, machining_type='batch', parent=self.parent, units=self.units,
+                        mirror_type=self.mirror_type, compact=self.compact)
+        gcoder.gcode = []
+        gcoder.reset_modal()
+        gcoder.create_header()
+        gcoder.insert_comment("Batch Info:")
+        for tool, ops in segments:
+            gcoder.insert_comment("Tool " + tool[1] + " " + str(tool[0]) + ": " +
+                                  ", ".join(op.tag + " " + op.kind for op in ops))
+        gcoder.gcode.append("\n")
+        gcoder.add_init()
+
+        tool_changes = len(segments) - int(segments[0][0] == start_tool)
+        print("Compute Batch " + setup + ":")
+        print(" - Tool changes: " + str(tool_changes) +
+              " (separate jobs: " + str(self.get_separate_tool_changes(setup)) + ")")
+        for tool_id, (tool, ops) in enumerate(segments):
+            if tool_id > 0 or tool != start_tool:
+                # every operation ends in travel mode
+                gcoder.spindle_on(False)
+                gcoder.go_tool_change(tool_id=tool_id)
+            gcoder.insert_comment("Tool Segment, " + tool[1] + " diameter: " + str(tool[0]))
+            spindle = None
+            for op in ops:
+                gcoder.load_cfg(op.cfg)
+                gcoder.insert_comment("Job: " + op.tag + ", " + op.kind)
+                gcoder.go_travel()
+                if op.cfg['spindle'] != spindle:
+                    spindle = op.cfg['spindle']
+                    gcoder.spindle_on(True)
+                gcoder.compute_operation((op.data, op.paths), machining_type=op.type, mirror=op.mirror)
+
+        gcoder.spindle_on(False)
+        gcoder.go_to((0.0, 0.0))
+        self.last_tool = segments[-1][0]
+        return gcoder
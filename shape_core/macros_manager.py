@@ -73,10 +73,7 @@ class Macros:
         # splitted = re.findall(r'[a-zA-Z][-]*[\d.]+', cmd.strip().upper())
         # if self.CHANGE_TOOL_COMMAND in splitted:
         #    return True
-        print("Is Macro New: " + str(cmd))
-        macros_list = list(self.macros_dict.keys())
-        print(cmd.strip().upper() in macros_list)
-        return cmd.strip().upper() in macros_list
+        return cmd.strip().upper() in self.macros_dict.keys()
 
     def get_macro_string(self, macro):
         lines = []
@@ -0,0 +1,271 @@
+
+import os
+import time
+import numpy as np
+from collections import OrderedDict as od
+from .gcode_manager import GCodeLeveler
+
+
+class ProbeGrid:
+    """ Grid of the auto bed levelling probes. In the grid mode every point
+        is probed, in the adaptive mode a coarse grid is probed first and
+        the cells are split, probing the new points, only where the surface
+        is not linear within the tolerance. The points not probed are
+        interpolated from the corners of their cell, so the result is
+        always the full grid. """
+
+    MODES = ('grid', 'adaptive')
+    TOLERANCE_DEFAULT = 0.02
+    # points of the first coarse grid, for each axis
+    COARSE_STEPS = 4
+
+    def __init__(self, bbox_t, steps_t, mode='grid', tolerance=TOLERANCE_DEFAULT):
+        self.xc = np.linspace(bbox_t[0], bbox_t[3], steps_t[0])
+        self.yc = np.linspace(bbox_t[1], bbox_t[4], steps_t[1])
+        self.mode = mode if mode in self.MODES else self.MODES[0]
+        self.tolerance = tolerance
+        # heights in the meshgrid layout [y, x]
+        self.z = np.full((len(self.yc), len(self.xc)), np.nan)
+        # cells to check (x0, x1, y0, y1) in grid indexes, with the error estimated when they were made
+        self.cells = []
+        self.leaves = []
+        self.coarse = None
+        self.started = False
+        # last point of the previous batch, where the probe is
+        self.last_idx = None
+
+    def get_coords(self, idx_l):
+        return [(self.xc[ix], self.yc[iy]) for ix, iy in idx_l]
+
+    def get_center(self):
+        return (self.xc[0] + self.xc[-1]) / 2.0, (self.yc[0] + self.yc[-1]) / 2.0
+
+    def set_value(self, idx, z):
+        ix, iy = idx
+        self.z[iy, ix] = z
+
+    def get_probed_count(self):
+        return int(np.count_nonzero(~np.isnan(self.z)))
+
+    @staticmethod
+    def get_coarse_indexes(n, steps):
+        # about steps indexes, always including the first and the last one
+        if n <= steps:
+            return np.arange(n)
+        return np.unique(np.round(np.linspace(0, n - 1, steps)).astype(int))
+
+    def get_unprobed(self, ix_a, iy_a):
+        idx_l = []
+        for iy in iy_a:
+            for ix in ix_a:
+                if np.isnan(self.z[iy, ix]) and (ix, iy) not in idx_l:
+                    idx_l.append((ix, iy))
+        return idx_l
+
+    def get_coarse_errors(self, ix_a, iy_a):
+        # error of the linear interpolation on the coarse cells, from the second differences
+        zc = self.z[np.ix_(iy_a, ix_a)]
+        err = np.zeros(zc.shape)
+        if len(ix_a) > 2:
+            d2 = np.abs(zc[:, :-2] - 2 * zc[:, 1:-1] + zc[:, 2:]) / 8.0
+            err[:, 1:-1] = np.maximum(err[:, 1:-1], d2)
+            err[:, 0] = np.maximum(err[:, 0], d2[:, 0])
+            err[:, -1] = np.maximum(err[:, -1], d2[:, -1])
+        if len(iy_a) > 2:
+            d2 = np.abs(zc[:-2, :] - 2 * zc[1:-1, :] + zc[2:, :]) / 8.0
+            err[1:-1, :] = np.maximum(err[1:-1, :], d2)
+            err[0, :] = np.maximum(err[0, :], d2[0, :])
+            err[-1, :] = np.maximum(err[-1, :], d2[-1, :])
+        if len(ix_a) <= 2 and len(iy_a) <= 2:
+            # no way to estimate it
+            err[:] = np.inf
+        cells = []
+        for j in range(len(iy_a) - 1):
+            for i in range(len(ix_a) - 1):
+                e = err[j:j + 2, i:i + 2].max()
+                cells.append((ix_a[i], ix_a[i + 1], iy_a[j], iy_a[j + 1], e))
+        return cells
+
+    def get_bilinear(self, cell, ix, iy):
+        x0, x1, y0, y1 = cell[:4]
+        u = (self.xc[ix] - self.xc[x0]) / (self.xc[x1] - self.xc[x0]) if x1 > x0 else 0.0
+        v = (self.yc[iy] - self.yc[y0]) / (self.yc[y1] - self.yc[y0]) if y1 > y0 else 0.0
+        z = self.z
+        return (z[y0, x0] * (1 - u) * (1 - v) + z[y0, x1] * u * (1 - v) +
+                z[y1, x0] * (1 - u) * v + z[y1, x1] * u * v)
+
+    def split_cells(self):
+        # the cells not linear within the tolerance are split in four,
+        # the new points are returned to be probed
+        idx_l = []
+        cells = []
+        for cell in self.cells:
+            x0, x1, y0, y1, e = cell
+            if e <= self.tolerance or (x1 - x0 <= 1 and y1 - y0 <= 1):
+                self.leaves.append(cell)
+                continue
+            xm = (x0 + x1) // 2
+            ym = (y0 + y1) // 2
+            ix_a = np.unique([x0, xm, x1])
+            iy_a = np.unique([y0, ym, y1])
+            new_idx = self.get_unprobed(ix_a, iy_a)
+            idx_l += [i for i in new_idx if i not in idx_l]
+            for j in range(len(iy_a) - 1):
+                for i in range(len(ix_a) - 1):
+                    # the children take the residual of the parent, known after probing
+                    cells.append([ix_a[i], ix_a[i + 1], iy_a[j], iy_a[j + 1], cell])
+        self.cells = cells
+        return idx_l
+
+    def update_errors(self):
+        # residual of the probed points from the interpolation of the parent cell
+        parents = {}
+        for cell in self.cells:
+            parent = cell[4]
+            if id(parent) not in parents.keys():
+                x0, x1, y0, y1 = parent[:4]
+                xm = (x0 + x1) // 2
+                ym = (y0 + y1) // 2
+                res = [abs(self.z[iy, ix] - self.get_bilinear(parent, ix, iy))
+                       for ix in np.unique([x0, xm, x1]) for iy in np.unique([y0, ym, y1])]
+                parents[id(parent)] = max(res)
+            cell[4] = parents[id(parent)]
+        self.cells = [tuple(cell) for cell in self.cells]
+
+    def get_serpentine(self, idx_l):
+        # rows in order, each one in the opposite direction of the previous one,
+        # starting from the end nearest to where the probe is
+        rows = sorted(set(iy for ix, iy in idx_l))
+        ordered = []
+        for k, row in enumerate(rows):
+            ordered += sorted((i for i in idx_l if i[1] == row), key=lambda i: i[0], reverse=bool(k % 2))
+        if self.last_idx is not None and len(ordered) > 1:
+            p = np.array(self.get_coords([self.last_idx])[0])
+            first, last = (np.array(c) for c in self.get_coords([ordered[0], ordered[-1]]))
+            if np.linalg.norm(last - p) < np.linalg.norm(first - p):
+                ordered.reverse()
+        if ordered:
+            self.last_idx = ordered[-1]
+        return ordered
+
+    def next_batch(self):
+        """ Grid indexes (x, y) of the points to probe next, empty when done. """
+        return self.get_serpentine(self.get_next_points())
+
+    def get_next_points(self):
+        if not self.started:
+            self.started = True
+            if self.mode == 'grid':
+                return [(ix, iy) for iy in range(len(self.yc)) for ix in range(len(self.xc))]
+            ix_a = self.get_coarse_indexes(len(self.xc), self.COARSE_STEPS)
+            iy_a = self.get_coarse_indexes(len(self.yc), self.COARSE_STEPS)
+            self.coarse = (ix_a, iy_a)
+            return self.get_unprobed(ix_a, iy_a)
+        if self.mode == 'grid':
+            return []
+        if self.coarse is not None:
+            self.cells = self.get_coarse_errors(*self.coarse)
+            self.coarse = None
+        else:
+            self.update_errors()
+        while self.cells:
+            idx_l = self.split_cells()
+            if idx_l:
+                return idx_l
+            # the new cells have all their points already probed
+            self.update_errors()
+        self.fill()
+        return []
+
+    def fill(self):
+        # points not probed, from the corners of their cell
+        for cell in self.leaves:
+            x0, x1, y0, y1 = cell[:4]
+            for iy in range(y0, y1 + 1):
+                for ix in range(x0, x1 + 1):
+                    if np.isnan(self.z[iy, ix]):
+                        self.z[iy, ix] = self.get_bilinear(cell, ix, iy)
+
+    def get_abl_values(self, xy_offset=(0, 0)):
+        # [x, y, z] of the whole grid, in the order of get_grid_coords
+        xi, yi = np.meshgrid(self.xc + xy_offset[0], self.yc + xy_offset[1])
+        return np.stack((xi.ravel(), yi.ravel(), self.z.ravel()), axis=1).tolist()
+
+
+class HeightMap:
+    """ Probed height map of the stock, in working coordinates and relative
+        to the Z zero set at its center. It is saved with its metadata and
+        can be applied to every G-code milled on the same fixture. The
+        interpolation of each kind is computed once and shared by the files. """
+
+    VERSION = 1
+    FILE_SUFFIX = "_height_map.npz"
+    # max XY work offset change (mm) the map still fits the stock
+    WCO_TOLERANCE = 0.01
+
+    def __init__(self, grid_data, bbox=None, steps=None, wco=(0, 0, 0), timestamp=None):
+        self.grid_data = tuple(np.asarray(a, dtype=float) for a in grid_data)
+        self.bbox = tuple(bbox) if bbox is not None else None
+        self.steps = tuple(steps) if steps is not None else None
+        self.wco = tuple(float(w) for w in wco)
+        self.timestamp = timestamp if timestamp is not None else time.time()
+        self.interp_od = od({})
+
+    @classmethod
+    def from_probes(cls, abl_val, steps, wco, bbox=None):
+        # the last probe is the one in the center, setting the Z zero
+        probes = list(abl_val)
+        last_probe = probes.pop()
+        grid_data = GCodeLeveler.get_grid_data(probes, steps, last_probe, wco)
+        return cls(grid_data, bbox, steps, wco)
+
+    def get_interp(self, kind='cubic'):
+        ig = self.interp_od.get(kind)
+        if ig is None:
+            abl = GCodeLeveler(None, self.grid_data, kind=kind)
+            abl.interp_grid_data()
+            ig = abl.ig
+            self.interp_od[kind] = ig
+        return ig
+
+    def get_file_name(self, gcode_path):
+        # one file per job and probing, the maps of the other boards are kept
+        job = os.path.splitext(os.path.basename(gcode_path))[0] if gcode_path else "abl"
+        return job + time.strftime("_%Y%m%d_%H%M%S", time.localtime(self.timestamp)) + self.FILE_SUFFIX
+
+    def is_valid_for(self, wco, tolerance=WCO_TOLERANCE):
+        # the map is in working coordinates, it fits the stock only with the same XY origin.
+        # Z is not compared: the tool change sets the Z zero again
+        return np.allclose(self.wco[:2], np.asarray(wco, dtype=float)[:2], atol=tolerance)
+
+    def get_info(self):
+        info = od({})
+        info["bbox"] = self.bbox
+        info["steps"] = self.steps
+        info["wco"] = self.wco
+        info["time"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp))
+        info["z_range"] = (float(np.nanmin(self.grid_data[2])), float(np.nanmax(self.grid_data[2])))
+        return info
+
+    def save(self, path):
+        X, Y, Z = self.grid_data
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, version=self.VERSION, x=X, y=Y, z=Z,
+                                bbox=np.array(self.bbox if self.bbox is not None else [], dtype=float),
+                                steps=np.array(self.steps if self.steps is not None else [], dtype=int),
+                                wco=np.array(self.wco, dtype=float), timestamp=self.timestamp)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as d:
+                if int(d['version']) != cls.VERSION:
+                    return None
+                bbox = tuple(d['bbox'].tolist()) if d['bbox'].size else None
+                steps = tuple(d['steps'].tolist()) if d['steps'].size else None
+                return cls((d['x'], d['y'], d['z']), bbox, steps, d['wco'].tolist(), float(d['timestamp']))
+        except (OSError, KeyError, ValueError) as e:
+            print("Invalid height map file: " + str(e))
+            return None
@@ -279,30 +279,17 @@ class VisualLayer:
 
         self.update_order()
 
-    def add_gcode(self, tag, gcode_list, color=('white', 'orange')):
-        if gcode_list:
+    def add_gcode(self, tag, gcode_runs, color=('white', 'orange')):
+        # gcode_runs: list of (travel, points) of consecutive vectors of the same type
+        if gcode_runs:
             order = 0
             gcode_paths = {}
-            pre_d = gcode_list.pop(0)
-            coords = [pre_d.coords]
-            pre_d = gcode_list[0]
-            for d in gcode_list:
-                if d.type == pre_d.type:
-                    coords.append(d.coords)
+            for travel, coords in gcode_runs:
+                c = color[1] if travel else color[0]
+                if c not in gcode_paths.keys():
+                    gcode_paths[c] = [coords]
                 else:
-                    c = color[1] if pre_d.type == pre_d.TRAVEL else color[0]
-                    if c not in gcode_paths.keys():
-                        gcode_paths[c] = [coords]
-                    else:
-                        gcode_paths[c].append(coords)
-                    coords = [pre_d.coords]
-                    coords.append(d.coords)
-                pre_d = d
-            c = color[1] if pre_d.type == pre_d.TRAVEL else color[0]
-            if c not in gcode_paths.keys():
-                gcode_paths[c] = [coords]
-            else:
-                gcode_paths[c].append(coords)
+                    gcode_paths[c].append(coords)
 
             for color in gcode_paths.keys():
                 self.create_line(tag, gcode_paths[color], color, order)
@@ -0,0 +1,39 @@
+import re
+import pytest
+from shapely.geometry import LineString
+from shape_core.gcode_manager import GCoder
+
+MOVE_PAT = re.compile(r"^G0?1\b.*[XYZ]")
+FEED_PAT = re.compile(r"^[^(]*F")
+
+
+def drill_gcode(compact):
+    gcoder = GCoder("test", machining_type='drill', compact=compact)
+    gcoder.load_path([((0.8, 'drill'), [LineString([(0, 0), (1, 1)])]),
+                      ((1.0, 'drill'), [LineString([(2, 2), (3, 3)])]),
+                      ((1.2, 'drill'), [LineString([(4, 4), (5, 5)])])])
+    gcoder.compute()
+    return "".join(gcoder.gcode).splitlines()
+
+
+@pytest.mark.parametrize("compact", [True, False])
+def test_feed_after_tool_change(compact):
+    # the tool change macro sets its own feed rates, each working move after it needs a new F
+    lines = drill_gcode(compact)
+    assert sum(line.strip() == GCoder.CHANGE_TOOL_COMMAND for line in lines) == 2
+    feed_known = False
+    for line in lines:
+        line = line.strip()
+        if line == GCoder.CHANGE_TOOL_COMMAND:
+            feed_known = False
+        if FEED_PAT.match(line):
+            feed_known = True
+        if MOVE_PAT.match(line):
+            assert feed_known, line
+
+
+def test_compact_feed_not_repeated():
+    lines = drill_gcode(True)
+    feeds = [line for line in lines if FEED_PAT.match(line)]
+    # once per tool
+    assert len(feeds) == 3
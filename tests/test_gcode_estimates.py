@@ -0,0 +1,114 @@
+import math
+import pytest
+from shape_core.gcode_manager import GCodeParser
+from shape_core.gcode_stats import GCodeStats
+from shape_core.gcode_runtime import GCodeRuntime
+
+
+def parse(text):
+    gcp = GCodeParser({})
+    gcp.load_gcode_lines(text.strip().splitlines(True))
+    gcp.interp()
+    gcp.vectorize()
+    return gcp
+
+
+def test_stats():
+    gcp = parse("""
+G21
+G90
+G0 X0 Y0
+G1 X10 F100
+G1 Y10 F200
+G0 X0 Y0
+M6
+T1 M6
+M5 M6
+""")
+    st = GCodeStats.from_gcode(gcp.get_gcode(), rapid_rate=500.0)
+    assert st.line_count == 9
+    # M6 is counted after another word too
+    assert st.tool_changes == 3
+    assert st.cut_length == pytest.approx(20.0)
+    assert st.rapid_length == pytest.approx(math.sqrt(200))
+    assert st.feeds_od[100.0] == pytest.approx((10.0, 0.1))
+    assert st.feeds_od[200.0] == pytest.approx((10.0, 0.05))
+    assert st.no_feed_length == 0.0
+    assert st.get_time() == pytest.approx(0.15 + math.sqrt(200) / 500.0)
+    assert st.bb[:2] == (0.0, 0.0) and st.bb[3:5] == (10.0, 10.0)
+
+
+def test_stats_rapid_rate():
+    assert GCodeStats.get_rapid_rate(None) == GCodeStats.RAPID_RATE_DEFAULT
+    # the slowest of X and Y, as the runtime estimate moves them
+    assert GCodeStats.get_rapid_rate({110: 3000.0, 111: 2000.0, 112: 500.0}) == 2000.0
+
+
+def test_stats_move_without_feed():
+    gcp = parse("G1 X5\nG1 X10 F100\n")
+    st = GCodeStats.from_gcode(gcp.get_gcode())
+    assert st.no_feed_length == pytest.approx(5.0)
+    assert st.get_cut_time() == pytest.approx(0.05)
+
+
+# max rates above the feed rates of the tests, 10 mm/s^2
+SETTINGS = {110: 6000.0, 111: 6000.0, 112: 6000.0, 120: 10.0, 121: 10.0, 122: 10.0}
+
+
+def estimate(text, settings=SETTINGS):
+    gcp = parse(text)
+    rt = GCodeRuntime(settings)
+    rt.estimate(gcp)
+    return rt, gcp
+
+
+def test_runtime_default_settings():
+    # GRBL defaults: 500 mm/min max rates
+    rt, gcp = estimate("G1 X100 F600\n", None)
+    v = 500.0 / 60.0
+    assert rt.total_time == pytest.approx(100.0 / v + v / 10.0)
+
+
+def test_runtime_trapezoid():
+    # 10 mm/s with 10 mm/s^2: 1 s and 5 mm to accelerate and to stop, 9 s of cruise
+    rt, gcp = estimate("G21\nG1 X100 F600\n")
+    assert rt.total_time == pytest.approx(11.0)
+    assert len(rt.line_times) == gcp.get_recode_length()
+
+
+def test_runtime_triangle():
+    # too short to reach the feed rate: 5 mm accelerating, 5 mm stopping
+    rt, gcp = estimate("G1 X10 F6000\n")
+    assert rt.total_time == pytest.approx(2.0)
+
+
+def test_runtime_axis_limits():
+    # the max rate of the axis limits the travel moves
+    rt, gcp = estimate("G0 X100\n", {110: 300.0, 120: 100.0})
+    assert rt.settings_od[111] == GCodeRuntime.SETTINGS_DEFAULT[111]
+    assert rt.total_time == pytest.approx(100 / 5.0 + 5.0 / 100.0)
+
+
+def test_runtime_corners_and_dwell():
+    straight, _ = estimate("G1 X50 F600\nG1 X100\n")
+    corner, _ = estimate("G1 X50 F600\nG1 X50 Y50\n")
+    # the straight junction is not slowed down
+    assert straight.total_time == pytest.approx(11.0)
+    assert corner.total_time > straight.total_time
+
+    dwell, _ = estimate("G1 X50 F600\nG4 P2\nG1 X100\n")
+    # the dwell stops the motion too
+    assert dwell.total_time == pytest.approx(2 * 6.0 + 2.0)
+
+    tool_change, _ = estimate("G1 X50 F600\nT1 M6\nG1 X100\n")
+    assert tool_change.total_time == pytest.approx(2 * 6.0)
+
+
+def test_runtime_progress():
+    rt, gcp = estimate("G21\nG90\nG1 X10 F600\nG1 X20\nG1 X30\n")
+    n = len(rt.line_times)
+    assert list(rt.line_times) == sorted(rt.line_times)
+    assert rt.get_progress(0) == 0.0
+    assert rt.get_progress(n) == pytest.approx(100.0)
+    assert rt.get_eta(n) == pytest.approx(0.0)
+    assert 0.0 < rt.get_progress(n - 1) < 100.0
@@ -0,0 +1,38 @@
+import os
+import pytest
+from shape_core.gcode_manager import GCoder, GCodeParser
+
+
+def write_gcode(path, n):
+    gcoder = GCoder("test", "commander")
+    gcoder.gcode = ["G21\n", "G90\n"] + ["G1 X{} Y{}\n".format(i, i) for i in range(n)]
+    gcoder.write(str(path))
+
+
+def test_mapped_file_survives_generation(tmp_path):
+    gcode_path = tmp_path / "test.gcode"
+    write_gcode(gcode_path, 10)
+    gcp = GCodeParser({})
+    gcp.load_gcode_file(str(gcode_path))
+    gcp.interp()
+    gcp.vectorize()
+    stream = iter(gcp.get_gcode_stream())
+    first = [next(stream) for _ in range(3)]
+
+    # generated again while the file is streaming
+    write_gcode(gcode_path, 20)
+    rest = list(stream)
+    assert len(first) + len(rest) == 12
+    assert not os.path.exists(str(gcode_path) + ".tmp")
+
+
+def test_changed_file_is_reported(tmp_path):
+    gcode_path = tmp_path / "test.gcode"
+    write_gcode(gcode_path, 10)
+    gcp = GCodeParser({})
+    gcp.load_gcode_file(str(gcode_path))
+    gcp.interp()
+    gcp.release_gcode_file()
+    write_gcode(gcode_path, 20)
+    with pytest.raises(OSError, match="changed"):
+        gcp.recode_gcode()
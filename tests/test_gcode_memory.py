@@ -0,0 +1,24 @@
+import tracemalloc
+import numpy as np
+from shape_core.gcode_manager import GCodeVectors
+
+
+def measure_points_memory(n=100000):
+    """ Memory footprint, in bytes per point, of n points
+        as a list of GcodePoint and as a GCodeVectors table. """
+    vec = GCodeVectors(n)
+    vec.points[:, 0] = np.arange(n)
+    vec.params[::10, 0] = 250.0
+    tracemalloc.start()
+    vl = [vec.get_point(i) for i in range(n)]
+    list_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del vl
+    table_size = sum(getattr(vec, k).nbytes for k in GCodeVectors.FIELDS)
+    return list_size / n, table_size / n
+
+
+def test_points_table_memory():
+    list_size, table_size = measure_points_memory(20000)
+    # the table is the form kept for the millions of points of the levelled files
+    assert table_size < list_size / 2
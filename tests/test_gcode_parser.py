@@ -0,0 +1,27 @@
+import pytest
+from shape_core.gcode_manager import GCodeParser
+
+
+def parse(lines):
+    gcp = GCodeParser({})
+    gcp.load_gcode_lines(lines)
+    gcp.interp()
+    gcp.vectorize()
+    return gcp
+
+
+def test_system_commands_and_delimiters():
+    lines = ["%\n", "$H\n", "G21\n", "G90\n", "G0 X1 Y1\n", "G1 X2 Y2 F100\n", "X3\n", "$J=G91X1F100\n", "%\n"]
+    gcp = parse(lines)
+    out = gcp.recode_gcode()
+    assert out[:3] == ["$H\n", "G21\n", "G90\n"]
+    assert "$J=G91X1F100\n" in out
+    assert "%\n" not in out
+    assert len(out) == gcp.get_recode_length()
+
+
+def test_invalid_line_fails_at_load():
+    gcp = GCodeParser({})
+    gcp.load_gcode_lines(["G21\n", "G90\n", "#1=2\n", "G0 X1\n"])
+    with pytest.raises(ValueError, match="line 3"):
+        gcp.interp()
@@ -0,0 +1,137 @@
+import os
+import asyncio
+import pytest
+from shape_core.gcode_manager import GCoder, GCodeParser
+from shape_core.grbl_streamer import GrblStreamer
+from shape_core.grbl_sender import GrblSender
+from shape_core.grbl_async_sender import AsyncGrblSender, open_serial
+from tools.grbl_simulator import GrblSimulator
+
+
+def job_lines(n):
+    return ["G1 X{} Y{}\n".format(i, i) for i in range(n)]
+
+
+async def run_simulated(lines, block_time=0.0, wait_resume=None, timeout=None, alarm_after=None, mode="counting"):
+    sim = GrblSimulator(block_time=block_time)
+    sim.start()
+    fd = open_serial(sim.port)
+    try:
+        sender = AsyncGrblSender(fd, GrblSender(), wait_resume=wait_resume)
+        # the welcome is flushed opening the port
+        sender.WELCOME_TIMEOUT = 0.1
+        if alarm_after is not None:
+            asyncio.get_running_loop().call_later(alarm_after, sim.write, b"ALARM:1\r\n")
+        stats = await sender.run(lines, mode, timeout=timeout)
+    finally:
+        os.close(fd)
+        sim.close()
+    stats["overflows"] = sim.overflows
+    return stats
+
+
+@pytest.mark.parametrize("mode", GrblStreamer.MODES)
+def test_simulated_job(mode):
+    lines = job_lines(300)
+    stats = asyncio.run(run_simulated(lines, block_time=0.001, mode=mode, timeout=30.0))
+    assert stats["aborted"] is None
+    assert stats["lines"] == len(lines)
+    assert stats["bytes"] == sum(len(line) for line in lines)
+    assert stats["errors"] == 0
+    assert stats["overflows"] == 0
+
+
+def test_alarm_aborts():
+    stats = asyncio.run(run_simulated(job_lines(300), block_time=0.01, alarm_after=0.5))
+    assert stats["aborted"] == "ALARM:1"
+    assert stats["lines"] < 300
+
+
+def test_pause_without_resume_aborts():
+    lines = job_lines(5) + ["M0\n"] + job_lines(5)
+    stats = asyncio.run(run_simulated(lines, timeout=5.0))
+    assert stats["aborted"].startswith("program paused")
+
+
+def test_pause_resumed():
+    resumed = []
+
+    async def wait_resume():
+        resumed.append(True)
+
+    lines = job_lines(5) + ["M0\n"] + job_lines(5)
+    stats = asyncio.run(run_simulated(lines, wait_resume=wait_resume, timeout=5.0))
+    assert stats["aborted"] is None
+    assert stats["lines"] == len(lines)
+    assert resumed == [True]
+
+
+def test_timeout_aborts():
+    stats = asyncio.run(run_simulated(job_lines(300), block_time=0.01, timeout=0.5))
+    assert stats["aborted"].startswith("timeout")
+
+
+def test_no_response_aborts():
+    master_fd, slave_fd = os.openpty()
+    fd = open_serial(os.ttyname(slave_fd))
+    try:
+        sender = AsyncGrblSender(fd, GrblSender())
+        sender.WELCOME_TIMEOUT = 0.1
+        sender.RESPONSE_TIMEOUT = 0.3
+        stats = asyncio.run(sender.run(job_lines(10), timeout=5.0))
+    finally:
+        os.close(fd)
+        os.close(master_fd)
+        os.close(slave_fd)
+    assert stats["aborted"].startswith("no response")
+
+
+def test_macro_needs_machine_config():
+    lines = job_lines(2) + [GCoder.CHANGE_TOOL_COMMAND + "\n"] + job_lines(2)
+    sender = GrblSender()
+    assert sender.find_macro(lines) == 2
+    assert GrblSender(gcr=GCoder("dummy", "commander")).find_macro(lines) is None
+
+    sender.start(lines)
+    assert sender.fill() == lines[:2]
+    assert sender.abort_reason is not None
+    assert sender.is_end_of_file()
+
+
+def test_command_ok_not_taken_by_the_job():
+    sender = GrblSender()
+    sender.send_command("$I\n")
+    assert sender.fill() == ["$I\n"]
+    # the job starts before the reply to the command
+    lines = job_lines(3)
+    sender.start(lines)
+    assert sender.fill() == lines
+    assert sender.ack()
+    assert sender.commands_pending == 0
+    assert sender.streamer.get_pending() == len(lines)
+    assert not sender.is_done()
+    for _ in lines:
+        assert sender.ack()
+    assert sender.is_done()
+    assert sender.get_stats()["lines"] == len(lines)
+
+
+def test_eta_from_runtime():
+    from shape_core.gcode_runtime import GCodeRuntime
+    gcp = GCodeParser({})
+    gcp.load_gcode_lines(["G1 X10 F600\n", "G1 X20\n", "G1 X30\n"])
+    gcp.interp()
+    gcp.vectorize()
+    runtime = GCodeRuntime({110: 6000.0, 111: 6000.0, 112: 6000.0})
+    runtime.estimate(gcp)
+    lines = gcp.recode_gcode()
+
+    sender = GrblSender()
+    sender.start(lines)
+    assert sender.get_eta() is None
+    sender.start(lines, runtime)
+    assert sender.get_eta() == (runtime.total_time, runtime.total_time)
+    sender.fill()
+    while sender.ack():
+        pass
+    assert sender.get_eta() == (runtime.total_time, 0.0)
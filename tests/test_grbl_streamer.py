@@ -0,0 +1,102 @@
+import random
+from shape_core.grbl_streamer import GrblStreamer
+
+
+def line_source(lines):
+    it = iter(lines)
+    return lambda: next(it, None)
+
+
+def test_fill_counts_bytes():
+    streamer = GrblStreamer(rx_buffer_size=32)
+    lines = ["G1 X{}\n".format(i) for i in range(100, 120)]
+    sent = streamer.fill(line_source(lines))
+    # a byte of the buffer is always left free
+    assert sum(len(line) for line in sent) <= 31
+    assert sum(len(line) for line in sent) + len(lines[len(sent)]) > 31
+    assert streamer.buffered_size == sum(len(line) for line in sent)
+    assert streamer.get_pending() == len(sent)
+    # the line that did not fit is kept for the next fill
+    assert streamer.next_line == lines[len(sent)]
+
+
+def test_ack_frees_oldest_line():
+    streamer = GrblStreamer(rx_buffer_size=32)
+    get_line = line_source(["G0 X1\n", "G1 X22 Y33\n", "G1 X4444 Y5555\n", "M5\n"])
+    sent = streamer.fill(get_line)
+    assert sent == ["G0 X1\n", "G1 X22 Y33\n"]
+    assert streamer.ack()
+    assert streamer.buffered_size == len("G1 X22 Y33\n")
+    assert streamer.fill(get_line) == ["G1 X4444 Y5555\n", "M5\n"]
+    assert streamer.ack() and streamer.ack() and streamer.ack()
+    assert not streamer.ack()
+    assert streamer.ack_lines == 4
+    assert streamer.buffered_size == 0
+
+
+def test_long_line_sent_alone():
+    streamer = GrblStreamer(rx_buffer_size=16)
+    long_line = "G1 X1.23456 Y7.89012 Z-0.1\n"
+    get_line = line_source(["G0\n", long_line, "G0\n"])
+    assert streamer.fill(get_line) == ["G0\n"]
+    streamer.ack()
+    assert streamer.fill(get_line) == [long_line]
+    streamer.ack()
+    assert streamer.fill(get_line) == ["G0\n"]
+
+
+def test_counting_never_overflows():
+    # GRBL acknowledges a line only once it has left the buffer
+    rng = random.Random(1)
+    size = 128
+    streamer = GrblStreamer(size)
+    lines = ["G1 X{:.3f} Y{:.3f}\n".format(rng.uniform(-99, 99), rng.uniform(-99, 99)) * rng.randint(1, 3)
+             for _ in range(2000)]
+    get_line = line_source(lines)
+    rx = []
+    sent = 0
+    while sent < len(lines) or rx:
+        new = streamer.fill(get_line)
+        rx += new
+        sent += len(new)
+        assert sum(len(line) for line in rx) <= size - 1
+        for _ in range(rng.randint(1, 3)):
+            if rx:
+                rx.pop(0)
+                assert streamer.ack()
+    assert streamer.get_pending() == 0
+    assert streamer.sent_lines == len(lines)
+    assert streamer.bytes_sent == sum(len(line) for line in lines)
+
+
+def test_status_mode_uses_reported_room():
+    streamer = GrblStreamer(rx_buffer_size=64, mode='status')
+    streamer.set_buffer_sizes(64, planner_size=15)
+    lines = ["G1 X{}\n".format(i) for i in range(100, 150)]
+    get_line = line_source(lines)
+    first = streamer.fill(get_line)
+    # not requested, ignored
+    streamer.set_status(0, 63)
+    assert streamer.fill(get_line) == []
+    # the report says the lines already left the buffer, without their ok
+    streamer.on_poll()
+    streamer.set_status(0, 63)
+    more = streamer.fill(get_line)
+    assert more
+    assert sum(len(line) for line in more) <= 63
+    # the bytes sent after the request are not in the report
+    assert streamer.get_free() == 63 - sum(len(line) for line in more)
+
+
+def test_starved_reports():
+    streamer = GrblStreamer(rx_buffer_size=64, mode='status')
+    streamer.set_buffer_sizes(64, planner_size=15)
+    streamer.fill(line_source(["G1 X1\n"]))
+    streamer.on_poll()
+    streamer.set_status(15, 57)
+    assert streamer.starved_reports == 1
+    streamer.ack()
+    streamer.on_poll()
+    streamer.set_status(15, 63)
+    # nothing waiting, the planner is empty because the job is over
+    assert streamer.starved_reports == 1
@@ -0,0 +1,44 @@
+import re
+from shapely.geometry import LineString
+from shape_core.gcode_manager import GCoder
+from shape_core.job_planner import JobPlanner, JobOperation
+
+
+def make_planner():
+    planner = JobPlanner()
+    cfg = dict(GCoder("drill", "drill").cfg)
+    planner.add_job("drill", "drill", cfg, [((0.8, 'drill'), [LineString([(0, 0), (1, 1)])]),
+                                            ((1.0, 'drill'), [LineString([(2, 2), (3, 3)])])])
+    return planner
+
+
+def get_tool_changes(gcoder):
+    lines = "".join(gcoder.gcode).splitlines()
+    return [i for i, line in enumerate(lines) if line.strip() == GCoder.CHANGE_TOOL_COMMAND], lines
+
+
+def test_first_segment_tool_change():
+    planner = make_planner()
+    for start_tool in (None, (3.0, JobOperation.BIT)):
+        changes, lines = get_tool_changes(planner.compute("top", start_tool=start_tool))
+        assert len(changes) == 2
+        # before the first working move
+        first_move = next(i for i, line in enumerate(lines) if re.match(r"G0?1\b", line))
+        assert changes[0] < first_move
+
+
+def test_loaded_tool_skips_first_change():
+    planner = make_planner()
+    start_tool = (1.0, JobOperation.BIT)
+    segments = planner.plan("top", start_tool)
+    assert segments[0][0] == start_tool
+    changes, lines = get_tool_changes(planner.compute("top", start_tool=start_tool))
+    assert len(changes) == 1
+
+
+def test_setup_jobs():
+    planner = make_planner()
+    assert planner.get_setup_jobs("top") == ["drill"]
+    assert planner.get_setup_jobs("bottom") == []
+    assert planner.compute("bottom") is None
+
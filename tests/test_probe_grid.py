@@ -0,0 +1,107 @@
+import numpy as np
+from shape_core.probe_grid import ProbeGrid, HeightMap
+
+
+def make_height_map(wco=(10.0, 20.0, -5.0)):
+    X, Y = np.meshgrid(np.linspace(0, 10, 3), np.linspace(0, 20, 3))
+    Z = 0.01 * X - 0.02 * Y
+    return HeightMap((X, Y, Z), bbox=(0, 0, 10, 20), steps=(2, 2), wco=wco)
+
+
+def test_height_map_file_per_job(tmp_path):
+    hm = make_height_map()
+    name = hm.get_file_name(str(tmp_path / "top_gerber.gcode"))
+    assert name.startswith("top_gerber_") and name.endswith(HeightMap.FILE_SUFFIX)
+    assert make_height_map().get_file_name("bottom_drill.gcode") != name
+
+    hm_path = str(tmp_path / name)
+    hm.save(hm_path)
+    loaded = HeightMap.load(hm_path)
+    assert loaded.wco == hm.wco
+    assert np.allclose(loaded.grid_data[2], hm.grid_data[2])
+
+
+def test_height_map_work_offset():
+    hm = make_height_map()
+    assert hm.is_valid_for(np.array([10.0, 20.0, -5.0]))
+    # the tool change sets the Z zero again
+    assert hm.is_valid_for(np.array([10.0, 20.0, -3.2]))
+    assert not hm.is_valid_for(np.array([12.0, 20.0, -5.0]))
+
+
+def probe_all(grid, surface):
+    # probe every batch, returns the number of probes and the batches
+    batches = []
+    while True:
+        batch = grid.next_batch()
+        if not batch:
+            break
+        batches.append(batch)
+        for idx, (x, y) in zip(batch, grid.get_coords(batch)):
+            grid.set_value(idx, surface(x, y))
+    return sum(len(b) for b in batches), batches
+
+
+def test_grid_mode_probes_every_point():
+    grid = ProbeGrid((0, 0, 0, 40, 20, 0), (5, 3))
+    n, batches = probe_all(grid, lambda x, y: 0.0)
+    assert n == 15 and len(batches) == 1
+    assert grid.get_probed_count() == 15
+
+
+def test_serpentine_order():
+    grid = ProbeGrid((0, 0, 0, 40, 20, 0), (5, 3))
+    batch = grid.next_batch()
+    rows = [[ix for ix, iy in batch if iy == row] for row in range(3)]
+    # one row after the other, alternating the direction
+    assert batch == [(ix, 0) for ix in rows[0]] + [(ix, 1) for ix in rows[1]] + [(ix, 2) for ix in rows[2]]
+    assert rows[0] == sorted(rows[0])
+    assert rows[1] == sorted(rows[1], reverse=True)
+    assert rows[2] == sorted(rows[2])
+
+
+def test_serpentine_starts_near_the_probe():
+    idx_l = [(0, 0), (4, 0), (0, 4), (4, 4)]
+    grid = ProbeGrid((0, 0, 0, 40, 40, 0), (5, 5))
+    grid.last_idx = (0, 0)
+    assert grid.get_serpentine(idx_l) == [(0, 0), (4, 0), (4, 4), (0, 4)]
+    # the serpentine ends on the other corner, it is run backwards
+    grid.last_idx = (0, 4)
+    batch = grid.get_serpentine(idx_l)
+    assert batch == [(0, 4), (4, 4), (4, 0), (0, 0)]
+    assert grid.last_idx == batch[-1]
+
+
+def test_adaptive_plane():
+    grid = ProbeGrid((0, 0, 0, 80, 80, 0), (17, 17), mode='adaptive', tolerance=0.01)
+    n, batches = probe_all(grid, lambda x, y: 0.001 * x - 0.002 * y)
+    # a plane is linear everywhere, only the coarse grid is probed
+    assert n == ProbeGrid.COARSE_STEPS ** 2
+    X, Y = np.meshgrid(grid.xc, grid.yc)
+    assert np.allclose(grid.z, 0.001 * X - 0.002 * Y)
+
+
+def test_adaptive_curved():
+    def surface(x, y):
+        return 0.3 * np.exp(-((x - 20) ** 2 + (y - 20) ** 2) / 50.0)
+
+    tolerance = 0.01
+    grid = ProbeGrid((0, 0, 0, 80, 80, 0), (17, 17), mode='adaptive', tolerance=tolerance)
+    n, batches = probe_all(grid, surface)
+    assert ProbeGrid.COARSE_STEPS ** 2 < n < 17 * 17
+    assert len(batches) > 1
+    X, Y = np.meshgrid(grid.xc, grid.yc)
+    assert not np.isnan(grid.z).any()
+    # the bump is refined, the flat part is not
+    assert np.abs(grid.z - surface(X, Y)).max() < 5 * tolerance
+
+
+def test_height_map_interp_per_kind():
+    X, Y = np.meshgrid(np.linspace(0, 30, 4), np.linspace(0, 30, 4))
+    hm = HeightMap((X, Y, 0.001 * X ** 2), bbox=(0, 0, 30, 30), steps=(4, 4))
+    linear = hm.get_interp('linear')
+    cubic = hm.get_interp('cubic')
+    # computed once for each kind, shared by the files
+    assert hm.get_interp('linear') is linear and hm.get_interp('cubic') is cubic
+    assert np.isclose(cubic(5.0, 5.0), 0.025)
+    assert np.isclose(linear(5.0, 5.0), 0.05)
@@ -0,0 +1,71 @@
+import os
+import sys
+import argparse
+import asyncio
+from shape_core.grbl_streamer import GrblStreamer
+from shape_core.grbl_sender import GrblSender
+from shape_core.grbl_async_sender import AsyncGrblSender, SETTINGS_FOLDER, open_serial, read_gcode_lines, \
+    load_commander, wait_enter
+from tools.grbl_simulator import GrblSimulator
+
+
+async def send_file(args):
+    lines = read_gcode_lines(args.file)
+    sender = GrblSender(args.rx_buffer_size, load_commander(args.machine_config))
+    idx = sender.find_macro(lines)
+    if idx is not None:
+        raise ValueError("line " + str(idx + 1) + ": " + lines[idx].strip() +
+                         ", the macros need the machine configuration (" + args.machine_config + ")")
+    sim = None
+    port = args.port
+    if args.simulate:
+        sim = GrblSimulator(args.rx_buffer_size, block_time=args.block_time)
+        sim.start()
+        port = sim.port
+    fd = open_serial(port, args.baud)
+    try:
+        wait_resume = wait_enter if args.interactive else None
+        stats = await AsyncGrblSender(fd, sender, args.verbose, wait_resume).run(lines, args.mode, args.timeout)
+    finally:
+        os.close(fd)
+        if sim is not None:
+            sim.close()
+    if sim is not None:
+        stats["overflows"] = sim.overflows
+    return stats
+
+
+def main(argv=None):
+    # python -m tools.grbl_send file.gcode --port /dev/ttyUSB0
+    # python -m tools.grbl_send file.gcode --simulate
+    parser = argparse.ArgumentParser(description="Send a G-code file to GRBL and report the throughput.")
+    parser.add_argument("file")
+    parser.add_argument("--port", help="serial device")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--mode", choices=GrblStreamer.MODES, default=GrblStreamer.MODES[0])
+    parser.add_argument("--rx-buffer-size", type=int, default=GrblStreamer.RX_BUFFER_SIZE)
+    parser.add_argument("--simulate", action="store_true", help="send to a simulated GRBL on a pty")
+    parser.add_argument("--block-time", type=float, default=0.0, help="seconds per block of the simulator")
+    parser.add_argument("--machine-config", default=SETTINGS_FOLDER,
+                        help="folder of machine_config.ini, used by the tool change macro")
+    parser.add_argument("--interactive", action="store_true", help="resume the program pauses (M0) from the keyboard")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds before the job is aborted")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if not args.simulate and not args.port:
+        parser.error("a port is needed, or --simulate")
+
+    try:
+        stats = asyncio.run(send_file(args))
+    except ValueError as e:
+        parser.exit(2, "not sent, " + str(e) + "\n")
+    print("{lines} lines, {bytes} bytes in {time:.2f} s: {lines_s:.0f} lines/s, {bytes_s:.0f} bytes/s".format(**stats))
+    print("errors: " + str(stats["errors"]) + ", planner empty reports: " + str(stats["planner_empty_reports"]) +
+          ("" if "overflows" not in stats else ", buffer overflows: " + str(stats["overflows"])))
+    if stats["aborted"] is not None:
+        print("aborted: " + stats["aborted"])
+    return 0 if stats["errors"] == 0 and stats["aborted"] is None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
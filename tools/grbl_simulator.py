@@ -0,0 +1,86 @@
+import os
+import asyncio
+from shape_core.grbl_streamer import GrblStreamer
+
+
+class GrblSimulator:
+    """ Minimal GRBL on a pty, to measure the streaming: a RX buffer that
+        counts the overflows, a planner executing a block every block_time
+        seconds, the status reports with the buffer data and the program
+        pause (M0) until the cycle start. """
+
+    def __init__(self, rx_buffer_size=GrblStreamer.RX_BUFFER_SIZE, planner_size=15, block_time=0.0):
+        import tty
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.port = os.ttyname(self.slave_fd)
+        self.rx_buffer_size = rx_buffer_size
+        self.planner_size = planner_size
+        self.block_time = block_time
+        self.rx = bytearray()
+        self.planner = 0
+        self.overflows = 0
+        self.hold = False
+        self.loop = None
+        self.task = None
+
+    def write(self, data):
+        os.write(self.master_fd, data)
+
+    def on_readable(self):
+        try:
+            data = os.read(self.master_fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if b"~" in data:
+            self.hold = False
+            data = data.replace(b"~", b"")
+        for c in data.split(b"?"):
+            self.rx += c
+        for _ in range(data.count(b"?")):
+            self.write("<{}|MPos:0.000,0.000,0.000|Bf:{},{}|FS:0,0>\r\n".format(
+                "Hold:0" if self.hold else "Run" if self.planner else "Idle", self.planner_size - self.planner,
+                max(self.rx_buffer_size - 1 - len(self.rx), 0)).encode())
+        if len(self.rx) > self.rx_buffer_size - 1:
+            self.overflows += 1
+            del self.rx[self.rx_buffer_size - 1:]
+        self.process()
+
+    def process(self):
+        # the lines leave the buffer when there is room in the planner
+        while self.planner < self.planner_size and not self.hold:
+            end = self.rx.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self.rx[:end]).strip()
+            del self.rx[:end + 1]
+            if line == b"$I":
+                self.write("[VER:1.1h.sim:]\r\n[OPT:V,{},{}]\r\n".format(
+                    self.planner_size, self.rx_buffer_size).encode())
+            elif line == b"M0":
+                self.hold = True
+            elif line and not line.startswith(b"$"):
+                self.planner += 1
+            self.write(b"ok\r\n")
+
+    async def execute(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            if self.planner and not self.hold:
+                self.planner -= 1
+                self.process()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(self.master_fd, self.on_readable)
+        self.task = asyncio.ensure_future(self.execute())
+        self.write(b"\r\nGrbl 1.1h ['$' for help]\r\n")
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.loop is not None:
+            self.loop.remove_reader(self.master_fd)
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
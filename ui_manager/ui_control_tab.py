@@ -1,9 +1,11 @@
-from PySide2.QtCore import Signal, Slot, QObject, QSize, Qt, QPersistentModelIndex, QItemSelectionModel
-from PySide2.QtWidgets import QFileDialog, QLabel, QRadioButton, QHeaderView, QButtonGroup, QAbstractItemView
+from PySide2.QtCore import Signal, Slot, QObject, QSize, Qt, QPersistentModelIndex, QItemSelectionModel, QTimer
+from PySide2.QtWidgets import QFileDialog, QLabel, QRadioButton, QHeaderView, QButtonGroup, QAbstractItemView, QAction, \
+    QMenu, QActionGroup
 from PySide2.QtGui import QIcon
 from style_manager import StyleManager
 import os
 import logging
+from collections import deque
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +26,13 @@ class UiControlTab(QObject):
     remove_gcode_s = Signal(str)
 
     ui_send_cmd_s = Signal(str, tuple)
+    load_height_map_s = Signal(str)              # Signal to load a saved height map
+    set_abl_interp_s = Signal(str, str)          # Signal to choose the height map interpolation of a file
+
+    # height map interpolations offered for a file, "" is the one of the machine settings
+    ABL_INTERP_NAMES = (("", "Default"), ("linear", "Bilinear"), ("cubic", "Bicubic"))
+
+    CONSOLE_REFRESH_MS = 100
 
     def __init__(self, ui, control_worker, serial_worker, ctrl_layer, settings):
         """
@@ -55,6 +64,15 @@ class UiControlTab(QObject):
         self.serial_connection_status = False
         self.serial_ports_name_ls = []
         self.serial_ports_baudrate_ls = []
+
+        # the console text is collected and shown at a fixed rate, only the last lines are kept
+        self.console_text_l = deque(maxlen=self.app_settings.console_max_lines)
+        self.ui.serial_te.document().setMaximumBlockCount(self.app_settings.console_max_lines)
+        self.console_timer = QTimer(self)
+        self.console_timer.setInterval(self.CONSOLE_REFRESH_MS)
+        self.console_timer.timeout.connect(self.flush_console_text)
+        self.console_timer.start()
+
         self.ui_serial_send_s.connect(self.controlWo.execute_gcode_cmd)
         self.ui_serial_open_s.connect(self.serialWo.open_port)
         self.ui_serial_close_s.connect(self.serialWo.close_port)
@@ -65,6 +83,7 @@ class UiControlTab(QObject):
         self.controlWo.update_bbox_s.connect(self.update_bbox)
         self.controlWo.update_console_text_s.connect(self.update_console_text)
         self.controlWo.update_file_progress_s.connect(self.update_progress_bar)
+        self.controlWo.update_file_eta_s.connect(self.update_eta)
 
         self.send_gcode_s.connect(self.controlWo.send_gcode_file)
         self.stop_gcode_s.connect(self.controlWo.stop_gcode_file)
@@ -72,6 +91,7 @@ class UiControlTab(QObject):
 
         # From Controller Manager to Serial Manager
         self.controlWo.gcode_vectorized_s.connect(self.enable_gcode_cb)
+        self.controlWo.gcode_failed_s.connect(self.show_gcode_failed)
         self.controlWo.serial_send_s.connect(self.serialWo.send)
         self.controlWo.serial_tx_available_s.connect(self.serialWo.send_from_queue)
 
@@ -133,6 +153,12 @@ class UiControlTab(QObject):
         self.ui.abl_active_chb.stateChanged.connect(
             lambda: self.controlWo.set_abl_active(self.ui.abl_active_chb.isChecked()))
         self.ui.get_bbox_pb.clicked.connect(self.controlWo.get_boundary_box)
+        self.load_height_map_action = QAction("Load Height Map...", self.ui.menuFile)
+        self.load_height_map_action.triggered.connect(self.open_height_map)
+        self.ui.menuFile.addAction(self.load_height_map_action)
+        self.load_height_map_s.connect(self.controlWo.load_height_map)
+        self.set_abl_interp_s.connect(self.controlWo.set_abl_interp)
+        self.abl_interp_od = {}
         self.ui.x_min_dsb.valueChanged.connect(self.update_bbox_x_steps)
         self.ui.x_max_dsb.valueChanged.connect(self.update_bbox_x_steps)
         self.ui.x_num_step_sb.valueChanged.connect(self.update_bbox_x_num_steps)
@@ -375,6 +401,9 @@ class UiControlTab(QObject):
                     # The total path is just in the ToolTip while the name shown is only the name
                     new_la = QLabel(os.path.basename(elem))
                     new_la.setToolTip(elem)
+                    new_la.setContextMenuPolicy(Qt.CustomContextMenu)
+                    new_la.customContextMenuRequested.connect(
+                        lambda pos, la=new_la: self.show_gcode_menu(la, pos))
                     self.ui.gcode_tw.setCellWidget(num_rows, 0, new_la)
                     column = 1
                     row = num_rows
@@ -394,12 +423,47 @@ class UiControlTab(QObject):
 
                 self.precalc_gcode_s.emit(elem)
 
+    def show_gcode_menu(self, label, pos):
+        # the interpolation of the height map is chosen for each file
+        gcode_path = label.toolTip()
+        menu = QMenu(label)
+        interp_menu = menu.addMenu("ABL Interpolation")
+        # enabled once the file is parsed
+        row = self.element_in_table(gcode_path)
+        interp_menu.setEnabled(row >= 0 and self.ui.gcode_tw.cellWidget(row, 1).isEnabled())
+        group = QActionGroup(interp_menu)
+        for kind, name in self.ABL_INTERP_NAMES:
+            if not kind:
+                name += " (" + self.machine_settings.abl_interp + ")"
+            action = interp_menu.addAction(name)
+            action.setCheckable(True)
+            action.setChecked(self.abl_interp_od.get(gcode_path, "") == kind)
+            action.setData(kind)
+            group.addAction(action)
+        action = menu.exec_(label.mapToGlobal(pos))
+        if action is not None and action.actionGroup() is group:
+            self.abl_interp_od[gcode_path] = action.data()
+            self.set_abl_interp_s.emit(gcode_path, action.data())
+
     @Slot(str)
     def enable_gcode_cb(self, gcode_path):
         row = self.element_in_table(gcode_path)
         if row >= 0:
+            label = self.ui.gcode_tw.cellWidget(row, 0)
+            label.setText(os.path.basename(gcode_path))
+            label.setStyleSheet("")
             self.ui.gcode_tw.cellWidget(row, 1).setEnabled(True)
 
+    @Slot(str)
+    def show_gcode_failed(self, gcode_path):
+        # the file stays in the table, it can be loaded again once fixed
+        row = self.element_in_table(gcode_path)
+        if row >= 0:
+            label = self.ui.gcode_tw.cellWidget(row, 0)
+            label.setText(os.path.basename(gcode_path) + " (not loaded)")
+            label.setStyleSheet("color: red;")
+            self.ui.gcode_tw.cellWidget(row, 1).setEnabled(False)
+
     @Slot(int)
     def gcode_item_selected(self, index):
         if index.isValid():
@@ -434,6 +498,7 @@ class UiControlTab(QObject):
             gcode_path = self.ui.gcode_tw.cellWidget(row, 0).toolTip()
             tag, _ = self.controlWo.get_gcode_data(gcode_path)
             self.remove_gcode_s.emit(gcode_path)
+            self.abl_interp_od.pop(gcode_path, None)
             self.ctrl_layer.remove_gcode(tag)
             self.ui.gcode_tw.removeRow(row)
 
@@ -505,7 +570,13 @@ class UiControlTab(QObject):
     @Slot(str)
     def update_console_text(self, new_text):
         pruned_text = new_text.strip()
-        self.ui.serial_te.append(pruned_text)
+        if pruned_text:
+            self.console_text_l.extend(pruned_text.splitlines())
+
+    def flush_console_text(self):
+        if self.console_text_l:
+            self.ui.serial_te.append("\n".join(self.console_text_l))
+            self.console_text_l.clear()
 
     def send_input(self):
         """Send input to the serial port."""
@@ -611,6 +682,7 @@ class UiControlTab(QObject):
         self.ui.get_tool_change_pb.setEnabled(False)
 
     def handle_clear_terminal(self):
+        self.console_text_l.clear()
         self.ui.serial_te.clear()
 
     def hide_show_console(self):
@@ -781,11 +853,33 @@ class UiControlTab(QObject):
         bbox_t, steps_t = self.get_abl_inputs()
         self.controlWo.send_abl_s.emit(bbox_t, steps_t)
 
+    def open_height_map(self):
+        load_hm = QFileDialog.getOpenFileName(None, "Load Height Map", self.gcf_settings.gcode_folder,
+                                              "Height Maps (*_height_map.npz)" + ";;All files (*.*)")
+        logger.debug(load_hm)
+        if load_hm[0]:
+            self.load_height_map_s.emit(os.path.normpath(load_hm[0]))
+
     @Slot(float)
     def update_progress_bar(self, prog_percentage):
         logger.debug(prog_percentage)
         self.ui.progressBar.setValue(prog_percentage)
 
+    @staticmethod
+    def format_time(seconds):
+        m, s = divmod(int(round(seconds)), 60)
+        h, m = divmod(m, 60)
+        return "{:d}:{:02d}:{:02d}".format(h, m, s)
+
+    @Slot(float, float)
+    def update_eta(self, total_time, remaining_time):
+        # the estimated times are shown in the progress bar, when the job has them
+        if total_time > 0:
+            self.ui.progressBar.setFormat("%p%  ETA " + self.format_time(remaining_time) +
+                                          " / " + self.format_time(total_time))
+        else:
+            self.ui.progressBar.setFormat("%p%")
+
     @Slot()
     def update_bbox_x_num_steps(self):
         self.machine_settings.x_bbox_step = self.ui.x_num_step_sb.value()